@@ -1,55 +1,94 @@
 import os
 import json
+import hashlib
 import time
-import queue
 import threading
-from concurrent.futures import ThreadPoolExecutor
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file, flash
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, flash, stream_with_context
+from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from pdf_processor import process_pdf, get_pdf_metadata
-from config import logger, MAX_QUEUE_SIZE, DOCUMENT_PROCESSING_DELAY, API_USAGE_LOG_PATH
-import openai
-from openai import OpenAI
-from openpyxl import Workbook
-import io
-import csv
-from diskcache import Cache
-from rag_system import initialize_rag_system, get_relevant_chunks
+from sqlalchemy.exc import IntegrityError
+from async_processor import cancel_document
+from config import (
+    logger,
+    API_USAGE_LOG_PATH,
+    STARTUP_MODE,
+    PROCESSING_WORKERS,
+    PROCESSING_WORKER_MODE,
+    JOB_MAX_ATTEMPTS,
+    EVENT_POLL_INTERVAL,
+    EVENT_STREAM_SECONDS,
+    PROFILING_ENABLED,
+    DOCUMENTS_PER_PAGE,
+    BULK_EXPORT_MAX_DOCUMENTS,
+    CHATBOT_MODEL,
+    CHATBOT_TOP_K,
+    DOCUMENT_TOKEN_BUDGET,
+    DOCUMENT_SYNC_INTERVAL,
+)
+from llm_cache import cache_stats
+from usage_metrics import usage_metrics, record_api_call
+from rag_system import get_rag_system, remove_from_rag_system
+from embedding_service import embedding_stats, QUERY
+from chatbot import answer_cache, select_passages, build_messages, NO_CONTEXT_ANSWER
+from job_queue import JobQueue, QUEUED, RUNNING, COMPLETED, FAILED
+from worker import start_worker_threads
+from scheduler import chunk_scheduler
+from instrumentation import span, stage_seconds, register_gauge, expose_metrics
+from revisions import revision_store, revision_key
+from exports import checklist_rows, stream_csv, stream_zip, write_workbook, stream_file, EXCEL_MIMETYPE
+from models import db, User, Document, ACTIVE_STATUSES, visible_documents, create_schema
+from uploads import receive_upload, keep_upload
+from shared_state import shared_state, api_slots
 
 app = Flask(__name__)
 app.config.from_object('config')
-app.config['SECRET_KEY'] = os.urandom(24)
+db.init_app(app)
+with app.app_context():
+    create_schema()
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-class User(UserMixin):
-    def __init__(self, id, username, password_hash):
-        self.id = id
-        self.username = username
-        self.password_hash = password_hash
-
-users = {}
-
 @login_manager.user_loader
 def load_user(user_id):
-    return users.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
-processing_queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
-documents = {}
-api_semaphore = threading.Semaphore(2)
-api_queue = queue.Queue()
+processing_queue = JobQueue()
+usage_metrics.import_csv_log(API_USAGE_LOG_PATH)
 
 MAX_RETRIES = 5
 
-cache = Cache('./cache')
-
-executor = ThreadPoolExecutor(max_workers=4)
+_client = None
+
+def get_openai_client():
+    # The openai package is slow to import, so the client is built on first use
+    global _client
+    if _client is None:
+        from openai import OpenAI
+        _client = OpenAI()
+    return _client
+
+def warm_up():
+    """Load heavy components ahead of the first request that needs them, returning seconds per component"""
+    timings = {}
+    for name, load in (
+        ('openai_client', get_openai_client),
+        ('openpyxl', lambda: __import__('openpyxl')),
+        ('rag_system', get_rag_system),
+    ):
+        started = time.perf_counter()
+        try:
+            load()
+            timings[name] = round(time.perf_counter() - started, 3)
+            logger.info(f"Warmed up {name} in {timings[name]:.2f}s")
+        except Exception as e:
+            logger.error(f"Error warming up {name}: {str(e)}")
+    return timings
 
-client = OpenAI()
+if STARTUP_MODE == 'background':
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() == 'pdf'
@@ -69,7 +108,7 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        user = next((u for u in users.values() if u.username == username), None)
+        user = User.query.filter_by(username=username).first()
         if user and check_password_hash(user.password_hash, password):
             login_user(user)
             return redirect(url_for('index'))
@@ -87,15 +126,59 @@ def register():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        if username in [u.username for u in users.values()]:
+        if User.query.filter_by(username=username).first() is not None:
             flash('Username already exists')
         else:
-            user_id = len(users) + 1
-            users[user_id] = User(user_id, username, generate_password_hash(password))
+            db.session.add(User(username=username, password_hash=generate_password_hash(password)))
+            db.session.commit()
             flash('Registration successful. Please log in.')
             return redirect(url_for('login'))
     return render_template('register.html')
 
+def save_upload(filename, content_hash, temp_path):
+    """Store a received upload as document `filename` and attach it to the job for its content"""
+    # Web workers serialize changes per document and per content: a re-upload, a delete and an
+    # identical upload must not interleave between checking for the stored file and attaching the job
+    with shared_state.lock(f'document:{current_user.id}:{filename}'):
+        with shared_state.lock(f'content:{content_hash}'):
+            file_path = keep_upload(temp_path, app.config['UPLOAD_FOLDER'], content_hash)
+            # Re-uploading a filename replaces the user's previous document and its result
+            document = (
+                Document.query.filter_by(owner_id=current_user.id, filename=filename).first()
+                or Document(owner_id=current_user.id, filename=filename)
+            )
+            replaced = document.job_key if document.id is not None and document.job_key != content_hash else None
+            document.path = file_path
+            document.content_hash = content_hash
+            document.retry_count = 0
+            document.error = None
+            document.chunk_count = document.item_count = None
+            document.result = None
+            payload = {
+                'filename': filename,
+                'path': file_path,
+                'content_hash': content_hash,
+                'user_id': current_user.id,
+                # Estimated tokens the document's chunk requests may use; 0 = unlimited
+                'token_budget': request.form.get('token_budget', DOCUMENT_TOKEN_BUDGET, type=int),
+            }
+            if PROFILING_ENABLED and request.form.get('profile') == '1':
+                payload['profile'] = True
+            # Identical content attaches to its queued or running job, or takes its finished result
+            job, created = processing_queue.attach(
+                content_hash,
+                payload,
+                priority=request.form.get('priority', 0, type=int),
+                max_attempts=JOB_MAX_ATTEMPTS,
+            )
+            if not created:
+                logger.info(f"Upload {filename} has the same content as {job['payload']['filename']}; sharing its job")
+            apply_job(document, job)
+            db.session.add(document)
+            db.session.commit()
+        if replaced:
+            release_content(replaced)
+
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload_file():
@@ -108,103 +191,274 @@ def upload_file():
     for file in files:
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            document = {
-                'filename': filename,
-                'path': file_path,
-                'status': 'Uploaded',
-                'processing': False,
-                'retry_count': 0
-            }
-            documents[filename] = document
-            processing_queue.put(filename)
+            content_hash, temp_path = receive_upload(file.stream, app.config['UPLOAD_FOLDER'])
+            try:
+                save_upload(filename, content_hash, temp_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
         else:
             return jsonify(error="Invalid file type. Only PDF files are allowed."), 400
 
     return jsonify(message="Files uploaded successfully"), 200
 
-def process_document(filename):
-    document = documents[filename]
-    document['processing'] = True
-    document['status'] = 'Processing'
-
+JOB_STATUS_LABELS = {QUEUED: 'Queued', RUNNING: 'Processing', COMPLETED: 'Completed', FAILED: 'Failed'}
+
+def apply_job(document, job):
+    document.status = JOB_STATUS_LABELS[job['status']]
+    if job['status'] == QUEUED and job['error']:
+        document.status = 'Retrying'
+    document.retry_count = job['retry_count']
+    document.error = job['error'] if job['status'] == FAILED else None
+    document.eta_at = job['eta_at'] if job['status'] == RUNNING else None
+    if job['status'] == COMPLETED and job['result'] is not None:
+        result = job['result']
+        if 'revision' in result and document.owner_id != job['payload'].get('user_id'):
+            # The revision entry compares with the previous version of the uploader's own document
+            result = {key: value for key, value in result.items() if key != 'revision'}
+        document.result = result
+        document.chunk_count = job['result'].get('chunk_count')
+        document.item_count = job['result'].get('item_count', 0)
+
+def sync_documents():
+    """Apply job state changes made by any worker (thread or process) to the document store.
+
+    Web workers share the time of the last sync and take turns: while one applies changes the
+    others read the documents as last synced, and none syncs again within DOCUMENT_SYNC_INTERVAL.
+    """
+    now = time.time()
+    if now - float(shared_state.get('documents:last_sync') or 0) < DOCUMENT_SYNC_INTERVAL:
+        return
+    with shared_state.lock('documents:sync', blocking=False) as acquired:
+        if not acquired:
+            return
+        last_sync = float(shared_state.get('documents:last_sync') or 0)
+        if not last_sync:
+            # Changes before the last stored update were applied by an earlier sync (possibly another process)
+            last_sync = db.session.query(db.func.max(Document.updated_at)).scalar() or 0.0
+        # Re-read a small window so jobs updated in the same instant are not missed
+        jobs = processing_queue.changed_since(last_sync - 1)
+        if jobs:
+            # Jobs are keyed by content hash, and every document with that content follows the job
+            keys = [job['document_id'] for job in jobs]
+            attached, filenames = {}, set()
+            for document in Document.query.filter(db.or_(Document.content_hash.in_(keys), Document.filename.in_(keys))):
+                attached.setdefault(document.job_key, []).append(document)
+                filenames.add(document.filename)
+            for job in jobs:
+                documents = attached.get(job['document_id'])
+                if documents is None and 'content_hash' not in job['payload'] and job['document_id'] not in filenames:
+                    # Job queued by filename before the document store existed
+                    document = Document(filename=job['payload']['filename'], path=job['payload']['path'])
+                    db.session.add(document)
+                    documents = attached[job['document_id']] = [document]
+                for document in documents or []:
+                    apply_job(document, job)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # A concurrent upload recorded the same new document first; the next sync covers these jobs
+                db.session.rollback()
+                return
+        shared_state.set('documents:last_sync', now)
+
+def release_content(job_key):
+    """Stop processing and drop the stored file and index entries of content no document refers to any more"""
+    referenced = db.or_(
+        Document.content_hash == job_key,
+        db.and_(Document.filename == job_key, Document.content_hash.is_(None)),
+    )
+    # Uploads of the same content (in any web worker) wait, so they never attach to a job being removed
+    with shared_state.lock(f'content:{job_key}'):
+        if Document.query.filter(referenced).first() is not None:
+            return
+        job = processing_queue.find(job_key)
+        if job is not None:
+            # Stop paying for chunks of a document that is going away
+            cancel_document(job_key)
+            processing_queue.remove(job_key)
+            if os.path.exists(job['payload']['path']):
+                os.remove(job['payload']['path'])
     try:
-        text = get_pdf_metadata(document['path'])
-        result = process_pdf(text)
-        
-        if not result:
-            raise ValueError("Generated result is empty")
-        
-        document['result'] = result
-        document['status'] = 'Completed'
-        logger.info(f"Successfully processed document: {filename}")
-
-        # Initialize RAG system with processed documents
-        initialize_rag_system({filename: {'content': text}})
+        remove_from_rag_system(job_key)
     except Exception as e:
-        logger.error(f"Error processing document {filename}: {str(e)}")
-        document['status'] = 'Failed'
-        document['error'] = str(e)
-    finally:
-        document['processing'] = False
-
-def document_processing_worker():
-    while True:
-        try:
-            filename = processing_queue.get(timeout=1)
-            process_document(filename)
-        except queue.Empty:
-            time.sleep(1)
-        except Exception as e:
-            logger.error(f"Error in document processing worker: {str(e)}")
-
-threading.Thread(target=document_processing_worker, daemon=True).start()
+        logger.error(f"Error removing {job_key} from the RAG index: {str(e)}")
+
+def document_names(job_keys, user_id=None):
+    """Job key (content hash) -> filenames of the documents with that content"""
+    if not job_keys:
+        return {}
+    query = visible_documents(user_id) if user_id is not None else Document.query
+    names = {}
+    keys = list(job_keys)
+    for document in query.filter(db.or_(Document.content_hash.in_(keys), Document.filename.in_(keys))):
+        names.setdefault(document.job_key, []).append(document.filename)
+    return names
+
+def chat_documents(user_id):
+    """Job keys of the documents a user can ask about, and a scope naming that set for the answer cache"""
+    rows = visible_documents(user_id).with_entities(Document.content_hash, Document.filename)
+    keys = sorted({content_hash or filename for content_hash, filename in rows})
+    return keys, hashlib.sha256('\n'.join(keys).encode('utf-8')).hexdigest()
+
+def find_document(filename):
+    # The user's own document shadows an unowned one with the same name
+    return (
+        visible_documents(current_user.id)
+        .filter(Document.filename == filename)
+        .order_by(Document.owner_id.is_(None))
+        .first()
+    )
+
+def page_args():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', DOCUMENTS_PER_PAGE, type=int), 1), 500)
+    return page, per_page
+
+if PROCESSING_WORKER_MODE == 'thread':
+    start_worker_threads(processing_queue, PROCESSING_WORKERS)
+
+# Read from the shared queue at scrape time, so this also covers external worker processes
+register_gauge(
+    'document_jobs', 'Documents in the processing queue by status',
+    lambda: {(status,): count for status, count in processing_queue.depth().items()}, ('status',)
+)
+
+@app.route('/metrics')
+def metrics():
+    return Response(expose_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/retry/<filename>', methods=['POST'])
+@login_required
+def retry_document(filename):
+    sync_documents()
+    document = find_document(filename)
+    if document is None:
+        return jsonify(error="Document not found"), 404
+    if document.status != 'Failed':
+        return jsonify(error="Only failed documents can be retried"), 400
+    if document.retry_count >= MAX_RETRIES:
+        return jsonify(error=f"Document has already been retried {MAX_RETRIES} times"), 400
+    if not processing_queue.retry(document.job_key, MAX_RETRIES):
+        return jsonify(error="Document not found in the processing queue"), 404
+    document.status = 'Queued'
+    document.retry_count += 1
+    document.error = None
+    db.session.commit()
+    return jsonify(message=f"Retrying processing for {filename}"), 200
 
 @app.route('/get_checklists', methods=['GET'])
 @login_required
 def get_checklists():
-    results = {}
-    processing = {}
-    errors = {}
-
-    for filename, doc in documents.items():
-        if 'result' in doc:
-            results[filename] = doc['result']
-        elif doc['processing']:
-            processing[filename] = doc['status']
-        elif 'error' in doc:
-            errors[filename] = doc['error']
-
-    return jsonify({
-        'results': results,
+    # ?status_only=1 omits result bodies for cheap polling; ?page= and ?per_page= page through finished documents
+    status_only = request.args.get('status_only', type=int) == 1
+    page, per_page = page_args()
+    sync_documents()
+    documents = visible_documents(current_user.id)
+
+    active = documents.filter(Document.status.in_(ACTIVE_STATUSES)).all()
+    processing = {document.filename: document.status for document in active}
+    # Estimated completion times (epoch seconds) stay stable between worker heartbeats, keeping the ETag valid
+    eta = {document.filename: document.eta_at for document in active if document.eta_at is not None}
+    errors = {document.filename: document.error for document in documents.filter(Document.status == 'Failed')}
+    finished = documents.filter(Document.item_count.isnot(None))
+    completed = finished.count()
+    pagination = finished.order_by(Document.updated_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
+
+    body = {
         'processing': processing,
+        'eta': eta,
         'errors': errors,
-        'total_documents': len(documents),
-        'completed': len(results)
-    })
+        'total_documents': documents.count(),
+        'completed': completed,
+        'page': page,
+        'pages': pagination.pages,
+    }
+    if status_only:
+        body['completed_documents'] = [document.filename for document in pagination.items]
+    else:
+        # Result bodies are deferred columns, loaded here for this page only
+        body['results'] = {document.filename: document.result for document in pagination.items}
+
+    # Clients revalidate with If-None-Match and get a bodiless 304 when nothing changed
+    response = jsonify(body)
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/events')
+@login_required
+def events():
+    """Server-Sent Events stream of document and per-chunk progress"""
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('since', type=int)
+    if last_id is None:
+        last_id = processing_queue.last_event_id()
+
+    user_id = current_user.id
+
+    def stream(last_id):
+        yield 'retry: 2000\n\n'
+        deadline = time.time() + EVENT_STREAM_SECONDS
+        idle_since = time.time()
+        while time.time() < deadline:
+            pending = processing_queue.events_since(last_id)
+            # Events are recorded per content hash; send one per document of this user with that content
+            names = document_names({event['data']['document'] for event in pending}, user_id)
+            for event in pending:
+                last_id = event['id']
+                for filename in names.get(event['data']['document'], []):
+                    data = dict(event['data'], document=filename)
+                    yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(data)}\n\n"
+            if pending:
+                idle_since = time.time()
+                continue
+            if time.time() - idle_since > 15:
+                yield ': keep-alive\n\n'
+                idle_since = time.time()
+            time.sleep(EVENT_POLL_INTERVAL)
+
+    return Response(
+        stream_with_context(stream(last_id)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
 
 @app.route('/list_documents')
 @login_required
 def list_documents():
-    return render_template('documents.html', documents=documents)
+    page, per_page = page_args()
+    sync_documents()
+    pagination = (
+        visible_documents(current_user.id)
+        .order_by(Document.created_at.desc())
+        .paginate(page=page, per_page=per_page, error_out=False)
+    )
+    return render_template('documents.html', pagination=pagination)
 
 @app.route('/view_document/<filename>')
 @login_required
 def view_document(filename):
-    if filename not in documents:
+    sync_documents()
+    document = find_document(filename)
+    if document is None:
         flash('Document not found')
         return redirect(url_for('list_documents'))
-    return render_template('document_details.html', document=documents[filename])
+    return render_template('document_details.html', document=document)
 
 @app.route('/delete_document/<filename>', methods=['POST'])
 @login_required
 def delete_document(filename):
-    if filename in documents:
-        file_path = documents[filename]['path']
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        del documents[filename]
+    document = find_document(filename)
+    if document is not None:
+        with shared_state.lock(f'document:{document.owner_id}:{filename}'):
+            job_key = document.job_key
+            db.session.delete(document)
+            db.session.commit()
+            # Processing, the stored file and index entries are kept while other documents share the content
+            release_content(job_key)
+            revision_store.remove(revision_key(document.owner_id, filename))
         flash(f'Document {filename} deleted successfully')
     else:
         flash('Document not found')
@@ -213,67 +467,108 @@ def delete_document(filename):
 @app.route('/api_usage')
 @login_required
 def api_usage():
-    api_usage = {}
-    with open(API_USAGE_LOG_PATH, 'r') as f:
-        for line in f:
-            timestamp, api_name = line.strip().split(',')
-            api_usage[api_name] = api_usage.get(api_name, 0) + 1
-    return jsonify(api_usage)
+    # ?window=hour|day limits counts to a recent window; ?model= and ?document= filter it
+    window = request.args.get('window')
+    if window:
+        # Usage is recorded per processing job, i.e. per content hash
+        document_id = request.args.get('document')
+        if document_id:
+            document = find_document(document_id)
+            if document is None:
+                return jsonify(error=f"Unknown document: {document_id}"), 404
+            document_id = document.job_key
+        try:
+            usage = usage_metrics.window(
+                window,
+                group_by=request.args.get('group_by', 'endpoint'),
+                model=request.args.get('model'),
+                document_id=document_id,
+            )
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+    else:
+        usage = usage_metrics.totals()
+    return jsonify({name: values['calls'] for name, values in usage.items()})
+
+def export_response(body, mimetype, download_name):
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    return response
+
+def excel_response(documents, download_name):
+    path = write_workbook(documents)
+    response = export_response(stream_file(path), EXCEL_MIMETYPE, download_name)
+    response.call_on_close(lambda: os.path.exists(path) and os.remove(path))
+    return response
 
 @app.route('/export_checklist/<filename>/<format>')
 @login_required
 def export_checklist(filename, format):
-    if filename not in documents or 'result' not in documents[filename]:
+    sync_documents()
+    document = find_document(filename)
+    if document is None or not document.has_result:
         flash('Result not found')
         return redirect(url_for('view_document', filename=filename))
 
-    result = documents[filename]['result']
+    result = document.result
 
     if format == 'csv':
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(['Item', 'Value'])
-        for key, value in result.items():
-            writer.writerow([key, value])
-        output.seek(0)
-        return send_file(io.BytesIO(output.getvalue().encode()), mimetype='text/csv', as_attachment=True, download_name=f'{filename}_result.csv')
+        return export_response(stream_csv(checklist_rows(result)), 'text/csv', f'{filename}_result.csv')
     elif format == 'excel':
-        wb = Workbook()
-        ws = wb.active
-        ws.append(['Item', 'Value'])
-        for key, value in result.items():
-            ws.append([key, value])
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
-        return send_file(output, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', as_attachment=True, download_name=f'{filename}_result.xlsx')
+        return excel_response([(filename, result)], f'{filename}_result.xlsx')
     else:
         flash('Invalid export format')
         return redirect(url_for('view_document', filename=filename))
 
+def export_results(document_ids):
+    """(filename, result) of each document, loading one result at a time"""
+    for document_id in document_ids:
+        row = db.session.query(Document.filename, Document.result).filter(Document.id == document_id).first()
+        if row is not None and row.result is not None:
+            yield row.filename, row.result
+
+@app.route('/export_checklists', methods=['POST'])
+@login_required
+def export_checklists():
+    """Checklists of the selected documents (all finished ones if none are selected) as a zip of CSVs or one workbook"""
+    format = request.form.get('format', 'zip')
+    if format not in ('zip', 'excel'):
+        return jsonify(error="Invalid export format"), 400
+    sync_documents()
+    query = visible_documents(current_user.id).filter(Document.item_count.isnot(None))
+    filenames = request.form.getlist('filenames')
+    if filenames:
+        query = query.filter(Document.filename.in_(filenames))
+    document_ids = [row.id for row in query.order_by(Document.filename).with_entities(Document.id)]
+    if not document_ids:
+        return jsonify(error="No processed documents selected"), 400
+    if len(document_ids) > BULK_EXPORT_MAX_DOCUMENTS:
+        return jsonify(error=f"At most {BULK_EXPORT_MAX_DOCUMENTS} documents can be exported at once"), 400
+
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    if format == 'excel':
+        return excel_response(export_results(document_ids), f'checklists-{stamp}.xlsx')
+    body = stream_with_context(stream_zip(export_results(document_ids)))
+    return export_response(body, 'application/zip', f'checklists-{stamp}.zip')
+
 def generate_api_usage_report():
-    api_usage = {}
-    first_call_timestamp = float('inf')
-    last_call_timestamp = 0
-    
-    with open(API_USAGE_LOG_PATH, 'r') as f:
-        for line in f:
-            timestamp, api_name = line.strip().split(',')
-            timestamp = float(timestamp)
-            api_usage[api_name] = api_usage.get(api_name, 0) + 1
-            
-            if timestamp < first_call_timestamp:
-                first_call_timestamp = timestamp
-            if timestamp > last_call_timestamp:
-                last_call_timestamp = timestamp
-    
-    total_calls = sum(api_usage.values())
-    
+    totals = usage_metrics.totals()
+    first_call_timestamp, last_call_timestamp = usage_metrics.call_range()
+
     report = {
-        'total_api_calls': total_calls,
-        'api_usage_breakdown': api_usage,
-        'first_call_timestamp': first_call_timestamp if first_call_timestamp != float('inf') else None,
-        'last_call_timestamp': last_call_timestamp if last_call_timestamp != 0 else None,
+        'total_api_calls': sum(values['calls'] for values in totals.values()),
+        'api_usage_breakdown': {name: values['calls'] for name, values in totals.items()},
+        'first_call_timestamp': first_call_timestamp,
+        'last_call_timestamp': last_call_timestamp,
+        'totals_by_model': usage_metrics.totals(group_by='model'),
+        'last_hour': usage_metrics.window('hour', group_by='model'),
+        'last_day': usage_metrics.window('day', group_by='model'),
+        'cache': cache_stats(),
+        'answer_cache': answer_cache.stats(),
+        'embedding': embedding_stats(),
+        # Chunk slots of the workers in this process (PROCESSING_WORKER_MODE='thread')
+        'scheduler': chunk_scheduler.stats(),
+        'api_slots': api_slots.stats(),
     }
     
     return report
@@ -284,48 +579,119 @@ def api_usage_report():
     report = generate_api_usage_report()
     return jsonify(report)
 
+def ndjson(message):
+    return json.dumps(message) + '\n'
+
+def chat_reply(answer, stream, cached=False):
+    if not stream:
+        return jsonify(response=answer)
+    return Response(ndjson({'delta': answer}) + ndjson({'done': True, 'cached': cached}), mimetype='application/x-ndjson')
+
+def stream_chat(response, question, embedding, corpus_version, scope, started, slot=None):
+    """Newline-delimited JSON: {"delta": text} as tokens arrive, then {"done": true} or {"error": message}"""
+    parts, usage, finish_reason = [], None, None
+    try:
+        for chunk in response:
+            if chunk.usage:
+                usage = chunk.usage
+            for choice in chunk.choices:
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                    yield ndjson({'delta': choice.delta.content})
+                finish_reason = choice.finish_reason or finish_reason
+    except Exception as e:
+        logger.error(f"Chatbot stream interrupted: {str(e)}")
+        yield ndjson({'error': "The answer was interrupted. Please try again."})
+        return
+    finally:
+        response.close()
+        api_slots.release(slot)
+        latency = time.perf_counter() - started
+        stage_seconds.observe(latency, 'chatbot_completion')
+        record_api_call(
+            'chatbot', CHATBOT_MODEL,
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0,
+            latency=latency,
+        )
+    # Truncated answers (length, content filter) are not worth repeating
+    if finish_reason == 'stop':
+        answer_cache.store(question, embedding, ''.join(parts), corpus_version, scope)
+    yield ndjson({'done': True, 'cached': False})
+
 @app.route('/chatbot', methods=['POST'])
 @login_required
 def chatbot():
     data = request.json
     user_message = data.get('message')
-    
+    stream = bool(data.get('stream'))
+
     if not user_message:
         return jsonify(error="No message provided"), 400
 
     try:
-        # Use RAG system to retrieve relevant chunks
-        relevant_chunks = get_relevant_chunks(user_message)
-        
-        if not relevant_chunks:
-            return jsonify(response="I'm sorry, I couldn't find any relevant information in the processed documents. Can you please rephrase your question or ask about a different topic?")
-
-        # Construct prompt with relevant chunks
-        prompt = f"""Based on the following information from processed documents:
-
-{' '.join(relevant_chunks)}
-
-User question: {user_message}
-
-Please provide a concise and informative answer:"""
-        
+        rag = get_rag_system()
+        embedding = rag.encode([user_message], QUERY)[0]
+        corpus_version = rag.corpus_version()
+        # Answers only draw on, and are only shared between users who see, the same documents
+        doc_ids, scope = chat_documents(current_user.id)
+        cached = answer_cache.lookup(embedding, corpus_version, scope)
+        if cached is not None:
+            return chat_reply(cached, stream, cached=True)
+
+        passages = select_passages(
+            rag.search_passages(user_message, CHATBOT_TOP_K, query_embedding=embedding, doc_ids=doc_ids)
+        )
+        if not passages:
+            return chat_reply(NO_CONTEXT_ANSWER, stream)
+        # Passages are indexed by content hash; label them with the user's name for the document
+        names = document_names({doc_id for doc_id, _ in passages}, current_user.id)
+        passages = [(names.get(doc_id, [doc_id])[0], passage) for doc_id, passage in passages]
+        messages = build_messages(user_message, passages)
+
+        client = get_openai_client()
+        import openai  # Already loaded by get_openai_client; needed for the error types below
+        started = time.perf_counter()
         try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant for a compliance checklist generator application. Provide concise and accurate information based on the processed documents."},
-                    {"role": "user", "content": prompt}
-                ]
+            if stream:
+                # The slot is held until the stream ends, and released by stream_chat
+                slot = api_slots.acquire()
+                try:
+                    # Errors raised here (before the first token) still get a JSON error response
+                    response = client.chat.completions.create(
+                        model=CHATBOT_MODEL, messages=messages, stream=True, stream_options={"include_usage": True}
+                    )
+                except BaseException:
+                    api_slots.release(slot)
+                    raise
+                return Response(
+                    stream_with_context(stream_chat(response, user_message, embedding, corpus_version, scope, started, slot)),
+                    mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+                )
+            with api_slots.hold(), span('chatbot_completion'):
+                response = client.chat.completions.create(model=CHATBOT_MODEL, messages=messages)
+            record_api_call(
+                'chatbot', CHATBOT_MODEL,
+                prompt_tokens=response.usage.prompt_tokens if response.usage else 0,
+                completion_tokens=response.usage.completion_tokens if response.usage else 0,
+                latency=time.perf_counter() - started,
             )
-            
+
             chatbot_response = response.choices[0].message.content
+            if response.choices[0].finish_reason == 'stop':
+                answer_cache.store(user_message, embedding, chatbot_response, corpus_version, scope)
             return jsonify(response=chatbot_response)
-        except openai.error.APIError as api_error:
+        except openai.APIStatusError as api_error:
+            record_api_call('chatbot', CHATBOT_MODEL, latency=time.perf_counter() - started, status=api_error.status_code)
+            if isinstance(api_error, openai.RateLimitError):
+                logger.error("OpenAI API rate limit exceeded")
+                return jsonify(error="The service is currently busy. Please try again in a few moments."), 429
+            logger.error(f"OpenAI API error: {str(api_error)}")
+            return jsonify(error="An error occurred while processing your request. Please try again later."), 500
+        except openai.APIError as api_error:
             logger.error(f"OpenAI API error: {str(api_error)}")
             return jsonify(error="An error occurred while processing your request. Please try again later."), 500
-        except openai.error.RateLimitError:
-            logger.error("OpenAI API rate limit exceeded")
-            return jsonify(error="The service is currently busy. Please try again in a few moments."), 429
         except Exception as e:
             logger.error(f"Unexpected error in OpenAI API call: {str(e)}")
             return jsonify(error="An unexpected error occurred. Please try again later."), 500
@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, CancelledError, FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional
+import aiohttp
+from config import CHUNK_CONCURRENCY, CHUNK_REQUEST_TIMEOUT
+from logger import main_logger as logger
+from rate_limiter import rate_limiter, estimate_tokens
+from llm_cache import get_cached_response, set_cached_response
+from usage_metrics import record_api_call
+from instrumentation import stage_seconds
+from scheduler import chunk_scheduler
+from shared_state import api_slots
+from pdf_processor import (
+    CHAT_MODEL, CHUNK_MAX_TOKENS, OPENAI_CHAT_COMPLETION_ENDPOINT, openai_headers, build_chunk_request, chunk_cache_key, finalize_chunk_output,
+)
+
+
+class AsyncChunkEngine:
+    """Runs chunk requests on a background event loop with one pooled aiohttp session"""
+
+    def __init__(self, concurrency: int = CHUNK_CONCURRENCY, timeout: float = CHUNK_REQUEST_TIMEOUT):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.jobs: Dict[str, List[Future]] = {}
+        self.lock = threading.Lock()
+        # Acquiring a shared API slot can block for long; its own threads keep releases (default executor) moving
+        self.slot_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='api-slot')
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.loop is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, name='async-chunk-engine', daemon=True).start()
+            asyncio.run_coroutine_threadsafe(self._open_session(), self.loop).result()
+
+    async def _open_session(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=openai_headers(),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+
+    async def _acquire_api_slot(self) -> Optional[str]:
+        acquiring = self.slot_executor.submit(api_slots.acquire)
+        try:
+            return await asyncio.wrap_future(acquiring)
+        except asyncio.CancelledError:
+            # The thread may still take the slot after the chunk is cancelled; give it back when it does
+            acquiring.add_done_callback(
+                lambda done: done.cancelled() or done.exception() is not None or api_slots.release(done.result())
+            )
+            raise
+
+    async def _release_api_slot(self, slot: Optional[str]):
+        # Shielded, so a cancellation arriving now cannot drop the release
+        await asyncio.shield(self.loop.run_in_executor(None, api_slots.release, slot))
+
+    async def process_chunk(self, chunk: str, index: int, retries: int = 5, use_cache: bool = True,
+                            document_id: Optional[str] = None) -> str:
+        logger.info(f"Processing chunk number: {index}")
+        cache_key = chunk_cache_key(chunk)
+        if use_cache:
+            cached = get_cached_response(cache_key)
+            if cached is not None:
+                record_api_call('chat_completion', CHAT_MODEL, cache_hit=True, document_id=document_id)
+                logger.info(f"Completed chunk number: {index} from cache")
+                return cached
+
+        data = build_chunk_request(chunk)
+        estimated_tokens = estimate_tokens(chunk, data["max_tokens"])
+
+        # The scheduler's shared slots bound concurrency and order chunks fairly across documents
+        async with chunk_scheduler.slot_async(document_id, estimated_tokens):
+            for attempt in range(retries):
+                # The limiter blocks, so wait for it off the event loop
+                await asyncio.to_thread(rate_limiter.acquire, estimated_tokens)
+                # Caps requests in flight across every worker process
+                slot = await self._acquire_api_slot()
+                started = time.perf_counter()
+                try:
+                    async with self.session.post(OPENAI_CHAT_COMPLETION_ENDPOINT, json=data) as response:
+                        latency = time.perf_counter() - started
+                        stage_seconds.observe(latency, 'llm_call')
+                        rate_limiter.update_from_headers(response.headers)
+                        if response.status != 200:
+                            record_api_call('chat_completion', CHAT_MODEL, latency=latency, status=response.status,
+                                            document_id=document_id)
+                        if response.status == 429 or response.status >= 500:
+                            logger.info(f"Chunk number: {index} got HTTP {response.status}, backing off")
+                            rate_limiter.backoff(attempt, response.headers.get('Retry-After'))
+                            continue
+                        response.raise_for_status()
+                        body = await response.json()
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    logger.warning(f"Network error processing chunk number: {index}, exception {e!r}")
+                    record_api_call('chat_completion', CHAT_MODEL, latency=time.perf_counter() - started, status=0,
+                                    document_id=document_id)
+                    rate_limiter.backoff(attempt)
+                    continue
+                finally:
+                    await self._release_api_slot(slot)
+
+                usage = body.get('usage') or {}
+                record_api_call(
+                    'chat_completion', CHAT_MODEL,
+                    prompt_tokens=usage.get('prompt_tokens', 0),
+                    completion_tokens=usage.get('completion_tokens', 0),
+                    latency=latency, document_id=document_id,
+                )
+                if 'total_tokens' in usage:
+                    rate_limiter.record_usage(estimated_tokens, usage['total_tokens'])
+                # Validation is local; the rare repair call blocks, so it runs off the event loop
+                content = await asyncio.to_thread(
+                    finalize_chunk_output, body['choices'][0]['message'].get('content'), index, document_id
+                )
+                set_cached_response(cache_key, content)
+                logger.info(f"Completed chunk number: {index}")
+                return content
+        raise Exception(f"Failed after {retries} retries.")
+
+    def run(self, chunks: Iterable[str], document_id: Optional[str] = None,
+            on_chunk: Optional[Callable[[int, str], None]] = None) -> List[str]:
+        """Process chunks on the engine loop, blocking the calling thread until done.
+
+        Chunks are submitted as the iterable yields them, so a lazy chunker keeps the
+        engine busy while later pages are still being extracted.
+        """
+        self._ensure_started()
+        futures: List[Future] = []
+        if document_id is not None:
+            with self.lock:
+                self.jobs[document_id] = futures
+        try:
+            for index, chunk in enumerate(chunks):
+                tokens = estimate_tokens(chunk, CHUNK_MAX_TOKENS)
+                chunk_scheduler.chunk_queued(document_id, tokens)
+                future = asyncio.run_coroutine_threadsafe(
+                    self.process_chunk(chunk, index, document_id=document_id), self.loop
+                )
+                future.add_done_callback(lambda done, tokens=tokens: chunk_scheduler.chunk_finished(document_id, tokens))
+                if on_chunk:
+                    future.add_done_callback(
+                        lambda done, index=index: done.cancelled() or done.exception() or on_chunk(index, done.result())
+                    )
+                futures.append(future)
+                # Stop at the first failed or cancelled chunk instead of paying for the rest
+                if any(future.done() and (future.cancelled() or future.exception()) for future in futures):
+                    break
+            wait(futures, return_when=FIRST_EXCEPTION)
+            return [future.result() for future in futures]
+        except CancelledError:
+            # Surface as a regular failure so the document worker records it
+            raise RuntimeError(f"Processing cancelled for document: {document_id}")
+        finally:
+            for future in futures:
+                future.cancel()
+            if document_id is not None:
+                with self.lock:
+                    if self.jobs.get(document_id) is futures:
+                        del self.jobs[document_id]
+
+    def cancel(self, document_id: str) -> bool:
+        """Cancel all outstanding chunk requests for a document"""
+        with self.lock:
+            futures = self.jobs.get(document_id)
+        if futures is None:
+            return False
+        logger.info(f"Cancelling outstanding chunks for document: {document_id}")
+        for future in list(futures):
+            future.cancel()
+        return True
+
+
+engine = AsyncChunkEngine()
+
+
+def process_document_async(chunks: Iterable[str], document_id: Optional[str] = None,
+                           on_chunk: Optional[Callable[[int, str], None]] = None) -> List[str]:
+    return engine.run(chunks, document_id, on_chunk)
+
+
+def cancel_document(document_id: str) -> bool:
+    return engine.cancel(document_id)
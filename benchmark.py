@@ -0,0 +1,426 @@
+"""Offline throughput benchmark against a local mock of the chat completions API.
+
+Starts a stand-in for the OpenAI chat completions endpoint (configurable latency, injected
+429s, token accounting), generates synthetic PDFs and runs each scenario in a fresh
+interpreter with its own working directory, so no API spend or shared state is involved:
+
+    extract      get_pdf_metadata on each document
+    process_pdf  page streaming, chunking and chunk LLM calls, as the workers run it
+    search       RAGSystem.similarity_search over the indexed documents (needs the embedding model)
+    upload       /upload followed by /get_checklists polling through the Flask test client
+
+    python benchmark.py [--scenarios extract,process_pdf] [--pages 10,100,1000] [--documents 3]
+                        [--latency 0.2] [--throttle-every 20] [--output benchmark_results.jsonl]
+
+Each result is appended to the output file with the current commit and compared with the
+latest result for the same scenario and size from a different commit.
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+SCENARIOS = ('extract', 'process_pdf', 'search', 'upload')
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CHECKLIST_HEADINGS = (
+    'Governance & Risk Management',
+    'Data Security & Protection',
+    'Monitoring & Detection',
+    'Incident Response & Recovery',
+    'Resilience & Evolution',
+)
+CHECKLIST_ITEMS = (
+    'Define cybersecurity roles and responsibilities for senior management.',
+    'Maintain a board-approved cyber resilience policy.',
+    'Review the cyber risk management framework annually.',
+    'Enforce multi-factor authentication for privileged access.',
+    'Encrypt sensitive data at rest and in transit.',
+    'Segment networks that hold sensitive information.',
+    'Log and monitor all access to critical systems.',
+    'Run quarterly vulnerability assessments.',
+    'Report incidents to the regulator within six hours.',
+    'Test backup restoration at least twice a year.',
+    'Maintain an incident response plan with named contacts.',
+    'Conduct an annual third-party security audit.',
+)
+WORDS = (
+    'the entity shall ensure that all systems data access controls are reviewed periodically by '
+    'management and audit functions with appropriate records retained for regulatory inspection '
+    'including encryption monitoring incident reporting backup recovery vendor risk assessment'
+).split()
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """Serves /v1/chat/completions with checklist-shaped answers and OpenAI-style usage"""
+
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.2, jitter: float = 0.05, throttle_every: int = 0,
+                 completion_tokens: int = 300, port: int = 0):
+        super().__init__(('127.0.0.1', port), MockOpenAIHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_every = throttle_every  # every Nth request gets a 429, 0 disables
+        self.completion_tokens = completion_tokens
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'throttled': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.stats)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='mock-openai', daemon=True).start()
+        return self
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: Dict, headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server: MockOpenAIServer = self.server
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.endswith('/chat/completions'):
+            self._send(404, {'error': {'message': f'Unknown path {self.path}'}})
+            return
+
+        with server.lock:
+            server.stats['requests'] += 1
+            throttled = server.throttle_every and server.stats['requests'] % server.throttle_every == 0
+            if throttled:
+                server.stats['throttled'] += 1
+        if throttled:
+            self._send(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}}, {'Retry-After': '1'})
+            return
+
+        time.sleep(max(0.0, random.gauss(server.latency, server.jitter)))
+        prompt = ''.join(str(message.get('content', '')) for message in request.get('messages', []))
+        structured = (request.get('response_format') or {}).get('type') == 'json_schema'
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = min(server.completion_tokens, request.get('max_tokens') or server.completion_tokens)
+        with server.lock:
+            server.stats['prompt_tokens'] += prompt_tokens
+            server.stats['completion_tokens'] += completion_tokens
+
+        self._send(200, {
+            'id': 'chatcmpl-mock',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'mock'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': mock_checklist(prompt, structured)},
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }, {
+            'x-ratelimit-remaining-requests': '10000',
+            'x-ratelimit-remaining-tokens': '10000000',
+            'x-ratelimit-reset-requests': '1ms',
+            'x-ratelimit-reset-tokens': '1ms',
+        })
+
+
+def mock_checklist(prompt: str, structured: bool = False) -> str:
+    """A deterministic checklist for the prompt; items repeat across chunks as real answers do"""
+    rng = random.Random(hashlib.sha256(prompt.encode('utf-8')).digest())
+    sections = [
+        {'title': heading, 'items': rng.sample(CHECKLIST_ITEMS, 3)}
+        for heading in rng.sample(CHECKLIST_HEADINGS, 3)
+    ]
+    if structured:
+        return json.dumps({'sections': sections})
+    return '\n\n'.join(
+        f"{section['title']}:\n" + '\n'.join(f'- {item}' for item in section['items']) for section in sections
+    )
+
+
+def synthetic_pdf(path: str, pages: int, seed: int = 0) -> str:
+    """Write a text PDF of `pages` pages with numbered sections and policy-like paragraphs"""
+    if os.path.exists(path):
+        return path
+    try:
+        import pymupdf
+    except ImportError:
+        raise RuntimeError("Generating synthetic PDFs requires PyMuPDF (pip install pymupdf)")
+    rng = random.Random(seed)
+    document = pymupdf.open()
+    for page_number in range(1, pages + 1):
+        page = document.new_page()
+        lines = [f'Section {page_number}.{rng.randint(1, 9)} {rng.choice(CHECKLIST_HEADINGS)}', '']
+        for _ in range(4):
+            lines.append(' '.join(rng.choice(WORDS) for _ in range(rng.randint(60, 90))).capitalize() + '.')
+            lines.append('')
+        page.insert_textbox(pymupdf.Rect(50, 50, 545, 790), '\n'.join(lines), fontsize=9)
+    document.save(path)
+    document.close()
+    return path
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # Nearest-rank
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_extract(paths: List[str]) -> Dict:
+    from pdf_processor import get_pdf_metadata
+    latencies = []
+    for path in paths:
+        started = time.perf_counter()
+        get_pdf_metadata(path)
+        latencies.append(time.perf_counter() - started)
+    return {'latencies': latencies, 'operations': len(paths), 'unit': 'documents'}
+
+
+def run_process_pdf(paths: List[str]) -> Dict:
+    from pdf_processor import process_pdf, iter_pdf_pages
+    latencies = []
+    for path in paths:
+        started = time.perf_counter()
+        process_pdf(iter_pdf_pages(path), document_id=os.path.basename(path))
+        latencies.append(time.perf_counter() - started)
+    return {'latencies': latencies, 'operations': len(paths), 'unit': 'documents'}
+
+
+def run_search(paths: List[str], queries: int = 50) -> Dict:
+    from pdf_processor import get_pdf_metadata
+    from rag_system import get_rag_system
+    rag_system = get_rag_system()
+    rag_system.create_embeddings({os.path.basename(path): {'content': get_pdf_metadata(path)} for path in paths})
+    rng = random.Random(1)
+    latencies = []
+    for _ in range(queries):
+        query = f'{rng.choice(CHECKLIST_HEADINGS)} {rng.choice(CHECKLIST_ITEMS)}'
+        started = time.perf_counter()
+        rag_system.similarity_search(query)
+        latencies.append(time.perf_counter() - started)
+    return {'latencies': latencies, 'operations': queries, 'unit': 'queries'}
+
+
+def run_upload(paths: List[str], timeout: float = 3600) -> Dict:
+    import app as web
+    client = web.app.test_client()
+    client.post('/register', data={'username': 'benchmark', 'password': 'benchmark'})
+    client.post('/login', data={'username': 'benchmark', 'password': 'benchmark'})
+
+    names = [os.path.basename(path) for path in paths]
+    uploaded = time.perf_counter()
+    files = [(open(path, 'rb'), name) for path, name in zip(paths, names)]
+    try:
+        response = client.post('/upload', data={'files': files}, content_type='multipart/form-data')
+    finally:
+        for handle, _ in files:
+            handle.close()
+    if response.status_code != 200:
+        raise RuntimeError(f"Upload failed with HTTP {response.status_code}: {response.get_data(as_text=True)}")
+
+    # Per-document latency is upload to the first poll that reports it finished
+    finished: Dict[str, float] = {}
+    while len(finished) < len(names):
+        if time.perf_counter() - uploaded > timeout:
+            raise RuntimeError(f"Timed out with {len(finished)} of {len(names)} documents finished")
+        status = client.get('/get_checklists?status_only=1').get_json()
+        for name in list(status['completed_documents']) + list(status['errors']):
+            finished.setdefault(name, time.perf_counter() - uploaded)
+        time.sleep(0.1)
+    if status['errors']:
+        raise RuntimeError(f"Documents failed: {status['errors']}")
+    return {'latencies': list(finished.values()), 'operations': len(names), 'unit': 'documents'}
+
+
+RUNNERS = {'extract': run_extract, 'process_pdf': run_process_pdf, 'search': run_search, 'upload': run_upload}
+
+
+def run_child(scenario: str, paths: List[str], output: str):
+    """Entry point of the per-scenario interpreter"""
+    started = time.perf_counter()
+    result = RUNNERS[scenario](paths)
+    result['elapsed'] = time.perf_counter() - started
+    result['peak_rss_mb'] = peak_rss_mb()
+    with open(output, 'w') as f:
+        json.dump(result, f)
+
+
+def scenario_env(workdir: str, mock_url: str) -> Dict[str, str]:
+    return dict(
+        os.environ,
+        OPENAI_API_KEY='benchmark',
+        OPENAI_BASE_URL=f'{mock_url}/v1',
+        OPENAI_CHAT_COMPLETION_ENDPOINT=f'{mock_url}/v1/chat/completions',
+        LLM_CACHE_ENABLED='false',
+        STARTUP_MODE='lazy',
+        PROCESSING_WORKER_MODE='thread',
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'documents.db')}",
+        JOB_QUEUE_DB_PATH=os.path.join(workdir, 'job_queue.db'),
+        USAGE_METRICS_DB_PATH=os.path.join(workdir, 'usage_metrics.db'),
+        ANSWER_CACHE_DB_PATH=os.path.join(workdir, 'answer_cache.db'),
+        REVISION_DB_PATH=os.path.join(workdir, 'revisions.db'),
+        VECTOR_STORE_PATH=os.path.join(workdir, 'faiss_index'),
+    )
+
+
+def run_scenario(scenario: str, paths: List[str], server: MockOpenAIServer, workdir: str) -> Dict:
+    output = os.path.join(workdir, 'result.json')
+    before = server.snapshot()
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', scenario, '--child-output', output, *paths],
+        cwd=workdir, env=scenario_env(workdir, server.url), capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Scenario {scenario} failed:\n{completed.stderr[-3000:]}")
+    with open(output) as f:
+        result = json.load(f)
+    after = server.snapshot()
+    calls = {name: after[name] - before[name] for name in after}
+
+    latencies = result['latencies']
+    return {
+        'scenario': scenario,
+        'unit': result['unit'],
+        'operations': result['operations'],
+        'elapsed_seconds': round(result['elapsed'], 3),
+        'per_minute': round(result['operations'] / result['elapsed'] * 60, 2) if result['elapsed'] else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'peak_rss_mb': result['peak_rss_mb'],
+        'api_calls_per_document': round(calls['requests'] / len(paths), 2),
+        'throttled': calls['throttled'],
+        'prompt_tokens': calls['prompt_tokens'],
+        'completion_tokens': calls['completion_tokens'],
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_result(path: str, report: Dict) -> Optional[Dict]:
+    """Latest stored result for the same scenario and size from another commit"""
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if (row.get('commit') != report['commit'] and row['scenario'] == report['scenario']
+                    and row['pages'] == report['pages'] and row['documents'] == report['documents']):
+                previous = row
+    return previous
+
+
+def format_change(current: float, previous: float) -> str:
+    if not previous:
+        return ''
+    return f' ({(current - previous) / previous * 100:+.1f}%)'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default='extract,process_pdf,upload',
+                        help=f'comma-separated, any of: {", ".join(SCENARIOS)}')
+    parser.add_argument('--pages', default='10,100,1000', help='comma-separated page counts per document')
+    parser.add_argument('--documents', type=int, default=3, help='documents per scenario run')
+    parser.add_argument('--latency', type=float, default=0.2, help='mock completion latency in seconds')
+    parser.add_argument('--throttle-every', type=int, default=0, help='answer every Nth request with a 429')
+    parser.add_argument('--workdir', help='where synthetic PDFs and scenario state are kept (default: temp dir)')
+    parser.add_argument('--output', default='benchmark_results.jsonl', help='results are appended here')
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--child-output', help=argparse.SUPPRESS)
+    parser.add_argument('paths', nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.paths, args.child_output)
+        return
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    server = MockOpenAIServer(latency=args.latency, throttle_every=args.throttle_every).start()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    commit = git_commit()
+    print(f"Mock chat completions at {server.url}, working directory {workdir}")
+
+    for pages in [int(value) for value in args.pages.split(',')]:
+        paths = [
+            synthetic_pdf(os.path.join(workdir, f'synthetic-{pages}p-{number}.pdf'), pages, seed=number)
+            for number in range(args.documents)
+        ]
+        for scenario in scenarios:
+            # A fresh directory per run so queue, metrics and vector store state never carry over
+            report = run_scenario(scenario, paths, server, tempfile.mkdtemp(prefix=f'{scenario}-', dir=workdir))
+            report.update({
+                'pages': pages,
+                'documents': args.documents,
+                'mock_latency': args.latency,
+                'throttle_every': args.throttle_every,
+                'commit': commit,
+                'timestamp': time.time(),
+            })
+            previous = previous_result(args.output, report) or {}
+            print(f"{scenario:<12} {pages:>5} pages: {report['per_minute']:>9.2f} {report['unit']}/min"
+                  f"{format_change(report['per_minute'], previous.get('per_minute'))}  "
+                  f"p50 {report['p50_ms']:.0f} ms  p99 {report['p99_ms']:.0f} ms"
+                  f"{format_change(report['p99_ms'], previous.get('p99_ms'))}  "
+                  f"peak RSS {report['peak_rss_mb']:.0f} MB  "
+                  f"{report['api_calls_per_document']:.1f} API calls/doc ({report['throttled']} throttled)")
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(report) + '\n')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""Prompt building and semantic answer caching for /chatbot.
+
+Retrieved passages are added best-first until CHATBOT_CONTEXT_TOKENS is reached. Answers
+are stored with the question embedding and the version of the indexed document set, and
+a later question whose embedding is within ANSWER_CACHE_THRESHOLD, asked by a user who
+sees the same documents, gets the stored answer for as long as no document has been
+indexed or removed.
+"""
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from chunker import count_tokens
+from config import (
+    CHATBOT_CONTEXT_TOKENS,
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_DB_PATH,
+    ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_MAX_ENTRIES,
+)
+from logger import main_logger as logger
+
+SYSTEM_PROMPT = (
+    "You are a helpful assistant for a compliance checklist generator application. "
+    "Provide concise and accurate information based on the processed documents."
+)
+NO_CONTEXT_ANSWER = (
+    "I'm sorry, I couldn't find any relevant information in the processed documents. "
+    "Can you please rephrase your question or ask about a different topic?"
+)
+
+
+def select_passages(hits: List[Tuple[str, str, float]], budget: int = CHATBOT_CONTEXT_TOKENS) -> List[Tuple[str, str]]:
+    """(doc_id, passage) of the most relevant hits that fit in the token budget, best first"""
+    selected, used = [], 0
+    for doc_id, passage, score in sorted(hits, key=lambda hit: hit[2], reverse=True):
+        tokens = count_tokens(passage)
+        if used + tokens > budget:
+            continue  # a shorter passage further down may still fit
+        selected.append((doc_id, passage))
+        used += tokens
+    return selected
+
+
+def build_messages(question: str, passages: List[Tuple[str, str]]) -> List[Dict[str, str]]:
+    context = '\n\n'.join(f'[{doc_id}]\n{passage}' for doc_id, passage in passages)
+    prompt = f"""Based on the following information from processed documents:
+
+{context}
+
+User question: {question}
+
+Please provide a concise and informative answer:"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+class _ScopeEntries:
+    """Cached answers of one scope, as loaded into memory"""
+
+    def __init__(self):
+        self.last_id = 0
+        self.embeddings = np.empty((0, 0), dtype=np.float32)
+        self.entries: List[Tuple[float, str]] = []  # (created_at, answer), one per embedding row
+
+
+class AnswerCache:
+    """Answers keyed by question embedding, valid for one version of the document set.
+
+    Each answer belongs to a scope, the set of documents it could have been built from, and
+    is only served within that scope. Entries live in SQLite so every web process shares
+    them; each process keeps the embeddings for the current version in memory and loads
+    new rows incrementally.
+    """
+
+    def __init__(self, path: str = ANSWER_CACHE_DB_PATH):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(chat_answers)')]
+        if columns and 'scope' not in columns:
+            # Answers cached before scoping may quote any user's documents
+            self.db.execute('DROP TABLE chat_answers')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS chat_answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                corpus_version TEXT NOT NULL,
+                scope TEXT NOT NULL,
+                question TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chat_answers_scope ON chat_answers (corpus_version, scope, id);
+        ''')
+        self.db.commit()
+        self.version = None
+        self.scopes: Dict[str, _ScopeEntries] = {}  # least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, corpus_version: str, scope: str) -> _ScopeEntries:
+        if corpus_version != self.version:
+            self.version, self.scopes = corpus_version, {}
+        cached = self.scopes.pop(scope, None) or _ScopeEntries()
+        self.scopes[scope] = cached
+        rows = self.db.execute(
+            'SELECT id, embedding, answer, created_at FROM chat_answers '
+            'WHERE corpus_version = ? AND scope = ? AND id > ? ORDER BY id',
+            (corpus_version, scope, cached.last_id),
+        ).fetchall()
+        if rows:
+            cached.last_id = rows[-1][0]
+            new = np.stack([np.frombuffer(blob, dtype=np.float32) for _, blob, _, _ in rows])
+            cached.embeddings = np.vstack([cached.embeddings, new]) if len(cached.entries) else new
+            cached.entries.extend((created_at, answer) for _, _, answer, created_at in rows)
+            if len(cached.entries) > ANSWER_CACHE_MAX_ENTRIES:
+                cached.embeddings = cached.embeddings[-ANSWER_CACHE_MAX_ENTRIES:]
+                cached.entries = cached.entries[-ANSWER_CACHE_MAX_ENTRIES:]
+        # Scopes not used recently are dropped to keep ANSWER_CACHE_MAX_ENTRIES in memory overall
+        while sum(len(entries.entries) for entries in self.scopes.values()) > ANSWER_CACHE_MAX_ENTRIES \
+                and len(self.scopes) > 1:
+            del self.scopes[next(iter(self.scopes))]
+        return cached
+
+    def lookup(self, embedding: np.ndarray, corpus_version: str, scope: str) -> Optional[str]:
+        """Stored answer to a near-identical question against the same documents, if any"""
+        if not ANSWER_CACHE_ENABLED:
+            return None
+        with self.lock:
+            cached = self._load(corpus_version, scope)
+            if cached.entries and cached.embeddings.shape[1] == embedding.size:
+                # Embeddings are normalized, so dot = cosine
+                scores = cached.embeddings @ embedding.reshape(-1)
+                for index in np.argsort(scores)[::-1]:
+                    if scores[index] < ANSWER_CACHE_THRESHOLD:
+                        break
+                    created_at, answer = cached.entries[index]
+                    if time.time() - created_at <= ANSWER_CACHE_TTL:
+                        self.hits += 1
+                        logger.info(f"Answer cache hit (similarity {scores[index]:.3f})")
+                        return answer
+            self.misses += 1
+        return None
+
+    def store(self, question: str, embedding: np.ndarray, answer: str, corpus_version: str, scope: str):
+        if not ANSWER_CACHE_ENABLED:
+            return
+        now = time.time()
+        blob = np.ascontiguousarray(embedding, dtype=np.float32).reshape(-1).tobytes()
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO chat_answers (corpus_version, scope, question, embedding, answer, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (corpus_version, scope, question, blob, answer, now),
+            )
+            # Answers about a different document set can never be served again
+            self.db.execute(
+                'DELETE FROM chat_answers WHERE corpus_version != ? OR created_at < ?', (corpus_version, now - ANSWER_CACHE_TTL)
+            )
+            self.db.execute(
+                'DELETE FROM chat_answers WHERE id <= (SELECT id FROM chat_answers ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                (ANSWER_CACHE_MAX_ENTRIES,),
+            )
+            self.db.commit()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM chat_answers').fetchone()[0]
+        return {'enabled': ANSWER_CACHE_ENABLED, 'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+
+answer_cache = AnswerCache()
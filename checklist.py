@@ -0,0 +1,201 @@
+"""Structure and reduce step for per-chunk checklist answers.
+
+Chunk answers are either JSON matching CHECKLIST_SCHEMA (structured output mode) or
+markdown, which is parsed into the same (section, item) records. Exact duplicates are
+dropped by normalised text and near-duplicates are merged with one batched embedding
+pass, so the document checklist is assembled locally without a second LLM call.
+"""
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Union
+import numpy as np
+from config import CHECKLIST_DEDUP_THRESHOLD
+from logger import main_logger as logger
+
+GENERAL_SECTION = 'General'
+
+# Shape requested from the model with response_format in structured output mode
+CHECKLIST_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "sections": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string"},
+                    "items": {"type": "array", "items": {"type": "string"}},
+                },
+                "required": ["title", "items"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["sections"],
+    "additionalProperties": False,
+}
+
+BULLET_PATTERN = re.compile(r'^(?:[-*•+]|\d{1,2}[.)]|[a-zA-Z][.)])\s+(?:\[[ xX]\]\s*)?(?P<text>.+)$')
+NUMBERING_PATTERN = re.compile(r'^(?:\d+(?:\.\d+)*[.)]?|[IVXivx]+[.)]|[A-Za-z][.)])\s+')
+
+
+@dataclass
+class ChecklistItem:
+    section: str
+    text: str
+    chunks: List[int] = field(default_factory=list)  # chunk indexes the item was found in
+
+
+def _clean(text: str) -> str:
+    return re.sub(r'\s+', ' ', text.replace('**', '').replace('__', '')).strip()
+
+
+def _heading(line: str) -> Optional[str]:
+    """Section title if the line is a heading (`## X`, `**X**`, `X:`), otherwise None"""
+    if line.startswith('#'):
+        title = line.lstrip('#')
+    elif line.startswith('**') and line.rstrip(':').endswith('**'):
+        title = line
+    elif line.endswith(':') and len(line) <= 100:
+        title = line
+    else:
+        return None
+    title = NUMBERING_PATTERN.sub('', _clean(title).rstrip(':').strip())
+    return title or None
+
+
+def section_key(title: str) -> str:
+    return normalize(title.replace('&', ' and '))
+
+
+def normalize(text: str) -> str:
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', text.lower()).split())
+
+
+def parse_checklist(text: str, chunk_index: int = 0) -> List[ChecklistItem]:
+    """(section, item) records from one chunk's checklist answer; prose lines are ignored"""
+    items = []
+    section = GENERAL_SECTION
+    label, label_indent = None, -1  # bullet ending in ':' that groups the bullets nested under it
+    for raw_line in text.splitlines():
+        if not raw_line.strip():
+            continue
+        indent = len(raw_line) - len(raw_line.lstrip())
+        line = raw_line.strip()
+        bullet = BULLET_PATTERN.match(line)
+        if bullet is None:
+            title = _heading(line)
+            if title:
+                section, label = title, None
+            continue
+
+        item = _clean(bullet.group('text'))
+        if label is not None and indent <= label_indent:
+            label = None
+        if item.endswith(':') and len(item) <= 100:
+            label, label_indent = item.rstrip(':'), indent
+            continue
+        if label is not None:
+            item = f'{label}: {item}'
+        if item:
+            items.append(ChecklistItem(section, item, [chunk_index]))
+    return items
+
+
+def validate_checklist(content: Union[str, Dict, None]) -> Optional[Dict]:
+    """`{'sections': [{'title', 'items'}]}` if content matches CHECKLIST_SCHEMA, otherwise None"""
+    try:
+        data = json.loads(content) if isinstance(content, str) else content
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get('sections'), list):
+        return None
+    sections = []
+    for section in data['sections']:
+        if not isinstance(section, dict) or not isinstance(section.get('title'), str):
+            return None
+        items = section.get('items')
+        if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
+            return None
+        items = [_clean(item) for item in items if _clean(item)]
+        if items:
+            sections.append({'title': _clean(section['title']).rstrip(':') or GENERAL_SECTION, 'items': items})
+    return {'sections': sections}
+
+
+def parse_sections(text: str) -> Dict:
+    """Markdown checklist answer in the structured `{'sections': [...]}` form"""
+    sections: Dict[str, List[str]] = {}
+    for item in parse_checklist(text or ''):
+        sections.setdefault(item.section, []).append(item.text)
+    return {'sections': [{'title': title, 'items': items} for title, items in sections.items()]}
+
+
+def _items(output: Union[str, Dict], chunk_index: int) -> List[ChecklistItem]:
+    if isinstance(output, dict):
+        return [
+            ChecklistItem(section['title'], item, [chunk_index])
+            for section in output.get('sections', []) for item in section['items']
+        ]
+    return parse_checklist(output or '', chunk_index)
+
+
+def _embed(texts: List[str]) -> Optional[np.ndarray]:
+    try:
+        from rag_system import get_rag_system
+        return get_rag_system().encode(texts)
+    except Exception as e:
+        # Exact de-duplication still applies without the embedding model
+        logger.warning(f"Checklist near-duplicate merging skipped: {str(e)}")
+        return None
+
+
+def deduplicate(items: List[ChecklistItem], threshold: float = CHECKLIST_DEDUP_THRESHOLD) -> List[ChecklistItem]:
+    """Merge exact and near-identical items, keeping the first occurrence and its section"""
+    unique: Dict[str, ChecklistItem] = {}
+    for item in items:
+        key = normalize(item.text)
+        if key in unique:
+            unique[key].chunks.extend(chunk for chunk in item.chunks if chunk not in unique[key].chunks)
+        else:
+            unique[key] = ChecklistItem(item.section, item.text, list(item.chunks))
+    candidates = list(unique.values())
+    if len(candidates) < 2 or threshold >= 1:
+        return candidates
+
+    embeddings = _embed([item.text for item in candidates])
+    if embeddings is None:
+        return candidates
+
+    # Greedy clustering against the items kept so far; embeddings are normalized, so dot = cosine
+    kept: List[ChecklistItem] = []
+    kept_rows = np.empty_like(embeddings)
+    for item, embedding in zip(candidates, embeddings):
+        if kept:
+            scores = kept_rows[:len(kept)] @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] >= threshold:
+                kept[best].chunks.extend(chunk for chunk in item.chunks if chunk not in kept[best].chunks)
+                continue
+        kept_rows[len(kept)] = embedding
+        kept.append(item)
+    return kept
+
+
+def merge_checklists(outputs: List[Union[str, Dict]], threshold: float = CHECKLIST_DEDUP_THRESHOLD) -> Dict[str, List[str]]:
+    """Section title -> deduplicated items, in order of first appearance"""
+    items = [item for index, output in enumerate(outputs) for item in _items(output, index)]
+    merged = deduplicate(items, threshold)
+
+    titles: Dict[str, str] = {}
+    checklist: Dict[str, List[str]] = {}
+    for item in merged:
+        title = titles.setdefault(section_key(item.section), item.section)
+        checklist.setdefault(title, []).append(item.text)
+    logger.info(f"Merged {len(items)} checklist items from {len(outputs)} chunks into {len(merged)}")
+    return checklist
+
+
+def render_checklist(checklist: Dict[str, List[str]]) -> str:
+    return '\n\n'.join(f'{title}:\n' + '\n'.join(f'- {item}' for item in items) for title, items in checklist.items())
@@ -0,0 +1,218 @@
+import os
+import re
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Tuple
+from config import CHUNK_TOKEN_BUDGET, CHUNK_OVERLAP_TOKENS, CHUNK_TOKENIZER_ENCODING, TOKENIZER_CACHE_DIR
+from logger import main_logger as logger
+
+# Lines that open a new section in regulatory text: "1.", "2.3.1", "Chapter IV", "Annex 3", "SECTION A", ...
+HEADING_PATTERN = re.compile(
+    r'^(?:'
+    r'(?:\d+\.)+\d*\s+\S'
+    r'|(?:chapter|section|part|annex(?:ure)?|appendix|schedule|article|clause)\b'
+    r'|[A-Z][A-Z0-9 ,&/()\'-]{3,80}$'
+    r')',
+    re.IGNORECASE,
+)
+SENTENCE_END = re.compile(r'(?<=[.;:!?])\s+')
+CHARS_PER_TOKEN = 4  # length-based estimate when the tokenizer is unavailable
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        # tiktoken downloads its BPE file on first use; a local cache keeps later runs (and offline hosts) off the network
+        os.environ.setdefault('TIKTOKEN_CACHE_DIR', os.path.abspath(TOKENIZER_CACHE_DIR))
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(CHUNK_TOKENIZER_ENCODING)
+        except Exception as e:
+            logger.warning(f"Tokenizer {CHUNK_TOKENIZER_ENCODING} unavailable, estimating tokens from length: {e}")
+            _encoding = False
+    return _encoding
+
+
+def _estimate_tokens(text: str) -> int:
+    # Whitespace is free, so text joined from pieces estimates exactly as the sum of its pieces
+    return sum(-(-len(word) // CHARS_PER_TOKEN) for word in text.split())
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return _estimate_tokens(text)
+
+
+@dataclass
+class Chunk:
+    text: str
+    start_page: int
+    end_page: int
+    token_count: int
+
+
+@dataclass
+class _Block:
+    text: str
+    page: int
+    tokens: int
+    is_heading: bool = False
+
+
+def _is_heading(line: str) -> bool:
+    return len(line) <= 120 and bool(HEADING_PATTERN.match(line))
+
+
+def _split_page(page_number: int, text: str) -> Iterator[_Block]:
+    """Group a page's lines into paragraph blocks, starting a new block at blank lines and headings"""
+    lines: List[str] = []
+    heading = False
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if not line or _is_heading(line):
+            if lines:
+                paragraph = '\n'.join(lines)
+                yield _Block(paragraph, page_number, count_tokens(paragraph), heading)
+                lines = []
+            heading = bool(line)
+        if line:
+            lines.append(line)
+    if lines:
+        paragraph = '\n'.join(lines)
+        yield _Block(paragraph, page_number, count_tokens(paragraph), heading)
+
+
+def _split_tokens(text: str, budget: int) -> List[str]:
+    encoding = _get_encoding()
+    if encoding:
+        ids = encoding.encode(text, disallowed_special=())
+        return [encoding.decode(ids[i:i + budget]) for i in range(0, len(ids), budget)]
+    # Whole words up to the budget; a word longer than the budget is cut into budget-sized parts
+    step = budget * CHARS_PER_TOKEN
+    pieces: List[str] = []
+    words: List[str] = []
+    tokens = 0
+    for word in text.split():
+        for start in range(0, len(word), step):
+            part = word[start:start + step]
+            part_tokens = _estimate_tokens(part)
+            if words and tokens + part_tokens > budget:
+                pieces.append(' '.join(words))
+                words, tokens = [], 0
+            words.append(part)
+            tokens += part_tokens
+    if words:
+        pieces.append(' '.join(words))
+    return pieces
+
+
+def _split_block(block: _Block, first_budget: int, budget: int) -> Iterator[_Block]:
+    """Break a block on sentence boundaries into a piece of at most `first_budget` tokens
+    followed by pieces of at most `budget` tokens, hard-splitting overlong sentences"""
+    pieces: List[str] = []
+    piece_tokens = 0
+    limit = first_budget
+    is_heading = block.is_heading
+    for sentence in SENTENCE_END.split(block.text):
+        parts = _split_tokens(sentence, budget) if count_tokens(sentence) > budget else [sentence]
+        for part in parts:
+            part_tokens = count_tokens(part)
+            if piece_tokens + part_tokens > limit and (pieces or limit < budget):
+                if pieces:
+                    yield _Block(' '.join(pieces), block.page, piece_tokens, is_heading)
+                    is_heading = False
+                pieces, piece_tokens, limit = [], 0, budget
+            pieces.append(part)
+            piece_tokens += part_tokens
+    if pieces:
+        yield _Block(' '.join(pieces), block.page, piece_tokens, is_heading)
+
+
+def _tail(blocks: List[_Block], overlap_tokens: int) -> List[_Block]:
+    """Trailing text of a finished chunk, at most `overlap_tokens` long, to repeat in the next one"""
+    carried: List[_Block] = []
+    carried_tokens = 0
+    for block in reversed(blocks):
+        if carried_tokens + block.tokens <= overlap_tokens:
+            carried.insert(0, block)
+            carried_tokens += block.tokens
+            continue
+        sentences: List[str] = []
+        for sentence in reversed(SENTENCE_END.split(block.text)):
+            tokens = count_tokens(sentence)
+            if carried_tokens + tokens > overlap_tokens:
+                break
+            sentences.insert(0, sentence)
+            carried_tokens += tokens
+        if sentences:
+            text = ' '.join(sentences)
+            carried.insert(0, _Block(text, block.page, count_tokens(text)))
+        break
+    return carried
+
+
+def _make_chunk(blocks: List[_Block]) -> Chunk:
+    return Chunk(
+        text='\n\n'.join(block.text for block in blocks),
+        start_page=blocks[0].page,
+        end_page=blocks[-1].page,
+        token_count=sum(block.tokens for block in blocks),
+    )
+
+
+def chunk_pages(pages: Iterable[Tuple[int, str]], max_tokens: int = CHUNK_TOKEN_BUDGET,
+                overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[Chunk]:
+    """Lazily pack (page_number, text) pairs into chunks of at most `max_tokens` tokens.
+
+    Chunks break on heading, paragraph and page boundaries, and each chunk repeats up to
+    `overlap_tokens` of trailing text from the previous one so clauses are not lost at the seams.
+    """
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+    current: List[_Block] = []
+    current_tokens = 0
+    fresh = False  # current holds text beyond the overlap carried from the previous chunk
+
+    def pending(block: _Block) -> Iterator[_Block]:
+        # A block that would leave a mostly empty chunk behind is split to fill it
+        room = max_tokens - current_tokens
+        if block.tokens > max_tokens or (block.tokens > room and current_tokens < max_tokens // 2):
+            yield from _split_block(block, room, max_tokens)
+        else:
+            yield block
+
+    for page_number, text in pages:
+        for block in _split_page(page_number, text or ''):
+            for piece in pending(block):
+                # Prefer to close a reasonably full chunk right before a new heading
+                heading_break = piece.is_heading and current_tokens >= max_tokens // 2
+                if fresh and (current_tokens + piece.tokens > max_tokens or heading_break):
+                    yield _make_chunk(current)
+                    current = _tail(current, overlap_tokens)
+                    current_tokens = sum(carried.tokens for carried in current)
+                    fresh = False
+                # Drop overlap that would not leave room for the new piece
+                while current and current_tokens + piece.tokens > max_tokens:
+                    current_tokens -= current.pop(0).tokens
+                current.append(piece)
+                current_tokens += piece.tokens
+                fresh = True
+
+    if fresh:
+        yield _make_chunk(current)
+
+
+def chunk_text(text: str, max_tokens: int = CHUNK_TOKEN_BUDGET,
+               overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[Chunk]:
+    """Chunk an already extracted document, treating it as a single page"""
+    return list(chunk_pages([(1, text)], max_tokens, overlap_tokens))
+
+
+if __name__ == '__main__':
+    # Run once with network access; copy TOKENIZER_CACHE_DIR to hosts without it
+    if _get_encoding():
+        print(f"Tokenizer {CHUNK_TOKENIZER_ENCODING} cached in {os.environ['TIKTOKEN_CACHE_DIR']}")
+    else:
+        raise SystemExit(f"Could not load tokenizer {CHUNK_TOKENIZER_ENCODING}")
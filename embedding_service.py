@@ -0,0 +1,325 @@
+"""Micro-batched sentence embeddings, encoded outside the web and document worker threads.
+
+Every encode call (passages during ingestion, questions from the chatbot and search) is
+queued with a priority. A dispatcher thread merges queued requests into batches of up to
+EMBEDDING_BATCH_SIZE texts, waiting at most EMBEDDING_BATCH_WAIT_MS for a batch to fill, and
+splits large requests so queries never wait behind more than one ingestion batch.
+
+With EMBEDDING_SERVICE_MODE=process the model runs in a child process (`python
+embedding_service.py`), so torch's CPU work does not hold this process's GIL; the child
+reports its address on stdout and exits when the parent disconnects.
+"""
+import argparse
+import atexit
+import heapq
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+from typing import Dict, List, Optional
+import numpy as np
+from config import (
+    EMBEDDING_MODEL_NAME,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_SERVICE_MODE,
+    EMBEDDING_BACKEND,
+    EMBEDDING_TORCH_THREADS,
+    EMBEDDING_BATCH_WAIT_MS,
+)
+from instrumentation import registry, stage_seconds, Counter, Histogram
+from logger import main_logger as logger
+
+QUERY = 0  # encoded ahead of queued ingestion work
+INGEST = 1
+
+batch_sizes = registry.register(Histogram(
+    'embedding_batch_size', 'Texts per embedding batch', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+))
+texts_encoded = registry.register(Counter(
+    'embedding_texts_total', 'Texts encoded by the embedding service', ('priority',)
+))
+
+
+def load_model(model_name: str = EMBEDDING_MODEL_NAME, backend: str = EMBEDDING_BACKEND,
+               threads: int = EMBEDDING_TORCH_THREADS):
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+    from sentence_transformers import SentenceTransformer
+    if backend == 'onnx':
+        # Needs sentence-transformers >= 3.2 with onnxruntime (pip install "sentence-transformers[onnx]")
+        return SentenceTransformer(model_name, device='cpu', backend='onnx')
+    model = SentenceTransformer(model_name, device='cpu')
+    if backend == 'quantized':
+        torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def encode_with(model, texts: List[str]) -> np.ndarray:
+    embeddings = model.encode(
+        texts,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+    )
+    return np.ascontiguousarray(embeddings, dtype=np.float32).reshape(len(texts), -1)
+
+
+class _InlineEncoder:
+    def __init__(self):
+        self.model = load_model()
+        self.dimension = self.model.get_sentence_embedding_dimension()
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        return encode_with(self.model, texts)
+
+    def close(self):
+        pass
+
+
+class _ProcessEncoder:
+    """Model in a child process, sent one batch at a time over a local authenticated connection"""
+
+    def __init__(self):
+        authkey = os.urandom(16)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--serve'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            env={**os.environ, 'EMBEDDING_SERVICE_AUTHKEY': authkey.hex()},
+            text=True,
+        )
+        # The child prints "ready <port> <dimension>" once its model is loaded
+        for line in self.process.stdout:
+            if line.startswith('ready '):
+                break
+        else:
+            self.process.wait()
+            raise RuntimeError(f"Embedding service exited during startup (code {self.process.returncode})")
+        _, port, dimension = line.split()
+        self.dimension = int(dimension)
+        self.connection = Client(('127.0.0.1', int(port)), authkey=authkey)
+        logger.info(f"Embedding service started (pid {self.process.pid}, backend {EMBEDDING_BACKEND})")
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        self.connection.send(texts)
+        status, value = self.connection.recv()
+        if status == 'error':
+            raise RuntimeError(f"Embedding service error: {value}")
+        return value
+
+    def close(self):
+        try:
+            self.connection.close()
+            self.process.wait(timeout=10)
+        except Exception:
+            self.process.kill()
+
+
+class _Request:
+    def __init__(self, texts: List[str], priority: int):
+        self.texts = texts
+        self.priority = priority
+        self.next = 0  # first text not yet handed to a batch
+        self.done = 0
+        self.vectors: Optional[np.ndarray] = None
+        self.future: Future = Future()
+
+
+class EmbeddingService:
+    def __init__(self, mode: str = EMBEDDING_SERVICE_MODE, batch_size: int = EMBEDDING_BATCH_SIZE,
+                 wait: float = EMBEDDING_BATCH_WAIT_MS / 1000):
+        self.mode = mode
+        self.batch_size = batch_size
+        self.wait = wait
+        self.encoder = self._start_encoder()
+        self.dimension = self.encoder.dimension
+        self.heap = []
+        self.sequence = itertools.count()
+        self.queued_texts = 0
+        self.condition = threading.Condition()
+        self.stats_lock = threading.Lock()
+        self.batches = 0
+        self.texts = 0
+        self.busy_seconds = 0.0
+        self.closed = False
+        self.thread = threading.Thread(target=self._dispatch, name='embedding-dispatcher', daemon=True)
+        self.thread.start()
+
+    def _start_encoder(self):
+        return _ProcessEncoder() if self.mode == 'process' else _InlineEncoder()
+
+    def encode(self, texts: List[str], priority: int = INGEST) -> np.ndarray:
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        request = _Request(list(texts), priority)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Embedding service is closed")
+            heapq.heappush(self.heap, (priority, next(self.sequence), request))
+            self.queued_texts += len(request.texts)
+            self.condition.notify()
+        return request.future.result()
+
+    def _next_batch(self):
+        """(request, start, end) slices totalling at most batch_size texts, highest priority first"""
+        with self.condition:
+            while not self.heap and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+            deadline = time.monotonic() + self.wait
+            while self.queued_texts < self.batch_size and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch, room = [], self.batch_size
+            while self.heap and room:
+                request = self.heap[0][2]
+                if request.future.done():  # failed in an earlier batch
+                    heapq.heappop(self.heap)
+                    self.queued_texts -= len(request.texts) - request.next
+                    continue
+                take = min(room, len(request.texts) - request.next)
+                batch.append((request, request.next, request.next + take))
+                request.next += take
+                room -= take
+                self.queued_texts -= take
+                if request.next == len(request.texts):
+                    heapq.heappop(self.heap)
+            return batch
+
+    def _dispatch(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if not batch:
+                continue
+            texts = [text for request, start, end in batch for text in request.texts[start:end]]
+            started = time.perf_counter()
+            try:
+                vectors = self.encoder(texts)
+            except (EOFError, OSError) as e:
+                logger.error(f"Embedding service connection lost, restarting: {str(e)}")
+                self._fail(batch, e)
+                self._restart()
+                continue
+            except Exception as e:
+                logger.error(f"Embedding batch of {len(texts)} texts failed: {str(e)}")
+                self._fail(batch, e)
+                continue
+            elapsed = time.perf_counter() - started
+            self._record(batch, len(texts), elapsed)
+
+            offset = 0
+            for request, start, end in batch:
+                if request.vectors is None:
+                    request.vectors = np.empty((len(request.texts), vectors.shape[1]), dtype=np.float32)
+                request.vectors[start:end] = vectors[offset:offset + end - start]
+                offset += end - start
+                request.done += end - start
+                if request.done == len(request.texts) and not request.future.done():
+                    request.future.set_result(request.vectors)
+
+    def _fail(self, batch, error: Exception):
+        for request, _, _ in batch:
+            if not request.future.done():
+                request.future.set_exception(error)
+
+    def _restart(self):
+        try:
+            self.encoder.close()
+        except Exception:
+            pass
+        try:
+            self.encoder = self._start_encoder()
+        except Exception as e:
+            logger.error(f"Embedding service restart failed: {str(e)}")
+
+    def _record(self, batch, size: int, elapsed: float):
+        batch_sizes.observe(size)
+        stage_seconds.observe(elapsed, 'encode')
+        for request, start, end in batch:
+            texts_encoded.inc(end - start, 'query' if request.priority == QUERY else 'ingest')
+        with self.stats_lock:
+            self.batches += 1
+            self.texts += size
+            self.busy_seconds += elapsed
+
+    def stats(self) -> Dict:
+        with self.stats_lock:
+            return {
+                'mode': self.mode,
+                'backend': EMBEDDING_BACKEND,
+                'batches': self.batches,
+                'texts': self.texts,
+                'mean_batch_size': round(self.texts / self.batches, 2) if self.batches else 0,
+                'texts_per_second': round(self.texts / self.busy_seconds, 1) if self.busy_seconds else 0,
+                'queued_texts': self.queued_texts,
+            }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            pending = [request for _, _, request in self.heap]
+            self.heap.clear()
+            self.condition.notify_all()
+        self._fail([(request, 0, 0) for request in pending], RuntimeError("Embedding service is closed"))
+        self.thread.join(timeout=5)
+        self.encoder.close()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_embedding_service() -> EmbeddingService:
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                started = time.perf_counter()
+                _service = EmbeddingService()
+                atexit.register(_service.close)
+                logger.info(f"Embedding service ready in {time.perf_counter() - started:.2f}s ({_service.mode})")
+    return _service
+
+
+def embedding_stats() -> Optional[Dict]:
+    """Batching stats, or None if nothing has been embedded in this process"""
+    return _service.stats() if _service is not None else None
+
+
+def serve():
+    """Child process: load the model, then encode batches sent by the parent until it disconnects"""
+    model = load_model()
+    listener = Listener(('127.0.0.1', 0), authkey=bytes.fromhex(os.environ['EMBEDDING_SERVICE_AUTHKEY']))
+    print('ready', listener.address[1], model.get_sentence_embedding_dimension(), flush=True)
+    sys.stdout = sys.stderr  # the parent stops reading stdout after the ready line
+    with listener.accept() as connection:
+        listener.close()
+        while True:
+            try:
+                texts = connection.recv()
+            except EOFError:
+                return
+            try:
+                connection.send(('ok', encode_with(model, texts)))
+            except Exception as e:
+                connection.send(('error', f'{type(e).__name__}: {e}'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--serve', action='store_true', help="run as the embedding process of a parent service")
+    args = parser.parse_args()
+    if args.serve:
+        serve()
+    else:
+        parser.print_help()
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import numpy as np
+from typing import Dict, List, Tuple
+
+
+class EmbeddingStore:
+    """Passage embeddings persisted on disk and keyed by content hash and embedding model.
+
+    Vectors are appended to a raw float32 file per model that is memory-mapped for reads;
+    SQLite maps content hashes to rows and records which passages belong to which document.
+    Vectors of removed passages stay in the file so an identical passage is never re-encoded.
+    """
+
+    def __init__(self, path: str, model_name: str, dimension: int):
+        os.makedirs(path, exist_ok=True)
+        self.model_name = model_name
+        self.dimension = dimension
+        slug = re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)
+        self.vector_path = os.path.join(path, f'{slug}.f32')
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(os.path.join(path, 'store.db'), check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS vectors (
+                hash TEXT PRIMARY KEY,
+                row INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS passages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                doc_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS passages_doc_id ON passages (doc_id);
+        ''')
+        self.db.commit()
+        self._map_vectors()
+
+    def _map_vectors(self):
+        size = os.path.getsize(self.vector_path) if os.path.exists(self.vector_path) else 0
+        rows = size // (self.dimension * 4)
+        if rows:
+            self.vectors = np.memmap(self.vector_path, dtype=np.float32, mode='r', shape=(rows, self.dimension))
+        else:
+            self.vectors = np.empty((0, self.dimension), dtype=np.float32)
+
+    def content_hash(self, text: str) -> str:
+        return hashlib.sha256(f'{self.model_name}\0{text}'.encode('utf-8')).hexdigest()
+
+    def lookup(self, hashes: List[str]) -> Dict[str, int]:
+        """Rows of the hashes that already have a stored vector"""
+        found: Dict[str, int] = {}
+        unique = list(set(hashes))
+        with self.lock:
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                found.update(self.db.execute(
+                    f'SELECT hash, row FROM vectors WHERE hash IN ({placeholders})', batch
+                ).fetchall())
+        return found
+
+    def add_vectors(self, hashes: List[str], embeddings: np.ndarray) -> Dict[str, int]:
+        with self.lock:
+            # The write lock on the database also serializes appends from other processes
+            self.db.execute('BEGIN IMMEDIATE')
+            with open(self.vector_path, 'ab') as file:
+                first_row = file.tell() // (self.dimension * 4)
+                file.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+            rows = {content_hash: first_row + offset for offset, content_hash in enumerate(hashes)}
+            self.db.executemany('INSERT OR REPLACE INTO vectors (hash, row) VALUES (?, ?)', rows.items())
+            self.db.commit()
+            self._map_vectors()
+        return rows
+
+    def get_vectors(self, rows: List[int]) -> np.ndarray:
+        with self.lock:
+            # Another process may have appended vectors since the file was mapped
+            if rows and max(rows) >= len(self.vectors):
+                self._map_vectors()
+            return np.asarray(self.vectors[rows], dtype=np.float32)
+
+    def add_passages(self, doc_id: str, passages: List[str]) -> List[int]:
+        with self.lock:
+            ids = []
+            for position, text in enumerate(passages):
+                cursor = self.db.execute(
+                    'INSERT INTO passages (doc_id, position, text) VALUES (?, ?, ?)', (doc_id, position, text)
+                )
+                ids.append(cursor.lastrowid)
+            self.db.commit()
+        return ids
+
+    def remove_document(self, doc_id: str) -> List[int]:
+        with self.lock:
+            ids = [row[0] for row in self.db.execute('SELECT id FROM passages WHERE doc_id = ?', (doc_id,))]
+            self.db.execute('DELETE FROM passages WHERE doc_id = ?', (doc_id,))
+            self.db.commit()
+        return ids
+
+    def data_version(self) -> int:
+        """Changes whenever another connection (e.g. a worker process) commits to the store"""
+        with self.lock:
+            return self.db.execute('PRAGMA data_version').fetchone()[0]
+
+    def corpus_version(self) -> str:
+        """Identifies the current passage set; ids are never reused, so any add or remove changes it"""
+        with self.lock:
+            count, last_id = self.db.execute('SELECT COUNT(*), COALESCE(MAX(id), 0) FROM passages').fetchone()
+        return f'{count}:{last_id}'
+
+    def passage_ids(self) -> List[int]:
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT id FROM passages')]
+
+    def document_passage_ids(self, doc_ids: List[str]) -> List[int]:
+        if not doc_ids:
+            return []
+        placeholders = ','.join('?' * len(doc_ids))
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                f'SELECT id FROM passages WHERE doc_id IN ({placeholders})', list(doc_ids)
+            )]
+
+    def all_passages(self) -> List[Tuple[int, str]]:
+        with self.lock:
+            return self.db.execute('SELECT id, text FROM passages ORDER BY id').fetchall()
+
+    def get_passages(self, ids: List[int]) -> Dict[int, Tuple[str, str]]:
+        """Passage id -> (doc_id, text)"""
+        if not ids:
+            return {}
+        placeholders = ','.join('?' * len(ids))
+        with self.lock:
+            rows = self.db.execute(
+                f'SELECT id, doc_id, text FROM passages WHERE id IN ({placeholders})', ids
+            ).fetchall()
+        return {passage_id: (doc_id, text) for passage_id, doc_id, text in rows}
+
+    def document_ids(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT DISTINCT doc_id FROM passages')]
@@ -0,0 +1,136 @@
+"""Streamed checklist exports.
+
+CSV and zip responses are generated row by row and sent as they are produced. Excel
+workbooks use openpyxl's write-only mode, which spools each sheet to disk as rows are
+appended, and the finished file is streamed from a temporary file. Bulk exports load
+one document result at a time, so memory stays flat however many documents are selected.
+"""
+import csv
+import os
+import re
+import tempfile
+import zipfile
+from typing import Dict, Iterable, Iterator, Set, Tuple
+from config import EXPORT_CHUNK_SIZE
+
+CSV_HEADER = ('Section', 'Item')
+EXCEL_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+Row = Tuple[str, str]
+
+
+def checklist_rows(result: Dict) -> Iterator[Row]:
+    """(section, item) rows of a document result"""
+    for section, items in result.get('checklist', {}).items():
+        for item in items:
+            yield section, item
+    if 'compliance_info' in result:
+        yield 'Unstructured output', result['compliance_info']
+
+
+class _Pending:
+    """Write target (text or bytes) that hands back whatever was written since the last drain"""
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0  # bytes written since the last drain
+        self.offset = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self.parts)
+        self.parts, self.size = [], 0
+        return data
+
+
+def stream_csv(rows: Iterable[Row]) -> Iterator[bytes]:
+    """CSV bytes of the rows, in chunks of about EXPORT_CHUNK_SIZE"""
+    pending = _Pending()
+    writer = csv.writer(pending)
+    writer.writerow(CSV_HEADER)
+    for row in rows:
+        writer.writerow(row)
+        if pending.size >= EXPORT_CHUNK_SIZE:
+            yield pending.drain()
+    if pending.size:
+        yield pending.drain()
+
+
+def member_name(name: str, used: Set[str]) -> str:
+    """Zip member name for a document's CSV, unique in the archive (ignoring case, as many filesystems do)"""
+    member, suffix = f'{name}_result.csv', 1
+    while member.lower() in used:
+        suffix += 1
+        member = f'{name}_result~{suffix}.csv'
+    used.add(member.lower())
+    return member
+
+
+def stream_zip(documents: Iterable[Tuple[str, Dict]]) -> Iterator[bytes]:
+    """Zip archive with one CSV per (name, result), produced as it is written"""
+    target = _Pending()
+    used: Set[str] = set()
+    with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, result in documents:
+            with archive.open(member_name(name, used), 'w') as member:
+                for data in stream_csv(checklist_rows(result)):
+                    member.write(data)
+                    if target.size:
+                        yield target.drain()
+    yield target.drain()
+
+
+def sheet_title(name: str, used: Set[str]) -> str:
+    """Excel sheet name for a document: at most 31 characters, no []:*?/\\ and unique in the workbook"""
+    base = re.sub(r'[\[\]:*?/\\]', '_', os.path.splitext(name)[0]).strip("'") or 'Sheet'
+    title, suffix = base[:31], 1
+    while title.lower() in used:
+        suffix += 1
+        title = f'{base[:31 - len(str(suffix)) - 1]}~{suffix}'
+    used.add(title.lower())
+    return title
+
+
+def write_workbook(documents: Iterable[Tuple[str, Dict]]) -> str:
+    """Path of a temporary .xlsx with one sheet per (name, result); the caller removes it"""
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    used: Set[str] = set()
+    for name, result in documents:
+        sheet = workbook.create_sheet(sheet_title(name, used))
+        sheet.append(CSV_HEADER)
+        for row in checklist_rows(result):
+            sheet.append(row)
+    if not used:
+        workbook.create_sheet('Checklist').append(CSV_HEADER)
+    handle, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(handle)
+    try:
+        workbook.save(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+def stream_file(path: str) -> Iterator[bytes]:
+    """File contents in EXPORT_CHUNK_SIZE pieces"""
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(EXPORT_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
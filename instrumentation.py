@@ -0,0 +1,229 @@
+"""In-process metrics with Prometheus text exposition.
+
+Pipeline stages are timed with `span()` (or `TimedIterator` for lazily consumed stages)
+into the `pipeline_stage_seconds` histogram. Gauges can be backed by a callback so values
+such as queue depth are read at scrape time. Metrics are per process; with external
+workers each worker process keeps its own.
+"""
+import bisect
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+from config import PROFILE_DIR
+from logger import main_logger as logger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series: Dict[LabelValues, list] = {}  # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self.lock:
+            series = self.series.setdefault(label_values, [0] * len(self.buckets) + [0.0, 0])
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def expose(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} histogram'
+        with self.lock:
+            items = [(values, list(series)) for values, series in self.series.items()]
+        for values, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _format_labels(self.labels, values, 'le="%s"' % bound)
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labels, values, 'le="+Inf"')
+            yield f'{self.name}_bucket{labels} {series[-1]}'
+            yield f'{self.name}_sum{_format_labels(self.labels, values)} {series[-2]}'
+            yield f'{self.name}_count{_format_labels(self.labels, values)} {series[-1]}'
+
+
+class Counter:
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values: Dict[LabelValues, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values: str):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def expose(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} counter'
+        with self.lock:
+            items = list(self.values.items())
+        for values, value in items:
+            yield f'{self.name}{_format_labels(self.labels, values)} {value}'
+
+
+class Gauge:
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (),
+                 callback: Optional[Callable[[], Dict[LabelValues, float]]] = None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.callback = callback
+        self.values: Dict[LabelValues, float] = {}
+        self.lock = threading.Lock()
+
+    def set(self, value: float, *label_values: str):
+        with self.lock:
+            self.values[label_values] = value
+
+    def inc(self, amount: float = 1, *label_values: str):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, amount: float = 1, *label_values: str):
+        self.inc(-amount, *label_values)
+
+    def expose(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} gauge'
+        if self.callback is not None:
+            try:
+                items = list(self.callback().items())
+            except Exception as e:
+                logger.error(f"Error collecting gauge {self.name}: {str(e)}")
+                items = []
+        else:
+            with self.lock:
+                items = list(self.values.items())
+        for values, value in items:
+            yield f'{self.name}{_format_labels(self.labels, values)} {value}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    'pipeline_stage_seconds', 'Time spent in each document pipeline and chatbot stage', ('stage',)
+))
+stage_errors = registry.register(Counter(
+    'pipeline_stage_errors_total', 'Pipeline stages that raised an exception', ('stage',)
+))
+workers_busy = registry.register(Gauge(
+    'document_workers_busy', 'Document processing workers currently running a job'
+))
+workers_total = registry.register(Gauge(
+    'document_workers', 'Document processing workers started in this process'
+))
+workers_busy.set(0)
+workers_total.set(0)
+
+
+@contextmanager
+def span(stage: str):
+    """Time a block into pipeline_stage_seconds{stage=...}"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc(1, stage)
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage)
+
+
+class TimedIterator:
+    """Wraps a lazily consumed stage and accumulates the time spent producing its items"""
+
+    def __init__(self, iterable: Iterable, stage: str, exclude: Optional['TimedIterator'] = None):
+        self.iterator = iter(iterable)
+        self.stage = stage
+        self.exclude = exclude  # an upstream stage whose time is counted separately
+        self.elapsed = 0.0
+        self.recorded = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            item = next(self.iterator)
+        except StopIteration:
+            self.elapsed += time.perf_counter() - started
+            self.record()
+            raise
+        self.elapsed += time.perf_counter() - started
+        return item
+
+    def record(self):
+        if self.recorded:
+            return
+        self.recorded = True
+        elapsed = self.elapsed - (self.exclude.elapsed if self.exclude else 0.0)
+        stage_seconds.observe(max(elapsed, 0.0), self.stage)
+
+
+def register_gauge(name: str, description: str, callback: Callable[[], Dict[LabelValues, float]],
+                   labels: Tuple[str, ...] = ()) -> Gauge:
+    return registry.register(Gauge(name, description, labels, callback))
+
+
+def expose_metrics() -> str:
+    return registry.expose()
+
+
+@contextmanager
+def profiled(name: str, enabled: bool = True):
+    """Run a block under cProfile and dump the stats to PROFILE_DIR/<name>-<timestamp>.prof"""
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f'{name}-{int(time.time())}.prof')
+        profiler.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+        logger.info(f"Profile written to {path}\n{summary.getvalue()}")
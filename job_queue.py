@@ -0,0 +1,257 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from config import (
+    JOB_QUEUE_DB_PATH,
+    JOB_LEASE_SECONDS,
+    DOCUMENT_PROCESSING_DELAY,
+    MAX_BACKOFF,
+    BACKOFF_FACTOR,
+    EVENT_RETENTION_SECONDS,
+)
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+class JobQueue:
+    """Durable document-processing queue in SQLite, safe to share between threads and processes.
+
+    Jobs are claimed highest priority first under a lease; a worker that dies without
+    finishing its job lets the lease expire and the job is handed to another worker.
+    Pass ':memory:' as the path for a private in-process queue (e.g. in tests).
+    """
+
+    def __init__(self, path: str = JOB_QUEUE_DB_PATH, lease_seconds: float = JOB_LEASE_SECONDS,
+                 retry_delay: float = DOCUMENT_PROCESSING_DELAY):
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
+        self.last_pruned = 0.0
+        self.lock = threading.RLock()
+        # Autocommit mode so transactions are explicit and claims can take the write lock up front
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                document_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                retry_count INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                available_at REAL NOT NULL,
+                lease_expires_at REAL,
+                worker_id TEXT,
+                error TEXT,
+                result TEXT,
+                eta_at REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, priority DESC, available_at);
+            CREATE INDEX IF NOT EXISTS jobs_document ON jobs (document_id);
+            CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated_at);
+            CREATE TABLE IF NOT EXISTS job_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                document_id TEXT NOT NULL,
+                type TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS job_events_created ON job_events (created_at);
+        ''')
+        columns = {row['name'] for row in self.db.execute('PRAGMA table_info(jobs)')}
+        if 'eta_at' not in columns:
+            # Estimated completion time of a running job, added after the table was first created
+            self.db.execute('ALTER TABLE jobs ADD COLUMN eta_at REAL')
+
+    def _row(self, row: Optional[sqlite3.Row]) -> Optional[Dict]:
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def enqueue(self, document_id: str, payload: Dict, priority: int = 0, max_attempts: int = 3) -> int:
+        """Queue a document, replacing any earlier job for it"""
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute('DELETE FROM jobs WHERE document_id = ?', (document_id,))
+                cursor = self.db.execute(
+                    'INSERT INTO jobs (document_id, payload, priority, status, max_attempts, available_at, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (document_id, json.dumps(payload), priority, QUEUED, max_attempts, now, now, now),
+                )
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return cursor.lastrowid
+
+    def attach(self, document_id: str, payload: Dict, priority: int = 0, max_attempts: int = 3) -> Tuple[Dict, bool]:
+        """The queued, running or completed job for a document, or a new one if it has none (or it failed).
+
+        Returns (job, created). Concurrent identical uploads share one job this way; a higher
+        priority raises the priority of the job they attach to.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute(
+                    'SELECT * FROM jobs WHERE document_id = ? ORDER BY id DESC LIMIT 1', (document_id,)
+                ).fetchone()
+                created = row is None or row['status'] == FAILED
+                if created:
+                    self.db.execute('DELETE FROM jobs WHERE document_id = ?', (document_id,))
+                    job_id = self.db.execute(
+                        'INSERT INTO jobs (document_id, payload, priority, status, max_attempts, available_at, created_at, updated_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (document_id, json.dumps(payload), priority, QUEUED, max_attempts, now, now, now),
+                    ).lastrowid
+                else:
+                    job_id = row['id']
+                    if row['status'] == QUEUED and priority > row['priority']:
+                        self.db.execute('UPDATE jobs SET priority = ? WHERE id = ?', (priority, job_id))
+                job = self._row(self.db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return job, created
+
+    def find(self, document_id: str) -> Optional[Dict]:
+        with self.lock:
+            return self._row(self.db.execute(
+                'SELECT * FROM jobs WHERE document_id = ? ORDER BY id DESC LIMIT 1', (document_id,)
+            ).fetchone())
+
+    def claim(self, worker_id: str) -> Optional[Dict]:
+        """Lease the next ready job to `worker_id`, or return None if nothing is ready"""
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute(
+                    'SELECT id FROM jobs WHERE (status = ? AND available_at <= ?) OR (status = ? AND lease_expires_at < ?) '
+                    'ORDER BY priority DESC, available_at, id LIMIT 1',
+                    (QUEUED, now, RUNNING, now),
+                ).fetchone()
+                if row is None:
+                    self.db.execute('COMMIT')
+                    return None
+                self.db.execute(
+                    'UPDATE jobs SET status = ?, worker_id = ?, lease_expires_at = ?, attempts = attempts + 1, updated_at = ? '
+                    'WHERE id = ?',
+                    (RUNNING, worker_id, now + self.lease_seconds, now, row['id']),
+                )
+                job = self.db.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return self._row(job)
+
+    def _update_owned(self, job_id: int, worker_id: str, sql: str, params: tuple) -> bool:
+        # Only the worker holding the lease may change a running job
+        with self.lock:
+            cursor = self.db.execute(
+                f'UPDATE jobs SET {sql}, updated_at = ? WHERE id = ? AND worker_id = ? AND status = ?',
+                params + (time.time(), job_id, worker_id, RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, job_id: int, worker_id: str, eta_at: Optional[float] = None) -> bool:
+        """Extend the lease, recording the job's estimated completion time"""
+        return self._update_owned(
+            job_id, worker_id, 'lease_expires_at = ?, eta_at = ?', (time.time() + self.lease_seconds, eta_at)
+        )
+
+    def complete(self, job_id: int, worker_id: str, result: Dict) -> bool:
+        return self._update_owned(
+            job_id, worker_id, 'status = ?, result = ?, error = NULL, lease_expires_at = NULL',
+            (COMPLETED, json.dumps(result)),
+        )
+
+    def fail(self, job_id: int, worker_id: str, error: str, retry: bool = True) -> bool:
+        """Record a failed attempt, re-queueing the job with backoff while attempts remain.
+
+        Returns True if the job will be retried; pass retry=False for errors another attempt would repeat.
+        """
+        with self.lock:
+            job = self.get_job(job_id)
+            if job is None:
+                return False
+            if retry and job['attempts'] < job['max_attempts']:
+                delay = min(MAX_BACKOFF, self.retry_delay * BACKOFF_FACTOR ** (job['attempts'] - 1))
+                return self._update_owned(
+                    job_id, worker_id, 'status = ?, error = ?, available_at = ?, lease_expires_at = NULL',
+                    (QUEUED, error, time.time() + delay),
+                )
+            self._update_owned(job_id, worker_id, 'status = ?, error = ?, lease_expires_at = NULL', (FAILED, error))
+            return False
+
+    def retry(self, document_id: str, max_retries: int) -> bool:
+        """Give a failed document a fresh set of attempts, at most `max_retries` times"""
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                'UPDATE jobs SET status = ?, attempts = 0, retry_count = retry_count + 1, available_at = ?, '
+                'error = NULL, updated_at = ? WHERE document_id = ? AND status = ? AND retry_count < ?',
+                (QUEUED, now, now, document_id, FAILED, max_retries),
+            )
+        return cursor.rowcount > 0
+
+    def remove(self, document_id: str):
+        with self.lock:
+            self.db.execute('DELETE FROM jobs WHERE document_id = ?', (document_id,))
+
+    def get_job(self, job_id: int) -> Optional[Dict]:
+        with self.lock:
+            return self._row(self.db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+    def changed_since(self, timestamp: float) -> List[Dict]:
+        with self.lock:
+            rows = self.db.execute('SELECT * FROM jobs WHERE updated_at >= ? ORDER BY updated_at', (timestamp,)).fetchall()
+        return [self._row(row) for row in rows]
+
+    def add_event(self, document_id: str, event_type: str, data: Dict):
+        """Record a progress event for streaming to clients; events expire after EVENT_RETENTION_SECONDS"""
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO job_events (document_id, type, data, created_at) VALUES (?, ?, ?, ?)',
+                (document_id, event_type, json.dumps(dict(data, document=document_id)), now),
+            )
+            if now - self.last_pruned > 60:
+                self.db.execute('DELETE FROM job_events WHERE created_at < ?', (now - EVENT_RETENTION_SECONDS,))
+                self.last_pruned = now
+
+    def events_since(self, last_id: int, limit: int = 200) -> List[Dict]:
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT id, type, data FROM job_events WHERE id > ? ORDER BY id LIMIT ?', (last_id, limit)
+            ).fetchall()
+        return [{'id': row['id'], 'type': row['type'], 'data': json.loads(row['data'])} for row in rows]
+
+    def last_event_id(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COALESCE(MAX(id), 0) FROM job_events').fetchone()[0]
+
+    def depth(self) -> Dict[str, int]:
+        """Number of jobs in each state"""
+        with self.lock:
+            rows = self.db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
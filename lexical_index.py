@@ -0,0 +1,82 @@
+"""In-memory BM25 inverted index over RAG passages.
+
+Complements the embedding index for exact identifiers (circular numbers such as
+"SEBI/HO/MRD/2023/12", clause references such as "Annex 3.2") that sentence embeddings
+match poorly. Identifiers are indexed both whole and by their parts, so a query can match
+either form. Passages are added and removed incrementally alongside their embeddings.
+"""
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+(?:[./\-_][a-z0-9]+)*')
+PART_PATTERN = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset('''
+a an and are as at be by for from has have in is it its of on or that the this to was were will with
+what which who whom how when where why can do does shall should may must not no any all our we you your
+'''.split())
+
+
+def tokenize(text: str) -> List[str]:
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token not in STOPWORDS:
+            terms.append(token)
+        if not token.isalnum():
+            terms.extend(part for part in PART_PATTERN.findall(token) if part not in STOPWORDS)
+    return terms
+
+
+class BM25Index:
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[int, int]] = {}  # term -> passage id -> term frequency
+        self.lengths: Dict[int, int] = {}
+        self.terms: Dict[int, Tuple[str, ...]] = {}  # passage id -> distinct terms, for removal
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, passage_id: int, text: str):
+        if passage_id in self.lengths:
+            self.remove([passage_id])
+        counts = Counter(tokenize(text))
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[passage_id] = count
+        length = sum(counts.values())
+        self.lengths[passage_id] = length
+        self.terms[passage_id] = tuple(counts)
+        self.total_length += length
+
+    def remove(self, passage_ids: Iterable[int]):
+        for passage_id in passage_ids:
+            if passage_id not in self.lengths:
+                continue
+            for term in self.terms.pop(passage_id):
+                postings = self.postings[term]
+                del postings[passage_id]
+                if not postings:
+                    del self.postings[term]
+            self.total_length -= self.lengths.pop(passage_id)
+
+    def search(self, query: str, top_k: int, allowed: Optional[Set[int]] = None) -> List[Tuple[int, float]]:
+        """(passage id, BM25 score) of the best matches; only passages sharing a query term (and in `allowed`) are scored"""
+        count = len(self.lengths)
+        if not count:
+            return []
+        average_length = self.total_length / count or 1
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for passage_id, frequency in postings.items():
+                if allowed is not None and passage_id not in allowed:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[passage_id] / average_length)
+                scores[passage_id] = scores.get(passage_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
@@ -0,0 +1,50 @@
+import hashlib
+import json
+from typing import Any, Dict, Optional, Union
+from diskcache import Cache
+from config import DISK_CACHE_DIR, DISK_CACHE_EXPIRATION, DISK_CACHE_SIZE_LIMIT, LLM_CACHE_ENABLED
+from logger import main_logger as logger
+
+# Persistent response cache shared by every LLM call site; diskcache keeps its SQLite index in DISK_CACHE_DIR
+response_cache = Cache(
+    DISK_CACHE_DIR,
+    size_limit=DISK_CACHE_SIZE_LIMIT,
+    eviction_policy='least-recently-used',
+)
+response_cache.stats(enable=True)
+
+
+# A cached completion: validated structured output, or free-form text
+CachedResponse = Union[str, Dict[str, Any]]
+
+
+def make_cache_key(model: str, prompt_key: str, text: str, max_tokens: int) -> str:
+    """Content-addressed key for a completion request; `prompt_key` identifies the prompt and output format"""
+    payload = json.dumps([model, prompt_key, text, max_tokens], ensure_ascii=False)
+    return 'chat:' + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_cached_response(key: str) -> Optional[CachedResponse]:
+    if not LLM_CACHE_ENABLED:
+        return None
+    value = response_cache.get(key)
+    if value is not None:
+        logger.info(f"LLM cache hit: {key[:16]}")
+    return value
+
+
+def set_cached_response(key: str, value: CachedResponse):
+    if not LLM_CACHE_ENABLED:
+        return
+    response_cache.set(key, value, expire=DISK_CACHE_EXPIRATION)
+
+
+def cache_stats() -> Dict:
+    hits, misses = response_cache.stats()
+    return {
+        'enabled': LLM_CACHE_ENABLED,
+        'hits': hits,
+        'misses': misses,
+        'entries': len(response_cache),
+        'size_bytes': response_cache.volume(),
+    }
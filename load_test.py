@@ -0,0 +1,240 @@
+"""Load test of /upload and /get_checklists throughput as web worker processes are added.
+
+For each worker count, starts the app as that many processes on one port, sharing a database,
+job queue and upload folder in a fresh working directory, the way a gunicorn deployment with
+PROCESSING_WORKER_MODE=external does. Concurrent client processes, each logged in as its own
+user, then upload unique PDFs and poll /get_checklists?status_only=1 for a fixed time:
+
+    python load_test.py [--workers 1,2,4] [--clients 16] [--duration 10] [--backend memory|redis]
+                        [--server auto|gunicorn|builtin] [--output load_test_results.jsonl]
+
+No processing workers run, so uploads are only stored and queued and both endpoints measure
+the web tier. Requests per second are reported with the scaling efficiency against the first
+worker count (per worker); scaling is bounded by the cores shared by the server and the client processes.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+from benchmark import synthetic_pdf, percentile, git_commit
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+PHASES = ('upload', 'get_checklists')
+
+
+def serve(fd: int):
+    """Entry point of a built-in server process: one threaded WSGI server on the shared listening socket"""
+    import logging
+    from werkzeug.serving import make_server
+    from app import app
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # no per-request access log
+    server = make_server('127.0.0.1', 0, app, threaded=True, fd=fd)
+    print('ready', flush=True)
+    server.serve_forever()
+
+
+def server_env(workdir: str, backend: str) -> Dict[str, str]:
+    return dict(
+        os.environ,
+        OPENAI_API_KEY='load-test',
+        SECRET_KEY='load-test',  # every worker must accept the others' session cookies
+        STARTUP_MODE='lazy',
+        PROCESSING_WORKER_MODE='external',
+        SHARED_STATE_BACKEND=backend,
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'documents.db')}",
+        JOB_QUEUE_DB_PATH=os.path.join(workdir, 'job_queue.db'),
+        USAGE_METRICS_DB_PATH=os.path.join(workdir, 'usage_metrics.db'),
+        ANSWER_CACHE_DB_PATH=os.path.join(workdir, 'answer_cache.db'),
+        REVISION_DB_PATH=os.path.join(workdir, 'revisions.db'),
+        VECTOR_STORE_PATH=os.path.join(workdir, 'faiss_index'),
+        UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+        SHARED_STATE_PREFIX=f'load-test-{os.getpid()}-{os.path.basename(workdir)}:',
+    )
+
+
+def start_server(workers: int, server: str, env: Dict[str, str], workdir: str) -> Tuple[List[subprocess.Popen], str]:
+    if server == 'gunicorn':
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        command = [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', '4',
+                   '--bind', f'127.0.0.1:{port}', 'app:app']
+        return [subprocess.Popen(command, cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL)], f'http://127.0.0.1:{port}'
+
+    # Each process accepts from the same listening socket, as gunicorn's workers do
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    fd = listener.fileno()
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--serve-fd', str(fd)],
+            cwd=workdir, env=env, pass_fds=(fd,), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        )
+        for _ in range(workers)
+    ]
+    url = f'http://127.0.0.1:{listener.getsockname()[1]}'
+    listener.close()
+    return processes, url
+
+
+def wait_ready(url: str, processes: List[subprocess.Popen], timeout: float = 120):
+    import requests
+    # Built-in server processes report once the app is imported, so imports are not measured
+    for process in processes:
+        if process.stdout is not None:
+            process.stdout.readline()
+    deadline = time.time() + timeout
+    while True:
+        if any(process.poll() is not None for process in processes):
+            raise RuntimeError("A server process exited during startup")
+        try:
+            if requests.get(f'{url}/login', timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        if time.time() > deadline:
+            raise RuntimeError(f"Server at {url} did not start within {timeout:.0f}s")
+        time.sleep(0.5)
+
+
+def stop_server(processes: List[subprocess.Popen]):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run_client(args: Tuple) -> Dict[str, Dict]:
+    """One client process: log in, then run each phase between its shared start and end times"""
+    import requests
+    url, number, pdf_path, phase_starts, duration = args
+    session = requests.Session()
+    username = f'load-{number}'
+    session.post(f'{url}/register', data={'username': username, 'password': username})
+    session.post(f'{url}/login', data={'username': username, 'password': username})
+    with open(pdf_path, 'rb') as f:
+        pdf = f.read()
+
+    results = {}
+    for phase, started in zip(PHASES, phase_starts):
+        time.sleep(max(0.0, started - time.time()))
+        latencies, errors, sent = [], 0, 0
+        while time.time() < started + duration:
+            sent += 1
+            request_started = time.perf_counter()
+            try:
+                if phase == 'upload':
+                    # Unique content, so every upload stores a file and queues a job
+                    content = pdf + f'\n% load test {number}-{sent}\n'.encode()
+                    response = session.post(
+                        f'{url}/upload', files={'files': (f'load-{number}-{sent}.pdf', content, 'application/pdf')}
+                    )
+                else:
+                    response = session.get(f'{url}/get_checklists?status_only=1')
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - request_started)
+            else:
+                errors += 1
+        results[phase] = {'latencies': latencies, 'errors': errors}
+    return results
+
+
+def run_load(url: str, clients: int, duration: float, pdf_path: str) -> Dict[str, Dict]:
+    # Phases start at fixed times once every client has had time to log in
+    first = time.time() + 5
+    phase_starts = [first + index * (duration + 1) for index in range(len(PHASES))]
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.map(run_client, [(url, number, pdf_path, phase_starts, duration) for number in range(clients)])
+
+    report = {}
+    for phase in PHASES:
+        latencies = [latency for result in results for latency in result[phase]['latencies']]
+        report[phase] = {
+            'requests': len(latencies),
+            'errors': sum(result[phase]['errors'] for result in results),
+            'per_second': round(len(latencies) / duration, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', default='1,2,4', help='comma-separated web worker process counts')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent client processes')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per endpoint')
+    parser.add_argument('--backend', choices=('memory', 'redis'), default='memory',
+                        help='SHARED_STATE_BACKEND of the servers (redis coordinates across processes)')
+    parser.add_argument('--server', choices=('auto', 'gunicorn', 'builtin'), default='auto',
+                        help='gunicorn if installed, otherwise built-in processes sharing one socket')
+    parser.add_argument('--output', default='load_test_results.jsonl', help='results are appended here')
+    parser.add_argument('--serve-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_fd is not None:
+        serve(args.serve_fd)
+        return
+
+    server = args.server
+    if server == 'auto':
+        try:
+            import gunicorn  # noqa: F401
+            server = 'gunicorn'
+        except ImportError:
+            server = 'builtin'
+    root = tempfile.mkdtemp(prefix='load-test-')
+    pdf_path = synthetic_pdf(os.path.join(root, 'upload.pdf'), pages=5)
+    commit = git_commit()
+    print(f"{server} server, {args.backend} shared state, {args.clients} clients, {os.cpu_count()} cores, "
+          f"working directory {root}")
+
+    baseline: Dict[str, float] = {}
+    for workers in [int(value) for value in args.workers.split(',')]:
+        workdir = tempfile.mkdtemp(prefix=f'{workers}-workers-', dir=root)
+        os.makedirs(os.path.join(workdir, 'uploads'))
+        processes, url = start_server(workers, server, server_env(workdir, args.backend), workdir)
+        try:
+            wait_ready(url, processes)
+            report = run_load(url, args.clients, args.duration, pdf_path)
+        finally:
+            stop_server(processes)
+
+        for phase in PHASES:
+            result = report[phase]
+            baseline.setdefault(phase, result['per_second'] / workers)
+            efficiency = result['per_second'] / (baseline[phase] * workers) if baseline[phase] else 0.0
+            print(f"{workers:>3} workers  {phase:<15} {result['per_second']:>8.1f} req/s "
+                  f"({efficiency:.0%} of linear)  p50 {result['p50_ms']:.1f}ms  p99 {result['p99_ms']:.1f}ms  "
+                  f"errors {result['errors']}")
+            with open(args.output, 'a') as f:
+                f.write(json.dumps({
+                    'commit': commit,
+                    'timestamp': time.time(),
+                    'endpoint': phase,
+                    'workers': workers,
+                    'clients': args.clients,
+                    'server': server,
+                    'backend': args.backend,
+                    'cores': os.cpu_count(),
+                    'scaling_efficiency': round(efficiency, 3),
+                    **result,
+                }) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Users and documents persisted with Flask-SQLAlchemy (SQLite by default, PostgreSQL via DATABASE_URL).
+
+Result bodies live in a deferred column, so listing and status queries never load them;
+they are read only when a document is viewed or exported.
+"""
+import time
+from flask_login import UserMixin
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import deferred
+
+db = SQLAlchemy()
+
+# Document statuses in which the document is still waiting for or being processed
+ACTIVE_STATUSES = ('Queued', 'Processing', 'Retrying')
+
+
+class User(UserMixin, db.Model):
+    __tablename__ = 'users'
+
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(150), unique=True, nullable=False, index=True)
+    password_hash = db.Column(db.String(256), nullable=False)
+
+
+class Document(db.Model):
+    __tablename__ = 'documents'
+    __table_args__ = (
+        db.Index('documents_owner_status', 'owner_id', 'status'),
+        db.Index('documents_owner_updated', 'owner_id', 'updated_at'),
+        # Filenames are unique per owner; different users can each have a policy.pdf
+        db.Index('documents_owner_filename', 'owner_id', 'filename', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), nullable=False, index=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    path = db.Column(db.String(1024), nullable=False)
+    # sha256 of the file; documents with the same content share one processing job and result
+    content_hash = db.Column(db.String(64), index=True)
+    status = db.Column(db.String(32), nullable=False, default='Queued')
+    retry_count = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    chunk_count = db.Column(db.Integer)
+    item_count = db.Column(db.Integer)
+    # Estimated completion time while processing, from the worker's chunk throughput
+    eta_at = db.Column(db.Float)
+    created_at = db.Column(db.Float, nullable=False, default=time.time)
+    updated_at = db.Column(db.Float, nullable=False, default=time.time, onupdate=time.time)
+    result = deferred(db.Column(db.JSON))
+
+    @property
+    def processing(self) -> bool:
+        return self.status in ACTIVE_STATUSES
+
+    @property
+    def job_key(self) -> str:
+        # Documents uploaded before content addressing were queued by filename
+        return self.content_hash or self.filename
+
+    @property
+    def has_result(self) -> bool:
+        # item_count is set together with the result, so this does not load the deferred body
+        return self.item_count is not None
+
+
+def upgrade_schema():
+    """Add columns and indexes introduced after a database was created (create_all only creates missing tables)"""
+    inspector = db.inspect(db.engine)
+    columns = {column['name'] for column in inspector.get_columns('documents')}
+    indexes = {index['name']: index for index in inspector.get_indexes('documents')}
+    with db.engine.begin() as connection:
+        if indexes.get('ix_documents_filename', {}).get('unique'):
+            # Filenames used to be unique across all users
+            connection.execute(db.text('DROP INDEX ix_documents_filename'))
+            connection.execute(db.text('CREATE INDEX ix_documents_filename ON documents (filename)'))
+        if 'documents_owner_filename' not in indexes:
+            connection.execute(db.text(
+                'CREATE UNIQUE INDEX documents_owner_filename ON documents (owner_id, filename)'
+            ))
+        if 'content_hash' not in columns:
+            connection.execute(db.text('ALTER TABLE documents ADD COLUMN content_hash VARCHAR(64)'))
+            connection.execute(db.text('CREATE INDEX ix_documents_content_hash ON documents (content_hash)'))
+        if 'eta_at' not in columns:
+            connection.execute(db.text('ALTER TABLE documents ADD COLUMN eta_at FLOAT'))
+
+
+def create_schema(attempts: int = 3):
+    """Create missing tables and columns.
+
+    Web workers starting together on a new database race to create them; the losers' CREATE
+    fails, and the next attempt finds the winner's tables.
+    """
+    for attempt in range(attempts):
+        try:
+            db.create_all()
+            upgrade_schema()
+            return
+        except OperationalError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.1)
+
+
+def visible_documents(user_id: int):
+    """Documents a user can see: their own, plus any recorded without an owner"""
+    return Document.query.filter(db.or_(Document.owner_id == user_id, Document.owner_id.is_(None)))
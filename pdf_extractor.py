@@ -0,0 +1,111 @@
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Iterator, List, Optional, Tuple
+from config import PDF_EXTRACTION_BACKEND, PDF_PARALLEL_PAGE_THRESHOLD, PDF_EXTRACTION_PROCESSES
+from logger import main_logger as logger
+
+
+# PyMuPDF backend: MuPDF reads the file on demand, so opening by path never copies it into Python memory
+def _pymupdf_page_count(pdf_path: str) -> int:
+    import pymupdf
+    with pymupdf.open(pdf_path) as doc:
+        return doc.page_count
+
+
+def _pymupdf_pages(pdf_path: str, start: int, end: int) -> Iterator[str]:
+    import pymupdf
+    with pymupdf.open(pdf_path) as doc:
+        for page_index in range(start, end):
+            yield doc.load_page(page_index).get_text()
+
+
+# PyPDF2 backend: the reader seeks over a read-only memory map instead of a buffered file copy.
+# mmap cannot map a zero-byte file, so empty files are handled before any backend opens them.
+def _open_mmap(pdf_path: str) -> mmap.mmap:
+    with open(pdf_path, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _pypdf2_page_count(pdf_path: str) -> int:
+    import PyPDF2
+    with _open_mmap(pdf_path) as mapped:
+        return len(PyPDF2.PdfReader(mapped).pages)
+
+
+def _pypdf2_pages(pdf_path: str, start: int, end: int) -> Iterator[str]:
+    import PyPDF2
+    with _open_mmap(pdf_path) as mapped:
+        reader = PyPDF2.PdfReader(mapped)
+        for page_index in range(start, end):
+            yield reader.pages[page_index].extract_text() or ""
+
+
+BACKENDS = {
+    'pymupdf': (_pymupdf_page_count, _pymupdf_pages),
+    'pypdf2': (_pypdf2_page_count, _pypdf2_pages),
+}
+
+
+def resolve_backend(name: Optional[str] = None) -> str:
+    name = name or PDF_EXTRACTION_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown PDF extraction backend: {name}")
+    if name == 'pymupdf':
+        try:
+            import pymupdf  # noqa: F401
+        except ImportError:
+            logger.warning("PyMuPDF is not installed, falling back to PyPDF2 for text extraction")
+            return 'pypdf2'
+    return name
+
+
+def _extract_range(pdf_path: str, backend: str, start: int, end: int) -> List[str]:
+    return list(BACKENDS[backend][1](pdf_path, start, end))
+
+
+def _is_empty(pdf_path: str) -> bool:
+    return os.path.getsize(pdf_path) == 0
+
+
+def page_count(pdf_path: str, backend: Optional[str] = None) -> int:
+    if _is_empty(pdf_path):
+        return 0
+    return BACKENDS[resolve_backend(backend)][0](pdf_path)
+
+
+def iter_pages(pdf_path: str, backend: Optional[str] = None,
+               processes: Optional[int] = None) -> Iterator[Tuple[int, str]]:
+    """Yield (page_number, text) for each page, numbering from 1.
+
+    Documents with at least PDF_PARALLEL_PAGE_THRESHOLD pages are split into page ranges
+    extracted in a process pool; ranges are still yielded in page order as they complete.
+    """
+    if _is_empty(pdf_path):
+        logger.warning(f"{os.path.basename(pdf_path)} is empty, no pages to extract")
+        return
+    backend = resolve_backend(backend)
+    count_pages, extract_pages = BACKENDS[backend]
+    total = count_pages(pdf_path)
+    processes = processes or PDF_EXTRACTION_PROCESSES
+
+    if total < PDF_PARALLEL_PAGE_THRESHOLD or processes <= 1:
+        for page_index, text in enumerate(extract_pages(pdf_path, 0, total)):
+            yield page_index + 1, text
+        return
+
+    # Several ranges per process keeps early pages flowing to the chunker
+    range_size = max(1, -(-total // (processes * 4)))
+    ranges = [(start, min(start + range_size, total)) for start in range(0, total, range_size)]
+    logger.info(f"Extracting {total} pages from {os.path.basename(pdf_path)} with {processes} processes")
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        starts, ends = zip(*ranges)
+        results = pool.map(_extract_range, repeat(pdf_path), repeat(backend), starts, ends)
+        for (start, _), texts in zip(ranges, results):
+            for offset, text in enumerate(texts):
+                yield start + offset + 1, text
+
+
+def extract_text(pdf_path: str, backend: Optional[str] = None) -> str:
+    return "".join(text for _, text in iter_pages(pdf_path, backend))
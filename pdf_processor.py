@@ -1,38 +1,88 @@
-import openai
 import requests
-import PyPDF2
-import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from requests.adapters import HTTPAdapter
 from concurrent.futures import ThreadPoolExecutor
 import time
 import json
 import os
+import threading
+from itertools import chain
 from logger import main_logger as logger
+from rate_limiter import rate_limiter, estimate_tokens
+from llm_cache import make_cache_key, get_cached_response, set_cached_response
+from usage_metrics import record_api_call
+from config import CHUNK_ENGINE, CHUNK_CONCURRENCY, CHUNK_REQUEST_TIMEOUT, CHUNK_TOKEN_BUDGET, CHUNK_OUTPUT_FORMAT
+from chunker import chunk_pages
+from pdf_extractor import iter_pages, extract_text
+from instrumentation import span, TimedIterator
+from checklist import CHECKLIST_SCHEMA, merge_checklists, validate_checklist, parse_sections
+from revisions import StoredChunk, revision_store, plan_reuse, checklist_diff, fingerprinted
+from scheduler import chunk_scheduler
+from shared_state import api_slots
 
 # Set up OpenAI API key and endpoint for chat completions
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
-OPENAI_CHAT_COMPLETION_ENDPOINT = 'https://api.openai.com/v1/chat/completions'
+# Overridable so benchmarks can point at a local mock server
+OPENAI_CHAT_COMPLETION_ENDPOINT = os.environ.get('OPENAI_CHAT_COMPLETION_ENDPOINT', 'https://api.openai.com/v1/chat/completions')
+CHAT_MODEL = "gpt-4o-mini"
+CHUNK_MAX_TOKENS = 1500  # Increase max tokens if needed for detailed output
+
+# Bump whenever the chunk prompt below changes so cached responses are not reused
+CHECKLIST_PROMPT_VERSION = 2
+
+# Identifies the prompt and output format that produced a cached or stored chunk answer
+CHUNK_PROMPT_KEY = f"{CHECKLIST_PROMPT_VERSION}:{CHUNK_OUTPUT_FORMAT}"
+
+# Structured output: the API constrains chunk answers to CHECKLIST_SCHEMA
+CHECKLIST_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "compliance_checklist", "strict": True, "schema": CHECKLIST_SCHEMA},
+}
+
+# Keep-alive connection pool shared by all chunk worker threads
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CHUNK_CONCURRENCY)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+
+# Lazily extract (page_number, text) pairs from a PDF file
+def iter_pdf_pages(pdf_path):
+    return iter_pages(pdf_path)
 
 # Function to extract text from a PDF file
 def get_pdf_metadata(pdf_path):
-    text = ""
-    with open(pdf_path, 'rb') as file:
-        pdf_reader = PyPDF2.PdfReader(file)
-        for page_num in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[page_num]
-            text += page.extract_text()
-    return text
+    with span('extract'):
+        return extract_text(pdf_path)
 
-# Function to make an actual API call to OpenAI chat completion (GPT-4)
-def process_chunk_gpt4(chunk, index,retries=5, wait_time=2):
-    logger.info(f"Processing chunk number: {index}")
-    headers = {
+# Request headers for the OpenAI REST API
+def openai_headers():
+    return {
         "Authorization": f"Bearer {OPENAI_API_KEY}",
         "Content-Type": "application/json"
     }
 
+# Chat completion payload asking for a checklist for one chunk
+def build_chunk_request(chunk):
+    if CHUNK_OUTPUT_FORMAT == 'json':
+        output_instructions = """
+            Return the checklist as JSON: one entry in "sections" per heading, with the heading as "title" and each specific compliance requirement as a separate string in "items". Leave "sections" empty if the section contains no compliance requirements.
+            """
+    else:
+        output_instructions = """
+            Summarize the compliance requirements mentioned and provide a checklist that looks like this:
+
+            Governance & Risk Management:
+            - Establish clear cybersecurity roles and responsibilities for senior management and all employees.
+            - Document and implement a cybersecurity and cyber resilience policy approved by the Board/Partners/Proprietor.
+            - Develop a Cyber Risk Management Framework to continuously identify, analyze, and monitor cyber risks.
+
+            Data Security & Protection:
+            - Implement an Authentication and Access Control Policy and ensure effective logging of all access.
+            - Design and implement network segmentation to restrict access to sensitive information.
+
+            Continue in this format for all the relevant sections based on the content provided.
+            """
     data = {
-        "model": "gpt-4o-mini",  # Use GPT-4 model
+        "model": CHAT_MODEL,
         "messages": [
             {"role": "system", "content": "You are a compliance expert."},
             {"role": "user", "content": f"""
@@ -43,82 +93,238 @@ def process_chunk_gpt4(chunk, index,retries=5, wait_time=2):
             Here's the section to review:
 
             {chunk}
+            {output_instructions}"""}
+        ],
+        "max_tokens": CHUNK_MAX_TOKENS
+    }
+    if CHUNK_OUTPUT_FORMAT == 'json':
+        data["response_format"] = CHECKLIST_RESPONSE_FORMAT
+    return data
 
-            Summarize the compliance requirements mentioned and provide a checklist that looks like this:
-
-            Governance & Risk Management:
-            - Establish clear cybersecurity roles and responsibilities for senior management and all employees.
-            - Document and implement a cybersecurity and cyber resilience policy approved by the Board/Partners/Proprietor.
-            - Develop a Cyber Risk Management Framework to continuously identify, analyze, and monitor cyber risks.
-
-            Data Security & Protection:
-            - Implement an Authentication and Access Control Policy and ensure effective logging of all access.
-            - Design and implement network segmentation to restrict access to sensitive information.
+def chunk_cache_key(chunk):
+    return make_cache_key(CHAT_MODEL, CHUNK_PROMPT_KEY, chunk, CHUNK_MAX_TOKENS)
 
-            Continue in this format for all the relevant sections based on the content provided.
-            """}
+# One small call asking the model to re-format an answer that failed validation
+def repair_chunk_output(content, index, document_id=None):
+    data = {
+        "model": CHAT_MODEL,
+        "messages": [
+            {"role": "system", "content": "You convert compliance checklists to JSON without changing their wording."},
+            {"role": "user", "content": f"Convert this checklist into the requested JSON format:\n\n{content}"},
         ],
-        "max_tokens": 1500  # Increase max tokens if needed for detailed output
+        "max_tokens": CHUNK_MAX_TOKENS,
+        "response_format": CHECKLIST_RESPONSE_FORMAT,
     }
+    rate_limiter.acquire(estimate_tokens(content, CHUNK_MAX_TOKENS))
+    started = time.perf_counter()
+    try:
+        response = http_session.post(OPENAI_CHAT_COMPLETION_ENDPOINT, headers=openai_headers(), json=data, timeout=CHUNK_REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Repair call for chunk number: {index} failed: {e}")
+        return None
+    rate_limiter.update_from_headers(response.headers)
+    usage = {}
+    repaired = None
+    if response.status_code == 200:
+        body = response.json()
+        usage = body.get('usage') or {}
+        repaired = validate_checklist(body['choices'][0]['message'].get('content'))
+    record_api_call(
+        'chat_completion_repair', CHAT_MODEL,
+        prompt_tokens=usage.get('prompt_tokens', 0),
+        completion_tokens=usage.get('completion_tokens', 0),
+        latency=time.perf_counter() - started, status=response.status_code, document_id=document_id,
+    )
+    return repaired
 
-    for attempt in range(retries):
-        try:
-            response = requests.post(OPENAI_CHAT_COMPLETION_ENDPOINT, headers=headers, json=data, timeout=30)
-            response.raise_for_status()
-            logger.info(f"Completed chunk number: {index}")  # Check for HTTP errors
-            return response.json()['choices'][0]['message']['content']  # Return the chat completion result
-        except requests.exceptions.HTTPError as e:
-            logger.exception(f"Error processing chunk number: {index}, exception {e}")
-            if response.status_code == 429:
-                logger.info(f"Rate limit exceeded. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-                wait_time *= 2  # Exponential backoff: double the wait time for each retry
-            else:
+# Validate a chunk answer in structured output mode, repairing it only when invalid
+def finalize_chunk_output(content, index, document_id=None):
+    if CHUNK_OUTPUT_FORMAT != 'json':
+        return content
+    checklist = validate_checklist(content)
+    if checklist is None and content:
+        logger.warning(f"Chunk number: {index} returned an invalid checklist, requesting a repair")
+        checklist = repair_chunk_output(content, index, document_id)
+    if checklist is None:
+        # Last resort: read whatever checklist-shaped text the answer contains
+        checklist = parse_sections(content or '')
+    return checklist
+
+# Function to make an actual API call to OpenAI chat completion (GPT-4)
+def process_chunk_gpt4(chunk, index, retries=5, use_cache=True, document_id=None):
+    logger.info(f"Processing chunk number: {index}")
+    cache_key = chunk_cache_key(chunk)
+    if use_cache:
+        cached = get_cached_response(cache_key)
+        if cached is not None:
+            record_api_call('chat_completion', CHAT_MODEL, cache_hit=True, document_id=document_id)
+            logger.info(f"Completed chunk number: {index} from cache")
+            return cached
+
+    headers = openai_headers()
+    data = build_chunk_request(chunk)
+    estimated_tokens = estimate_tokens(chunk, data["max_tokens"])
+
+    # Wait for this document's turn at one of the shared request slots (held across retries)
+    with chunk_scheduler.slot(document_id, estimated_tokens):
+        for attempt in range(retries):
+            # Wait for headroom in the shared request/token budgets before sending
+            rate_limiter.acquire(estimated_tokens)
+            try:
+                # Caps requests in flight across every worker process
+                with api_slots.hold():
+                    started = time.perf_counter()
+                    with span('llm_call'):
+                        response = http_session.post(OPENAI_CHAT_COMPLETION_ENDPOINT, headers=headers, json=data, timeout=CHUNK_REQUEST_TIMEOUT)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                logger.warning(f"Network error processing chunk number: {index}, exception {e}")
+                record_api_call('chat_completion', CHAT_MODEL, latency=time.perf_counter() - started, status=0, document_id=document_id)
+                rate_limiter.backoff(attempt)
+                continue
+
+            latency = time.perf_counter() - started
+            rate_limiter.update_from_headers(response.headers)
+            if response.status_code != 200:
+                record_api_call('chat_completion', CHAT_MODEL, latency=latency, status=response.status_code, document_id=document_id)
+            if response.status_code == 429 or response.status_code >= 500:
+                logger.info(f"Chunk number: {index} got HTTP {response.status_code}, backing off")
+                rate_limiter.backoff(attempt, response.headers.get('Retry-After'))
+                continue
+
+            try:
+                response.raise_for_status()  # Check for HTTP errors
+            except requests.exceptions.HTTPError as e:
+                logger.exception(f"Error processing chunk number: {index}, exception {e}")
                 raise e  # Raise other errors
-    raise Exception(f"Failed after {retries} retries.")
+
+            body = response.json()
+            usage = body.get('usage') or {}
+            record_api_call(
+                'chat_completion', CHAT_MODEL,
+                prompt_tokens=usage.get('prompt_tokens', 0),
+                completion_tokens=usage.get('completion_tokens', 0),
+                latency=latency, status=response.status_code, document_id=document_id,
+            )
+            if 'total_tokens' in usage:
+                rate_limiter.record_usage(estimated_tokens, usage['total_tokens'])
+            content = finalize_chunk_output(body['choices'][0]['message'].get('content'), index, document_id)
+            set_cached_response(cache_key, content)
+            logger.info(f"Completed chunk number: {index}")
+            return content  # Return the chat completion result
+        raise Exception(f"Failed after {retries} retries.")
 
 # Parallel processing of document chunks (actual API calls)
-def process_document_parallel(chunks, delay=2):
-    with ThreadPoolExecutor(max_workers=5) as executor:
+# Pacing is handled by the shared rate limiter and ordering across documents by the chunk scheduler,
+# so chunks are submitted immediately
+def process_document_parallel(chunks, on_chunk=None, document_id=None):
+    with ThreadPoolExecutor(max_workers=CHUNK_CONCURRENCY) as executor:
         results = []
         for index, chunk in enumerate(chunks):
-            result = executor.submit(process_chunk_gpt4, chunk, index)
+            tokens = estimate_tokens(chunk, CHUNK_MAX_TOKENS)
+            chunk_scheduler.chunk_queued(document_id, tokens)
+            result = executor.submit(process_chunk_gpt4, chunk, index, document_id=document_id)
+            result.add_done_callback(lambda future, tokens=tokens: chunk_scheduler.chunk_finished(document_id, tokens))
+            if on_chunk:
+                result.add_done_callback(lambda future, index=index: future.exception() or on_chunk(index, future.result()))
             results.append(result)
-            time.sleep(delay)  # Simulating delay to avoid rate limits
         return [result.result() for result in results]
 
-# Generate a Checklist based on the results
+# Generate a Checklist based on the results: section title -> deduplicated items
 def generate_checklist(results):
-    # Placeholder for generating a compliance checklist based on results (can customize based on actual needs)
-    checklist = {
-        "Checklist": [
-            "Ensure data encryption is enabled",
-            "Conduct quarterly audits",
-            "Implement multi-factor authentication"
-        ]
-    }
-    return checklist
+    return merge_checklists(results)
 
 # Main processing function
-def process_pdf(text, chunk_size=50000):
-    # Simulating the extraction of relevant sections
-    chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)] # Simulated chunking
+# `source` is either extracted text or an iterable of (page_number, text) pairs; with pages,
+# chunks are dispatched to the LLM while later pages are still being extracted.
+# `on_progress(index, output, completed, submitted)` is called as each chunk finishes.
+# With `previous` (a stored revision of this document) only chunks of changed pages are sent.
+# `document_id` identifies the processing job (scheduling, cancellation, usage); the result is
+# stored as a revision under `revision_key` for `owner_id`, when given.
+def process_pdf(source, max_chunk_tokens=CHUNK_TOKEN_BUDGET, document_id=None, on_progress=None, previous=None,
+                revision_key=None, owner_id=None):
+    pages = [(1, source)] if isinstance(source, str) else source
+    progress = {'submitted': 0, 'completed': 0}
+    progress_lock = threading.Lock()
+    page_hashes, positions = [], {}
+    spans = []  # (first, last) page position of each chunk sent, in submission order
+
+    def counted(chunks):
+        for chunk in chunks:
+            progress['submitted'] += 1
+            spans.append((positions[chunk.start_page], positions[chunk.end_page]))
+            yield chunk.text
+
+    def chunk_done(index, output):
+        with progress_lock:
+            progress['completed'] += 1
+            completed, submitted = progress['completed'], progress['submitted']
+        try:
+            on_progress(index, output, completed, submitted)
+        except Exception as e:
+            logger.error(f"Error reporting progress for chunk {index}: {str(e)}")
+
+    # Extraction and chunking run lazily inside the dispatch loop, so both are timed per item
+    extracting = TimedIterator(pages, 'extract')
+    reused = []
+    if previous is None:
+        pages = fingerprinted(extracting, page_hashes, positions)
+        chunking = TimedIterator(chunk_pages(pages, max_chunk_tokens), 'chunk', exclude=extracting)
+    else:
+        # Diffing needs every page fingerprint first
+        pages = list(fingerprinted(extracting, page_hashes, positions))
+        plan = plan_reuse(previous, pages, CHUNK_PROMPT_KEY)
+        reused = plan.reused
+        runs = chain.from_iterable(chunk_pages(run, max_chunk_tokens) for run in plan.fresh_runs)
+        # Extraction already finished above, so chunking has no upstream time to exclude
+        chunking = TimedIterator(runs, 'chunk')
+    chunks = counted(chunking)
+
+    for index, chunk in enumerate(reused):
+        progress['submitted'] += 1
+        if on_progress:
+            chunk_done(index, chunk.output)
+
+    # Fresh chunks are numbered after the reused ones so progress indices stay unique
+    on_chunk = (lambda index, output: chunk_done(len(reused) + index, output)) if on_progress else None
 
     # Process relevant sections (API call)
-    logger.info(f"Processing total chunks: {len(chunks)}")
-    results = process_document_parallel(chunks, delay=2)
+    with span('llm_document'):
+        if CHUNK_ENGINE == 'async':
+            from async_processor import process_document_async
+            results = process_document_async(chunks, document_id, on_chunk)
+        else:
+            results = process_document_parallel(chunks, on_chunk, document_id)
+    logger.info(f"Processed total chunks: {len(results)}, reused: {len(reused)}")
 
-    # Combine results into a single output
-    final_output = "\n".join(results)
+    # Reused and new chunk outputs in page order
+    stored = sorted(reused + [StoredChunk(start, end, output) for (start, end), output in zip(spans, results)],
+                    key=lambda chunk: (chunk.start, chunk.end))
+    outputs = [chunk.output for chunk in stored]
 
-    # Generate a checklist
-    checklist = generate_checklist(results)
+    with span('assemble'):
+        # Generate a checklist
+        checklist = generate_checklist(outputs)
 
-    # Combine the final output and checklist
+    # Compact per-document result; the checklist is rendered for display/export on demand
     result = {
-        "compliance_info": final_output,
-        "checklist": checklist
+        "checklist": checklist,
+        "chunk_count": len(outputs),
+        "item_count": sum(len(items) for items in checklist.values()),
     }
+    if not checklist:
+        # Keep free-form answers that contained no recognisable checklist
+        raw = [output for output in outputs if isinstance(output, str) and output.strip()]
+        if raw:
+            result["compliance_info"] = "\n".join(raw)
+    if previous is not None:
+        result["revision"] = {
+            "previous_document": previous.filename,
+            "reused_chunks": len(reused),
+            "processed_chunks": len(results),
+            **checklist_diff(previous.checklist, checklist),
+        }
+    if revision_key is not None:
+        revision_store.save(revision_key, owner_id, page_hashes, stored, checklist, CHUNK_PROMPT_KEY)
 
     return result
 
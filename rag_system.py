@@ -1,46 +1,192 @@
+import threading
+import time
+import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
+from chunker import chunk_text
+from config import (
+    VECTOR_STORE_PATH,
+    EMBEDDING_MODEL_NAME,
+    RAG_PASSAGE_TOKENS,
+    RAG_PASSAGE_OVERLAP_TOKENS,
+    RAG_HYBRID_CANDIDATES,
+    RAG_MIN_SIMILARITY,
+    RAG_RRF_K,
+)
+from embedding_service import get_embedding_service, QUERY, INGEST
+from embedding_store import EmbeddingStore
+from instrumentation import span
+from lexical_index import BM25Index
 from logger import main_logger as logger
 
 class RAGSystem:
     def __init__(self):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.documents: Dict[str, Dict] = {}
-        self.embeddings: Dict[str, np.ndarray] = {}
+        # Torch and the model are loaded by the embedding service (in its own process by default)
+        self.embedder = get_embedding_service()
+        self.dimension = self.embedder.dimension
+        self.store = EmbeddingStore(VECTOR_STORE_PATH, EMBEDDING_MODEL_NAME, self.dimension)
+        # Inner product over L2-normalized vectors is cosine similarity
+        self.index = faiss.IndexIDMap(faiss.IndexFlatIP(self.dimension))
+        self.lexical = BM25Index()
+        self.lock = threading.RLock()
+        self.indexed_ids = set()
+        self.data_version = self.store.data_version()
+        self.load()
+
+    def split_passages(self, content: str) -> List[str]:
+        return [chunk.text for chunk in chunk_text(content, RAG_PASSAGE_TOKENS, RAG_PASSAGE_OVERLAP_TOKENS)]
+
+    def encode(self, texts: List[str], priority: int = INGEST) -> np.ndarray:
+        return self.embedder.encode(texts, priority).reshape(len(texts), self.dimension)
+
+    def embed_passages(self, passages: List[str]) -> np.ndarray:
+        """Embeddings for passages, encoding only those not already in the store"""
+        hashes = [self.store.content_hash(text) for text in passages]
+        rows = self.store.lookup(hashes)
+        missing = {content_hash: text for content_hash, text in zip(hashes, passages) if content_hash not in rows}
+        if missing:
+            rows.update(self.store.add_vectors(list(missing), self.encode(list(missing.values()))))
+        logger.info(f"Embedded {len(passages)} passages, {len(missing)} newly encoded")
+        return self.store.get_vectors([rows[content_hash] for content_hash in hashes])
+
+    def load(self):
+        """Rebuild the in-memory index from the persisted passages"""
+        passages = self.store.all_passages()
+        if not passages:
+            return
+        ids = [passage_id for passage_id, _ in passages]
+        embeddings = self.embed_passages([text for _, text in passages])
+        with self.lock:
+            self.index.add_with_ids(embeddings, np.array(ids, dtype=np.int64))
+            self.indexed_ids.update(ids)
+            for passage_id, text in passages:
+                self.lexical.add(passage_id, text)
+        logger.info(f"Loaded {len(passages)} passages from {VECTOR_STORE_PATH}")
+
+    def refresh(self):
+        """Pick up passages added or removed by other processes (e.g. external workers)"""
+        data_version = self.store.data_version()
+        if data_version == self.data_version:
+            return
+        with self.lock:
+            self.data_version = data_version
+            stored_ids = set(self.store.passage_ids())
+            removed = self.indexed_ids - stored_ids
+            added = sorted(stored_ids - self.indexed_ids)
+            if removed:
+                self.index.remove_ids(np.array(sorted(removed), dtype=np.int64))
+                self.indexed_ids -= removed
+                self.lexical.remove(removed)
+            if added:
+                passages = self.store.get_passages(added)
+                added = [passage_id for passage_id in added if passage_id in passages]
+                embeddings = self.embed_passages([passages[passage_id][1] for passage_id in added])
+                self.index.add_with_ids(embeddings, np.array(added, dtype=np.int64))
+                self.indexed_ids.update(added)
+                for passage_id in added:
+                    self.lexical.add(passage_id, passages[passage_id][1])
+        logger.info(f"Refreshed RAG index: {len(added)} passages added, {len(removed)} removed")
+
+    def corpus_version(self) -> str:
+        """Changes whenever documents are indexed or removed, by this or any other process"""
+        return f'{EMBEDDING_MODEL_NAME}:{self.store.corpus_version()}'
 
     def create_embeddings(self, documents: Dict[str, Dict]):
         for doc_id, doc in documents.items():
-            content = doc.get('content', '')
-            self.documents[doc_id] = doc
-            self.embeddings[doc_id] = self.model.encode(content)
+            passages = self.split_passages(doc.get('content', ''))
+            with span('embed'):
+                embeddings = self.embed_passages(passages) if passages else None
+            with self.lock:
+                # Re-processing a document replaces its passages
+                self.remove_document(doc_id)
+                ids = self.store.add_passages(doc_id, passages)
+                if ids:
+                    self.index.add_with_ids(embeddings, np.array(ids, dtype=np.int64))
+                    self.indexed_ids.update(ids)
+                    for passage_id, text in zip(ids, passages):
+                        self.lexical.add(passage_id, text)
+            logger.info(f"Indexed {len(passages)} passages for document: {doc_id}")
+
+    def remove_document(self, doc_id: str):
+        with self.lock:
+            passage_ids = self.store.remove_document(doc_id)
+            if passage_ids:
+                self.index.remove_ids(np.array(passage_ids, dtype=np.int64))
+                self.indexed_ids.difference_update(passage_ids)
+                self.lexical.remove(passage_ids)
+
+    def search_passages(self, query: str, top_k: int = 5, query_embedding: Optional[np.ndarray] = None,
+                        doc_ids: Optional[List[str]] = None) -> List[Tuple[str, str, float]]:
+        """(doc_id, passage, score) of the best passages by reciprocal rank fusion of vector and BM25 rankings.
+
+        Passages that only the vector index found are dropped below RAG_MIN_SIMILARITY, so the
+        result can be shorter than top_k; scores are fused scores, comparable within one query.
+        With `doc_ids`, only passages of those documents are searched.
+        """
+        with span('retrieve'):
+            self.refresh()
+            if query_embedding is None:
+                query_embedding = self.encode([query], QUERY)
+            query_embedding = query_embedding.reshape(1, self.dimension)
+            candidates = top_k * RAG_HYBRID_CANDIDATES
+            allowed, params = None, None
+            if doc_ids is not None:
+                allowed = set(self.store.document_passage_ids(doc_ids))
+                if not allowed:
+                    return []
+                params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(np.array(sorted(allowed), dtype=np.int64)))
+            with self.lock:
+                if self.index.ntotal == 0:
+                    return []
+                scores, ids = self.index.search(query_embedding, min(candidates, self.index.ntotal), params=params)
+                lexical = self.lexical.search(query, candidates, allowed)
+            similar = [(passage_id, score) for passage_id, score in zip(ids[0].tolist(), scores[0].tolist())
+                       if passage_id >= 0]
+            matched = {passage_id for passage_id, _ in lexical}
+
+            fused: Dict[int, float] = {}
+            for rank, (passage_id, similarity) in enumerate(similar):
+                if similarity >= RAG_MIN_SIMILARITY or passage_id in matched:
+                    fused[passage_id] = 1 / (RAG_RRF_K + rank + 1)
+            for rank, (passage_id, _) in enumerate(lexical):
+                fused[passage_id] = fused.get(passage_id, 0.0) + 1 / (RAG_RRF_K + rank + 1)
+            hits = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
+            passages = self.store.get_passages([passage_id for passage_id, _ in hits])
+            return [(*passages[passage_id], score) for passage_id, score in hits if passage_id in passages]
 
     def similarity_search(self, query: str, top_k: int = 3) -> List[Tuple[str, float]]:
-        query_embedding = self.model.encode(query)
-        similarities = []
-        for doc_id, embedding in self.embeddings.items():
-            similarity = cosine_similarity([query_embedding], [embedding])[0][0]
-            similarities.append((doc_id, similarity))
-        return sorted(similarities, key=lambda x: x[1], reverse=True)[:top_k]
-
-    def retrieve_relevant_chunks(self, query: str, top_k: int = 3) -> List[str]:
-        top_docs = self.similarity_search(query, top_k)
+        # Best passage score per document, over enough passages to usually cover top_k documents
+        best: Dict[str, float] = {}
+        for doc_id, _, score in self.search_passages(query, top_k * 10):
+            best[doc_id] = max(score, best.get(doc_id, -1.0))
+        return sorted(best.items(), key=lambda x: x[1], reverse=True)[:top_k]
+
+    def retrieve_relevant_chunks(self, query: str, top_k: int = 5) -> List[str]:
         relevant_chunks = []
-        for doc_id, similarity in top_docs:
-            content = self.documents[doc_id]['content']
-            relevancy_percentage = similarity * 100
-            logger.info(f"Relevancy percentage: {relevancy_percentage}")
-            if relevancy_percentage > 5:
-                relevant_chunks.append(content)
-            else:
-                relevant_chunks.append(f"No relevant information found for this document")
+        for doc_id, passage, score in self.search_passages(query, top_k):
+            logger.info(f"Relevance score: {score:.4f} ({doc_id})")
+            relevant_chunks.append(passage)
         return relevant_chunks
 
-rag_system = RAGSystem()
+_rag_system = None
+_rag_system_lock = threading.Lock()
+
+def get_rag_system() -> RAGSystem:
+    """Create the shared RAG system (and load the embedding model) on first use"""
+    global _rag_system
+    if _rag_system is None:
+        with _rag_system_lock:
+            if _rag_system is None:
+                started = time.perf_counter()
+                _rag_system = RAGSystem()
+                logger.info(f"RAG system loaded in {time.perf_counter() - started:.2f}s")
+    return _rag_system
 
 def initialize_rag_system(documents: Dict[str, Dict]):
-    rag_system.create_embeddings(documents)
+    get_rag_system().create_embeddings(documents)
+
+def remove_from_rag_system(doc_id: str):
+    get_rag_system().remove_document(doc_id)
 
-def get_relevant_chunks(query: str, top_k: int = 3) -> List[str]:
-    return rag_system.retrieve_relevant_chunks(query, top_k)
+def get_relevant_chunks(query: str, top_k: int = 5) -> List[str]:
+    return get_rag_system().retrieve_relevant_chunks(query, top_k)
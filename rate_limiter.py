@@ -0,0 +1,142 @@
+import random
+import re
+import threading
+import time
+from typing import Mapping, Optional
+from config import (
+    RATE_LIMIT,
+    RATE_LIMIT_PERIOD,
+    TOKEN_RATE_LIMIT,
+    INITIAL_BACKOFF,
+    MAX_BACKOFF,
+    BACKOFF_FACTOR,
+)
+from logger import main_logger as logger
+
+# Rough characters-per-token ratio for English text, used to size requests before sending
+CHARS_PER_TOKEN = 4
+
+# Extra tokens charged for the system message and prompt template around each chunk
+PROMPT_OVERHEAD_TOKENS = 400
+
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def estimate_tokens(text: str, max_tokens: int = 0) -> int:
+    """Estimate the token cost of a chat completion from the prompt text and completion budget"""
+    return len(text) // CHARS_PER_TOKEN + PROMPT_OVERHEAD_TOKENS + max_tokens
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Parse OpenAI reset durations ("1s", "6m0s", "20ms") and Retry-After seconds into seconds"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+class RateLimiter:
+    """Process-wide token bucket admitting calls against request and token budgets"""
+
+    def __init__(self, requests_per_period: int, tokens_per_period: int, period: float = 60,
+                 initial_backoff: float = 1, max_backoff: float = 60, backoff_factor: float = 2):
+        self.request_capacity = float(requests_per_period)
+        self.token_capacity = float(tokens_per_period)
+        self.request_rate = requests_per_period / period
+        self.token_rate = tokens_per_period / period
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.backoff_factor = backoff_factor
+
+        self.available_requests = self.request_capacity
+        self.available_tokens = self.token_capacity
+        self.paused_until = 0.0
+        self.last_refill = time.monotonic()
+        self.condition = threading.Condition()
+
+    def _refill(self, now: float):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.available_requests = min(self.request_capacity, self.available_requests + elapsed * self.request_rate)
+        self.available_tokens = min(self.token_capacity, self.available_tokens + elapsed * self.token_rate)
+
+    def _wait_time(self, tokens: float, now: float) -> float:
+        # A single request larger than the whole bucket is admitted once the bucket is full
+        tokens = min(tokens, self.token_capacity)
+        wait = max(0.0, self.paused_until - now)
+        if self.available_requests < 1:
+            wait = max(wait, (1 - self.available_requests) / self.request_rate)
+        if self.available_tokens < tokens:
+            wait = max(wait, (tokens - self.available_tokens) / self.token_rate)
+        return wait
+
+    def acquire(self, tokens: int = 0):
+        """Block until one request costing `tokens` fits in both budgets, then reserve it"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_time(tokens, now)
+                if wait <= 0:
+                    self.available_requests -= 1
+                    self.available_tokens -= min(tokens, self.token_capacity)
+                    return
+                self.condition.wait(wait)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        """Return (or charge) the difference between the estimated and billed token count"""
+        with self.condition:
+            self.available_tokens = min(self.token_capacity, self.available_tokens + estimated_tokens - actual_tokens)
+            self.condition.notify_all()
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        """Tighten the local buckets to the budgets the API reports as remaining"""
+        remaining_requests = headers.get('x-ratelimit-remaining-requests')
+        remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+        with self.condition:
+            self._refill(time.monotonic())
+            if remaining_requests is not None and remaining_requests.isdigit():
+                self.available_requests = min(self.available_requests, float(remaining_requests))
+            if remaining_tokens is not None and remaining_tokens.isdigit():
+                self.available_tokens = min(self.available_tokens, float(remaining_tokens))
+
+            # Server exhausted a budget: hold everyone until it resets
+            reset = None
+            if remaining_requests == '0':
+                reset = parse_duration(headers.get('x-ratelimit-reset-requests'))
+            if remaining_tokens == '0':
+                reset = max(reset or 0, parse_duration(headers.get('x-ratelimit-reset-tokens')) or 0)
+            if reset:
+                self.paused_until = max(self.paused_until, time.monotonic() + reset)
+
+    def backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Compute a jittered backoff for `attempt` and pause all callers for that long"""
+        delay = parse_duration(retry_after)
+        if delay is None:
+            ceiling = min(self.max_backoff, self.initial_backoff * self.backoff_factor ** attempt)
+            delay = random.uniform(0, ceiling)  # Full jitter
+        else:
+            delay = min(self.max_backoff, delay + random.uniform(0, self.initial_backoff))
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        logger.info(f"Backing off for {delay:.2f} seconds (attempt {attempt + 1})")
+        return delay
+
+
+# Shared limiter for all chat-completion calls in this process
+rate_limiter = RateLimiter(
+    RATE_LIMIT,
+    TOKEN_RATE_LIMIT,
+    period=RATE_LIMIT_PERIOD,
+    initial_backoff=INITIAL_BACKOFF,
+    max_backoff=MAX_BACKOFF,
+    backoff_factor=BACKOFF_FACTOR,
+)
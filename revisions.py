@@ -0,0 +1,246 @@
+"""Page fingerprints and chunk results of processed documents, for incremental reprocessing.
+
+When a revision of a known document is uploaded (same name, or mostly the same pages), the
+pages are diffed against the stored fingerprints. Chunks whose pages are all unchanged
+reuse their stored result, and only runs of changed pages are re-chunked and sent to the LLM.
+Revisions are stored per owner, and an upload is only compared with the documents its owner can see.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from difflib import SequenceMatcher
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from config import REVISION_DB_PATH, REVISION_MATCH_THRESHOLD, REVISION_PEEK_PAGES
+from checklist import normalize
+from logger import main_logger as logger
+
+Page = Tuple[int, str]
+
+
+def page_fingerprint(text: str) -> str:
+    return hashlib.sha256(' '.join(text.split()).encode('utf-8')).hexdigest()
+
+
+EMPTY_PAGE = page_fingerprint('')  # blank pages never count as shared between documents
+
+
+def revision_key(owner_id: Optional[int], filename: str) -> str:
+    """Revisions are stored per document: a filename within its owner's documents"""
+    return f"{owner_id if owner_id is not None else ''}/{filename}"
+
+
+@dataclass
+class StoredChunk:
+    start: int  # first and last page, as positions in the document's page list
+    end: int
+    output: object
+
+
+@dataclass
+class Revision:
+    document_id: str
+    page_hashes: List[str]
+    chunks: List[StoredChunk]
+    checklist: Dict[str, List[str]]
+    prompt_version: str  # chunk results are only reused under the prompt that produced them
+
+    @property
+    def filename(self) -> str:
+        return self.document_id.split('/', 1)[-1]
+
+
+@dataclass
+class ReusePlan:
+    reused: List[StoredChunk] = field(default_factory=list)  # positions refer to the new page list
+    fresh_runs: List[List[Page]] = field(default_factory=list)  # changed pages to chunk and send
+
+
+class RevisionStore:
+    def __init__(self, path: str = REVISION_DB_PATH):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(revisions)')]
+        if columns and 'owner_id' not in columns:
+            # Revisions used to be keyed by bare filename, so their owners are unknown
+            logger.info("Dropping revisions stored without an owner")
+            self.db.executescript('DROP TABLE revisions; DROP TABLE IF EXISTS page_fingerprints;')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS revisions (
+                document_id TEXT PRIMARY KEY,
+                owner_id INTEGER,
+                page_hashes TEXT NOT NULL,
+                chunks TEXT NOT NULL,
+                checklist TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS page_fingerprints (
+                hash TEXT NOT NULL,
+                document_id TEXT NOT NULL,
+                PRIMARY KEY (hash, document_id)
+            );
+        ''')
+        self.db.commit()
+
+    def save(self, document_id: str, owner_id: Optional[int], page_hashes: List[str], chunks: List[StoredChunk],
+             checklist: Dict[str, List[str]], prompt_version: str):
+        rows = json.dumps([[chunk.start, chunk.end, chunk.output] for chunk in chunks])
+        with self.lock:
+            self.db.execute('DELETE FROM page_fingerprints WHERE document_id = ?', (document_id,))
+            self.db.execute(
+                'INSERT OR REPLACE INTO revisions '
+                '(document_id, owner_id, page_hashes, chunks, checklist, prompt_version, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (document_id, owner_id, json.dumps(page_hashes), rows, json.dumps(checklist), prompt_version, time.time()),
+            )
+            self.db.executemany(
+                'INSERT OR IGNORE INTO page_fingerprints (hash, document_id) VALUES (?, ?)',
+                [(page_hash, document_id) for page_hash in set(page_hashes) if page_hash != EMPTY_PAGE],
+            )
+            self.db.commit()
+
+    def get(self, document_id: str) -> Optional[Revision]:
+        with self.lock:
+            row = self.db.execute(
+                'SELECT page_hashes, chunks, checklist, prompt_version FROM revisions WHERE document_id = ?', (document_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        chunks = [StoredChunk(start, end, output) for start, end, output in json.loads(row[1])]
+        return Revision(document_id, json.loads(row[0]), chunks, json.loads(row[2]), row[3])
+
+    def remove(self, document_id: str):
+        with self.lock:
+            self.db.execute('DELETE FROM revisions WHERE document_id = ?', (document_id,))
+            self.db.execute('DELETE FROM page_fingerprints WHERE document_id = ?', (document_id,))
+            self.db.commit()
+
+    def candidates(self, page_hashes: List[str], owner_id: Optional[int]) -> List[str]:
+        """Documents visible to `owner_id` (theirs, or unowned) sharing at least one of the given (non-empty) pages"""
+        hashes = [page_hash for page_hash in set(page_hashes) if page_hash != EMPTY_PAGE]
+        if not hashes:
+            return []
+        placeholders = ','.join('?' * len(hashes))
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                f'SELECT DISTINCT f.document_id FROM page_fingerprints f JOIN revisions r ON r.document_id = f.document_id '
+                f'WHERE f.hash IN ({placeholders}) AND (r.owner_id = ? OR r.owner_id IS NULL)', hashes + [owner_id]
+            )]
+
+
+revision_store = RevisionStore()
+
+
+def _similarity(a: List[str], b: List[str]) -> float:
+    a, b = set(a) - {EMPTY_PAGE}, set(b) - {EMPTY_PAGE}
+    return len(a & b) / len(a | b) if a | b else 0.0
+
+
+def match_previous(document_id: str, pages: Iterable[Page],
+                   owner_id: Optional[int] = None) -> Tuple[Optional[Revision], Iterable[Page]]:
+    """The stored revision the upload with revision key `document_id` revises, if any, and the pages to process.
+
+    A name match within the owner's documents wins. Otherwise the first REVISION_PEEK_PAGES pages
+    are fingerprinted, and only if they occur in a document the owner can see are the remaining
+    pages read up front to compare the whole document; new documents keep streaming.
+    """
+    previous = revision_store.get(document_id)
+    if previous is not None:
+        return previous, pages
+
+    iterator = iter(pages)
+    peeked = [page for _, page in zip(range(REVISION_PEEK_PAGES), iterator)]
+    candidates = [name for name in revision_store.candidates([page_fingerprint(text) for _, text in peeked], owner_id)
+                  if name != document_id]
+    if not candidates:
+        return None, chain(peeked, iterator)
+
+    all_pages = peeked + list(iterator)
+    hashes = [page_fingerprint(text) for _, text in all_pages]
+    best, best_score = None, 0.0
+    for name in candidates:
+        revision = revision_store.get(name)
+        score = _similarity(hashes, revision.page_hashes) if revision else 0.0
+        if score > best_score:
+            best, best_score = revision, score
+    if best is not None and best_score >= REVISION_MATCH_THRESHOLD:
+        logger.info(f"Processing {document_id} as a revision of {best.document_id} ({best_score:.0%} of pages shared)")
+        return best, all_pages
+    return None, all_pages
+
+
+def plan_reuse(previous: Revision, pages: List[Page], prompt_version: str) -> ReusePlan:
+    """Split the new pages into reusable stored chunks and runs of pages to process again"""
+    if previous.prompt_version != prompt_version:
+        return ReusePlan(fresh_runs=[list(pages)] if pages else [])
+    hashes = [page_fingerprint(text) for _, text in pages]
+    old_to_new: Dict[int, int] = {}
+    matcher = SequenceMatcher(a=previous.page_hashes, b=hashes, autojunk=False)
+    for tag, old_start, old_end, new_start, _ in matcher.get_opcodes():
+        if tag == 'equal':
+            for offset in range(old_end - old_start):
+                old_to_new[old_start + offset] = new_start + offset
+
+    # A stored chunk is reusable when its pages are unchanged and still consecutive
+    reusable = []
+    for chunk in previous.chunks:
+        pages_unchanged = all(position in old_to_new for position in range(chunk.start, chunk.end + 1))
+        reusable.append(pages_unchanged and old_to_new[chunk.end] - old_to_new[chunk.start] == chunk.end - chunk.start)
+
+    # Pages of reused chunks are skipped, except pages shared with a chunk that is processed again
+    covered = set()
+    for chunk, reuse in zip(previous.chunks, reusable):
+        if reuse:
+            covered.update(range(chunk.start, chunk.end + 1))
+    for chunk, reuse in zip(previous.chunks, reusable):
+        if not reuse:
+            covered.difference_update(range(chunk.start, chunk.end + 1))
+    covered_new = {old_to_new[position] for position in covered}
+
+    plan = ReusePlan()
+    for chunk, reuse in zip(previous.chunks, reusable):
+        if reuse:
+            plan.reused.append(StoredChunk(old_to_new[chunk.start], old_to_new[chunk.end], chunk.output))
+    run: List[Page] = []
+    for position, page in enumerate(pages):
+        if position in covered_new:
+            if run:
+                plan.fresh_runs.append(run)
+                run = []
+        else:
+            run.append(page)
+    if run:
+        plan.fresh_runs.append(run)
+    logger.info(f"Revision of {previous.document_id}: reusing {len(plan.reused)} of {len(previous.chunks)} chunks, "
+                f"{sum(len(run) for run in plan.fresh_runs)} of {len(pages)} pages to process")
+    return plan
+
+
+def checklist_diff(old: Dict[str, List[str]], new: Dict[str, List[str]]) -> Dict[str, Dict[str, List[str]]]:
+    """Items added and removed between two checklists, by section"""
+    def keys(checklist):
+        return {normalize(item) for items in checklist.values() for item in items}
+
+    def missing(checklist, other_keys):
+        changes = {}
+        for section, items in checklist.items():
+            changed = [item for item in items if normalize(item) not in other_keys]
+            if changed:
+                changes[section] = changed
+        return changes
+
+    return {'added': missing(new, keys(old)), 'removed': missing(old, keys(new))}
+
+
+def fingerprinted(pages: Iterable[Page], page_hashes: List[str], positions: Dict[int, int]) -> Iterator[Page]:
+    """Pass pages through, recording each page's fingerprint and its position by page number"""
+    for page_number, text in pages:
+        positions[page_number] = len(page_hashes)
+        page_hashes.append(page_fingerprint(text))
+        yield page_number, text
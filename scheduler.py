@@ -0,0 +1,252 @@
+"""Fair chunk scheduling across the documents being processed in this process.
+
+Chunk requests from every document share CHUNK_CONCURRENCY slots. When a slot frees up it
+goes to the highest-priority document with a waiting chunk; among equal priorities, to the
+user who has been served the fewest tokens, then to that user's least-served document. A
+short upload therefore gets its chunks through while a long one is running, instead of
+waiting behind all of its chunks.
+
+Documents can carry a token budget (estimated prompt + completion tokens); a chunk that
+would exceed it raises TokenBudgetExceeded. Throughput over recently completed chunks is
+used to estimate when each document will finish.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, Optional
+from config import CHUNK_CONCURRENCY, SCHEDULER_THROUGHPUT_WINDOW
+
+
+class TokenBudgetExceeded(Exception):
+    """A document's chunks would use more tokens than its budget allows"""
+
+
+@dataclass
+class _Waiter:
+    tokens: int
+    wake: Callable[[], None]
+    granted: bool = False
+
+
+@dataclass
+class _Document:
+    document_id: Optional[str]
+    user_id: Optional[int] = None
+    priority: int = 0
+    token_budget: int = 0  # 0 = unlimited
+    pages_total: Optional[int] = None
+    pages_read: int = 0
+    chunked_tokens: int = 0  # all chunks created so far, for tokens per page
+    queued_tokens: int = 0  # chunks created but not finished
+    spent_tokens: int = 0  # chunks granted a slot
+    served: float = 0.0
+    waiters: Deque[_Waiter] = field(default_factory=deque)
+
+
+class ChunkScheduler:
+    def __init__(self, slots: int = CHUNK_CONCURRENCY, window: float = SCHEDULER_THROUGHPUT_WINDOW):
+        self.slots = slots
+        self.window = window
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.documents: Dict[Optional[str], _Document] = {}
+        self.user_served: Dict[Optional[int], float] = {}
+        self.completions: Deque = deque()  # (finished at, tokens)
+
+    # Document lifecycle
+
+    def begin(self, document_id: str, user_id: Optional[int] = None, priority: int = 0, token_budget: int = 0,
+              pages_total: Optional[int] = None):
+        """Start scheduling a document's chunks; `document_id` must be unique among active documents"""
+        with self.lock:
+            if document_id in self.documents:
+                # Replacing the entry would strand the chunks waiting on it
+                raise ValueError(f"Document {document_id} is already being scheduled")
+            # Newcomers start level with the least-served active peer, so they neither starve nor monopolize
+            peers = [doc.served for doc in self.documents.values() if doc.user_id == user_id]
+            document = _Document(document_id, user_id, priority, token_budget, pages_total,
+                                 served=min(peers) if peers else 0.0)
+            self.documents[document_id] = document
+            if user_id not in self.user_served:
+                self.user_served[user_id] = min(self.user_served.values(), default=0.0)
+
+    def end(self, document_id: str):
+        with self.lock:
+            document = self.documents.pop(document_id, None)
+            if document is not None and not any(doc.user_id == document.user_id for doc in self.documents.values()):
+                self.user_served.pop(document.user_id, None)
+
+    def _document(self, document_id: Optional[str]) -> _Document:
+        document = self.documents.get(document_id)
+        if document is None:
+            # Chunks of documents processed without begin() (e.g. benchmarks) share one default entry
+            document = self.documents.get(None)
+            if document is None:
+                document = self.documents[None] = _Document(None)
+                self.user_served.setdefault(None, min(self.user_served.values(), default=0.0))
+        return document
+
+    def page_read(self, document_id: str):
+        with self.lock:
+            if document_id in self.documents:
+                self.documents[document_id].pages_read += 1
+
+    def chunk_queued(self, document_id: Optional[str], tokens: int):
+        with self.lock:
+            document = self._document(document_id)
+            document.chunked_tokens += tokens
+            document.queued_tokens += tokens
+
+    def chunk_finished(self, document_id: Optional[str], tokens: int):
+        """A queued chunk completed, failed, was cancelled or came from the cache"""
+        with self.lock:
+            document = self._document(document_id)
+            document.queued_tokens = max(0, document.queued_tokens - tokens)
+
+    # Slots
+
+    def _enqueue(self, document_id: Optional[str], tokens: int, wake: Callable[[], None]) -> _Waiter:
+        with self.lock:
+            document = self._document(document_id)
+            if document.token_budget and document.spent_tokens + tokens > document.token_budget:
+                raise TokenBudgetExceeded(
+                    f"Document {document_id} would exceed its budget of {document.token_budget} tokens"
+                )
+            document.spent_tokens += tokens
+            waiter = _Waiter(tokens, wake)
+            document.waiters.append(waiter)
+            self._dispatch()
+        return waiter
+
+    def _dispatch(self):
+        while self.in_flight < self.slots:
+            ready = [document for document in self.documents.values() if document.waiters]
+            if not ready:
+                return
+            top = max(document.priority for document in ready)
+            ready = [document for document in ready if document.priority == top]
+            user_id = min({document.user_id for document in ready}, key=lambda user: self.user_served.get(user, 0.0))
+            document = min((doc for doc in ready if doc.user_id == user_id), key=lambda doc: doc.served)
+            waiter = document.waiters.popleft()
+            document.served += waiter.tokens
+            self.user_served[user_id] = self.user_served.get(user_id, 0.0) + waiter.tokens
+            self.in_flight += 1
+            waiter.granted = True
+            waiter.wake()
+
+    def _abandon(self, document_id: Optional[str], waiter: _Waiter):
+        with self.lock:
+            if waiter.granted:
+                self._release(waiter.tokens, completed=False)
+                return
+            document = self._document(document_id)
+            if waiter in document.waiters:
+                document.waiters.remove(waiter)
+                document.spent_tokens -= waiter.tokens
+
+    def _release(self, tokens: int, completed: bool = True):
+        self.in_flight -= 1
+        if completed:
+            self.completions.append((time.time(), tokens))
+        self._dispatch()
+
+    @contextmanager
+    def slot(self, document_id: Optional[str], tokens: int):
+        """Hold one of the shared request slots while a chunk is sent (including its retries)"""
+        event = threading.Event()
+        waiter = self._enqueue(document_id, tokens, event.set)
+        try:
+            event.wait()
+        except BaseException:
+            self._abandon(document_id, waiter)
+            raise
+        try:
+            yield
+        except BaseException:
+            with self.lock:
+                self._release(tokens, completed=False)
+            raise
+        with self.lock:
+            self._release(tokens)
+
+    @asynccontextmanager
+    async def slot_async(self, document_id: Optional[str], tokens: int):
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = self._enqueue(document_id, tokens, wake)
+        try:
+            await granted
+        except BaseException:
+            self._abandon(document_id, waiter)
+            raise
+        try:
+            yield
+        except BaseException:
+            with self.lock:
+                self._release(tokens, completed=False)
+            raise
+        with self.lock:
+            self._release(tokens)
+
+    # Estimates
+
+    def throughput(self) -> Optional[float]:
+        """Tokens per second over the chunks completed in the last `window` seconds"""
+        with self.lock:
+            return self._throughput(time.time())
+
+    def _throughput(self, now: float) -> Optional[float]:
+        while self.completions and self.completions[0][0] < now - self.window:
+            self.completions.popleft()
+        if len(self.completions) < 2:
+            return None
+        elapsed = now - self.completions[0][0]
+        return sum(tokens for _, tokens in self.completions) / max(elapsed, 1.0)
+
+    def _remaining(self, document: _Document) -> float:
+        remaining = float(document.queued_tokens)
+        if document.pages_total and document.pages_read:
+            unread = max(0, document.pages_total - document.pages_read)
+            remaining += unread * document.chunked_tokens / document.pages_read
+        return remaining
+
+    def eta(self, document_id: str) -> Optional[float]:
+        """Estimated seconds until the document's chunks are done, or None before there is throughput data.
+
+        Higher-priority work is assumed to go first, and documents of the same priority to share
+        the throughput equally per user and then per document.
+        """
+        with self.lock:
+            document = self.documents.get(document_id)
+            throughput = self._throughput(time.time())
+            if document is None or not throughput:
+                return None
+            remaining = self._remaining(document)
+            ahead = sum(self._remaining(doc) for doc in self.documents.values() if doc.priority > document.priority)
+            peers = [doc for doc in self.documents.values() if doc.priority == document.priority]
+            users = {doc.user_id for doc in peers}
+            own = sum(1 for doc in peers if doc.user_id == document.user_id)
+            # At its fair share, but never slower than finishing all same-priority work first
+            same_priority = sum(self._remaining(doc) for doc in peers)
+            return (ahead + min(remaining * len(users) * own, same_priority)) / throughput
+
+    def stats(self) -> Dict:
+        with self.lock:
+            throughput = self._throughput(time.time())
+            return {
+                'slots': self.slots,
+                'in_flight': self.in_flight,
+                'waiting': sum(len(document.waiters) for document in self.documents.values()),
+                'documents': len(self.documents),
+                'tokens_per_second': round(throughput, 1) if throughput else None,
+            }
+
+
+chunk_scheduler = ChunkScheduler()
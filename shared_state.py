@@ -0,0 +1,196 @@
+"""Locks, concurrency slots and small values shared by the web and worker processes.
+
+With SHARED_STATE_BACKEND='redis' they live in Redis (REDIS_URL), so the gunicorn workers and
+worker processes of one host coordinate through them. The deployment stays on one host: the
+job queue is a local SQLite file, and the request and token rate limits are kept per process.
+'memory' is an in-process stand-in with the same interface: correct for the threads of a
+single process, and used by tests and single-process deployments.
+"""
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+from config import (
+    SHARED_STATE_BACKEND,
+    REDIS_URL,
+    SHARED_STATE_PREFIX,
+    SHARED_LOCK_TIMEOUT,
+    SHARED_POLL_INTERVAL,
+    API_CONCURRENCY,
+    API_SLOT_LEASE_SECONDS,
+)
+from logger import main_logger as logger
+
+# Drops expired holders, then takes a slot if fewer than the limit are held; Redis server time avoids clock skew
+ACQUIRE_SLOT_SCRIPT = '''
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2])))
+return 1
+'''
+COUNT_SLOTS_SCRIPT = '''
+local now = redis.call('TIME')
+return redis.call('ZCOUNT', KEYS[1], tonumber(now[1]) + tonumber(now[2]) / 1000000, '+inf')
+'''
+
+
+class MemoryState:
+    """In-process stand-in for RedisState"""
+
+    def __init__(self):
+        self.guard = threading.Condition()
+        self.locks: Dict[str, List] = {}  # name -> [lock, holders and waiters], dropped when unused
+        self.slots: Dict[str, Dict[str, float]] = {}  # name -> token -> lease expiry
+        self.values: Dict[str, str] = {}
+
+    @contextmanager
+    def lock(self, name: str, timeout: float = SHARED_LOCK_TIMEOUT, blocking: bool = True):
+        """Hold the named lock; yields False instead of waiting if blocking=False and it is taken"""
+        with self.guard:
+            entry = self.locks.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            acquired = entry[0].acquire(blocking)
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    entry[0].release()
+        finally:
+            with self.guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[name]
+
+    def _held(self, name: str) -> Dict[str, float]:
+        now = time.time()
+        holders = self.slots.setdefault(name, {})
+        for token in [token for token, expires in holders.items() if expires <= now]:
+            del holders[token]
+        return holders
+
+    def acquire_slot(self, name: str, limit: int, lease: float) -> str:
+        with self.guard:
+            while True:
+                holders = self._held(name)
+                if len(holders) < limit:
+                    token = uuid.uuid4().hex
+                    holders[token] = time.time() + lease
+                    return token
+                # Woken by releases; the timeout also notices leases that expired
+                self.guard.wait(SHARED_POLL_INTERVAL)
+
+    def release_slot(self, name: str, token: str):
+        with self.guard:
+            self.slots.get(name, {}).pop(token, None)
+            self.guard.notify_all()
+
+    def slots_in_use(self, name: str) -> int:
+        with self.guard:
+            return len(self._held(name))
+
+    def get(self, name: str) -> Optional[str]:
+        with self.guard:
+            return self.values.get(name)
+
+    def set(self, name: str, value):
+        with self.guard:
+            self.values[name] = str(value)
+
+
+class RedisState:
+    """Locks, slots and values in Redis, shared by every process using the same REDIS_URL"""
+
+    def __init__(self, url: str = REDIS_URL, prefix: str = SHARED_STATE_PREFIX):
+        import redis
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.acquire_script = self.client.register_script(ACQUIRE_SLOT_SCRIPT)
+        self.count_script = self.client.register_script(COUNT_SLOTS_SCRIPT)
+
+    @contextmanager
+    def lock(self, name: str, timeout: float = SHARED_LOCK_TIMEOUT, blocking: bool = True):
+        # The lock expires after `timeout`, so a crashed holder cannot block everyone else
+        lock = self.client.lock(f'{self.prefix}lock:{name}', timeout=timeout, sleep=SHARED_POLL_INTERVAL)
+        acquired = lock.acquire(blocking=blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except Exception as e:
+                    logger.warning(f"Lock {name} expired before it was released: {str(e)}")
+
+    def acquire_slot(self, name: str, limit: int, lease: float) -> str:
+        token = uuid.uuid4().hex
+        key = f'{self.prefix}slots:{name}'
+        while not self.acquire_script(keys=[key], args=[limit, lease, token]):
+            time.sleep(SHARED_POLL_INTERVAL)
+        return token
+
+    def release_slot(self, name: str, token: str):
+        self.client.zrem(f'{self.prefix}slots:{name}', token)
+
+    def slots_in_use(self, name: str) -> int:
+        return int(self.count_script(keys=[f'{self.prefix}slots:{name}']))
+
+    def get(self, name: str) -> Optional[str]:
+        return self.client.get(f'{self.prefix}value:{name}')
+
+    def set(self, name: str, value):
+        self.client.set(f'{self.prefix}value:{name}', str(value))
+
+
+class SharedSemaphore:
+    """At most `limit` holders across every process sharing the state; 0 = unlimited.
+
+    A slot held by a process that died is freed after `lease` seconds.
+    """
+
+    def __init__(self, state, name: str, limit: int, lease: float):
+        self.state = state
+        self.name = name
+        self.limit = limit
+        self.lease = lease
+
+    def acquire(self) -> Optional[str]:
+        """Block until a slot is free and take it, returning the token to release it with"""
+        if not self.limit:
+            return None
+        return self.state.acquire_slot(self.name, self.limit, self.lease)
+
+    def release(self, token: Optional[str]):
+        if token is not None:
+            self.state.release_slot(self.name, token)
+
+    @contextmanager
+    def hold(self):
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def stats(self) -> Dict:
+        return {'limit': self.limit, 'in_use': self.state.slots_in_use(self.name) if self.limit else None}
+
+
+def create_shared_state(backend: str = SHARED_STATE_BACKEND):
+    if backend == 'redis':
+        return RedisState()
+    if backend == 'memory':
+        return MemoryState()
+    raise ValueError(f"Unknown shared state backend: {backend}")
+
+
+shared_state = create_shared_state()
+
+# OpenAI requests in flight from every web and worker process (chunk calls and chatbot completions)
+api_slots = SharedSemaphore(shared_state, 'openai-api', API_CONCURRENCY, API_SLOT_LEASE_SECONDS)
@@ -0,0 +1,88 @@
+"""Cold-start profile of a web worker.
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter with warm-up disabled,
+then reports the slowest top-level imports and, optionally, how long each lazily loaded
+component takes to warm. Results can be appended to a JSON-lines file to track over time.
+
+    python startup_profile.py [--top 20] [--warm] [--output startup_profile.jsonl]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int, int]]:
+    """(module, self_us, cumulative_us, depth) for each line of -X importtime output"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def profile_imports(module: str = 'app') -> Dict:
+    env = dict(os.environ, STARTUP_MODE='lazy')
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, env=env,
+    )
+    wall = time.perf_counter() - started
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{completed.stderr[-2000:]}")
+    rows = parse_importtime(completed.stderr)
+    # Depth 0 lines are the modules the worker imports directly (or is first to pull in)
+    top_level = sorted((row for row in rows if row[3] == 0), key=lambda row: row[2], reverse=True)
+    return {
+        'module': module,
+        'wall_seconds': round(wall, 3),
+        'import_seconds': round(sum(row[2] for row in rows if row[3] == 0) / 1e6, 3),
+        'slowest_imports': [
+            {'module': name, 'cumulative_ms': round(cumulative / 1000, 1), 'self_ms': round(self_us / 1000, 1)}
+            for name, self_us, cumulative, _ in top_level
+        ],
+    }
+
+
+def profile_warm_up() -> Dict[str, float]:
+    """Seconds spent loading each lazily initialised component, measured in this process"""
+    os.environ['STARTUP_MODE'] = 'lazy'
+    import app
+    return app.warm_up()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--warm', action='store_true', help='also time loading of lazy components')
+    parser.add_argument('--output', help='append the report as one JSON line to this file')
+    args = parser.parse_args()
+
+    report = profile_imports(args.module)
+    report['slowest_imports'] = report['slowest_imports'][:args.top]
+    if args.warm:
+        report['warm_up_seconds'] = profile_warm_up()
+    report['timestamp'] = time.time()
+
+    print(f"Importing {report['module']}: {report['import_seconds']:.3f}s "
+          f"(interpreter wall time {report['wall_seconds']:.3f}s)")
+    for row in report['slowest_imports']:
+        print(f"  {row['cumulative_ms']:>9.1f} ms  {row['module']}")
+    for name, seconds in report.get('warm_up_seconds', {}).items():
+        print(f"  warm {name}: {seconds:.3f}s")
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+
+if __name__ == '__main__':
+    main()
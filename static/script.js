@@ -60,6 +60,7 @@ document.addEventListener('DOMContentLoaded', function () {
     }
 
     pollDocumentStatus();
+    subscribeToProgress();
 });
 
 async function handleUpload(e) {
@@ -99,25 +100,38 @@ async function handleUpload(e) {
     }
 }
 
+let lastCompletedCount = -1;
+let pollTimer = null;
+
 async function pollDocumentStatus() {
     const pollInterval = 5000;
     const maxAttempts = 120;
     let attempts = 0;
 
+    if (pollTimer) {
+        clearTimeout(pollTimer);
+        pollTimer = null;
+    }
+
     const poll = async () => {
         try {
-            const response = await fetch('/get_checklists');
+            // Status-only polling; the browser revalidates with If-None-Match and reuses the cached body on 304
+            const response = await fetch('/get_checklists?status_only=1', { cache: 'no-cache' });
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
-            const result = await response.json();
+            const status = await response.json();
 
-            displayResults(result);
+            displayDocumentStatus(status);
+            if (status.completed !== lastCompletedCount) {
+                lastCompletedCount = status.completed;
+                await fetchResults();
+            }
 
-            if (result.completed < result.total_documents) {
+            if (status.completed < status.total_documents) {
                 attempts++;
                 if (attempts < maxAttempts) {
-                    setTimeout(poll, pollInterval);
+                    pollTimer = setTimeout(poll, pollInterval);
                 } else {
                     const messageElement = document.getElementById('message');
                     if (messageElement) {
@@ -133,15 +147,75 @@ async function pollDocumentStatus() {
     poll();
 }
 
+async function fetchResults() {
+    const response = await fetch('/get_checklists', { cache: 'no-cache' });
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    displayResults(await response.json());
+}
+
+function subscribeToProgress() {
+    if (!window.EventSource || !document.getElementById('document-status')) return;
+
+    const source = new EventSource('/events');
+    source.addEventListener('chunk', (event) => {
+        const data = JSON.parse(event.data);
+        showChunkProgress(data);
+    });
+    source.addEventListener('document', (event) => {
+        const data = JSON.parse(event.data);
+        if (data.status === 'Completed' || data.status === 'Failed') {
+            pollDocumentStatus();
+        }
+    });
+}
+
+function showChunkProgress(data) {
+    const statusContainer = document.getElementById('document-status');
+    if (!statusContainer) return;
+
+    let element = statusContainer.querySelector(`[data-filename="${CSS.escape(data.document)}"]`);
+    if (!element) {
+        element = createStatusElement(data.document, 'processing', 'Processing');
+        statusContainer.appendChild(element);
+        statusContainer.classList.remove('hidden');
+    }
+
+    const statusText = element.querySelector('p');
+    statusText.textContent = `Processing: ${data.completed} of ${data.submitted} sections done`;
+
+    let partial = element.querySelector('pre.partial-checklist');
+    if (!partial) {
+        partial = document.createElement('pre');
+        partial.className = 'partial-checklist';
+        element.appendChild(partial);
+    }
+    partial.textContent += `${formatChecklistSections(data.section)}\n`;
+}
+
+// Chunk outputs are structured ({sections: [{title, items}]}) or markdown text
+function formatChecklistSections(output) {
+    if (typeof output === 'string') return output;
+    return (output.sections || [])
+        .map(section => `${section.title}:\n` + section.items.map(item => `- ${item}`).join('\n'))
+        .join('\n\n');
+}
+
 function displayResults(result) {
     const resultContainer = document.getElementById('result-container');
     if (!resultContainer) return;
+    if (Object.keys(result.results).length === 0) return;
 
     let textOutput = '';
     for (const [filename, data] of Object.entries(result.results)) {
-        textOutput += `Filename: ${filename}\n`;
-        for (const [key, value] of Object.entries(data)) {
-            textOutput += `  ${key}: ${value}\n`;
+        textOutput += `Filename: ${filename} (${data.item_count} items from ${data.chunk_count} sections)\n`;
+        for (const [section, items] of Object.entries(data.checklist || {})) {
+            textOutput += `  ${section}:\n`;
+            items.forEach(item => { textOutput += `    - ${item}\n`; });
+        }
+        if (data.compliance_info) {
+            textOutput += `${data.compliance_info}\n`;
         }
         textOutput += '\n';
     }
@@ -152,17 +226,25 @@ function displayResults(result) {
     resultContainer.appendChild(textContainer);
 
     resultContainer.classList.remove('hidden');
-    displayDocumentStatus(result);
 }
 
 function displayDocumentStatus(result) {
     const statusContainer = document.getElementById('document-status');
     if (!statusContainer) return;
 
+    // Keep partial checklist sections streamed in by showChunkProgress
+    const partials = {};
+    statusContainer.querySelectorAll('.status-item').forEach(element => {
+        const partial = element.querySelector('pre.partial-checklist');
+        if (partial) partials[element.dataset.filename] = partial;
+    });
+
     statusContainer.innerHTML = '';
 
+    const eta = result.eta || {};
     for (const [filename, status] of Object.entries(result.processing)) {
-        const processingElement = createStatusElement(filename, 'processing', status);
+        const processingElement = createStatusElement(filename, 'processing', formatEta(status, eta[filename]));
+        if (partials[filename]) processingElement.appendChild(partials[filename]);
         statusContainer.appendChild(processingElement);
     }
 
@@ -174,9 +256,16 @@ function displayDocumentStatus(result) {
     statusContainer.classList.remove('hidden');
 }
 
+function formatEta(status, etaAt) {
+    if (!etaAt) return status;
+    const minutes = Math.max(1, Math.round((etaAt * 1000 - Date.now()) / 60000));
+    return `${status} (about ${minutes} min left)`;
+}
+
 function createStatusElement(filename, status, content) {
     const element = document.createElement('div');
     element.className = `status-item ${status}`;
+    element.dataset.filename = filename;
 
     const header = document.createElement('h3');
     header.textContent = filename;
@@ -275,20 +364,51 @@ async function sendMessageToBackend(message) {
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ message: message }),
+            body: JSON.stringify({ message: message, stream: true }),
         });
-        const data = await response.json();
-        if (response.ok) {
-            if (data.response) {
-                addMessageToChat('Chatbot', data.response);
-            } else {
-                addMessageToChat('Chatbot', 'I\'m sorry, I couldn\'t find any relevant information. Can you please rephrase your question?');
-            }
-        } else {
+        if (!response.ok) {
+            const data = await response.json();
             throw new Error(data.error || 'An error occurred');
         }
+        const answerElement = startChatAnswer('Chatbot');
+        // One JSON object per line: {delta} as tokens arrive, then {done} or {error}
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            for (const line of lines) {
+                if (!line.trim()) continue;
+                const event = JSON.parse(line);
+                if (event.delta) {
+                    answerElement.textContent += event.delta;
+                } else if (event.error) {
+                    answerElement.textContent += ` (${event.error})`;
+                }
+            }
+            const chatMessages = document.getElementById('chat-messages');
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        }
+        if (!answerElement.textContent) {
+            answerElement.textContent = 'I\'m sorry, I couldn\'t find any relevant information. Can you please rephrase your question?';
+        }
     } catch (error) {
         console.error('Error sending message to backend:', error);
         addMessageToChat('Chatbot', 'Sorry, an error occurred. Please try again.');
     }
-}
\ No newline at end of file
+}
+
+function startChatAnswer(sender) {
+    const chatMessages = document.getElementById('chat-messages');
+    const messageElement = document.createElement('div');
+    messageElement.className = 'chat-message';
+    messageElement.innerHTML = `<strong>${sender}:</strong> `;
+    const answerElement = document.createElement('span');
+    messageElement.appendChild(answerElement);
+    chatMessages.appendChild(messageElement);
+    return answerElement;
+}
@@ -0,0 +1,24 @@
+import os
+import sys
+import tempfile
+
+# config reads the environment at import, so point every store at a scratch directory first
+_workdir = tempfile.mkdtemp(prefix='checklist-tests-')
+os.makedirs(os.path.join(_workdir, 'uploads'))
+os.environ.update(
+    OPENAI_API_KEY='test',
+    SECRET_KEY='test',
+    STARTUP_MODE='lazy',
+    PROCESSING_WORKER_MODE='external',  # uploads are only queued
+    SHARED_STATE_BACKEND='memory',
+    DATABASE_URL=f"sqlite:///{os.path.join(_workdir, 'documents.db')}",
+    JOB_QUEUE_DB_PATH=os.path.join(_workdir, 'job_queue.db'),
+    USAGE_METRICS_DB_PATH=os.path.join(_workdir, 'usage_metrics.db'),
+    ANSWER_CACHE_DB_PATH=os.path.join(_workdir, 'answer_cache.db'),
+    REVISION_DB_PATH=os.path.join(_workdir, 'revisions.db'),
+    VECTOR_STORE_PATH=os.path.join(_workdir, 'faiss_index'),
+    UPLOAD_FOLDER=os.path.join(_workdir, 'uploads'),
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Logs and the LLM response cache are written relative to the working directory
+os.chdir(_workdir)
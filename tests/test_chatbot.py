@@ -0,0 +1,28 @@
+import numpy as np
+from chatbot import AnswerCache
+from lexical_index import BM25Index
+
+
+def unit(values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_cached_answers_are_only_served_within_their_scope(tmp_path):
+    cache = AnswerCache(str(tmp_path / 'answers.db'))
+    question = unit([1, 0, 0])
+    cache.store('What must be reported?', question, "Alice's answer", 'v1', 'alice-documents')
+
+    assert cache.lookup(question, 'v1', 'alice-documents') == "Alice's answer"
+    assert cache.lookup(question, 'v1', 'bob-documents') is None
+    # Another process sees the same entries
+    assert AnswerCache(str(tmp_path / 'answers.db')).lookup(question, 'v1', 'alice-documents') == "Alice's answer"
+
+
+def test_lexical_search_is_limited_to_allowed_passages():
+    index = BM25Index()
+    index.add(1, 'SEBI/HO/MRD/2023/12 reporting duties')
+    index.add(2, 'SEBI/HO/MRD/2023/12 retention duties')
+
+    assert {passage_id for passage_id, _ in index.search('SEBI/HO/MRD/2023/12', 5)} == {1, 2}
+    assert [passage_id for passage_id, _ in index.search('SEBI/HO/MRD/2023/12', 5, allowed={2})] == [2]
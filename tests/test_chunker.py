@@ -0,0 +1,30 @@
+import random
+import pytest
+import chunker
+
+
+@pytest.fixture
+def estimated_tokens(monkeypatch):
+    # The length-based estimate used when tiktoken's BPE file cannot be loaded
+    monkeypatch.setattr(chunker, '_encoding', False)
+
+
+@pytest.mark.parametrize('budget', [50, 100, 1000])
+def test_estimated_chunks_stay_within_the_budget(estimated_tokens, budget):
+    rng = random.Random(budget)
+    words = ['compliance', 'report', 'shall', 'the', 'entity', 'within', 'days', 'SEBI/HO/MRD/2023/12', 'x' * 900]
+    pages = [
+        (number, '\n'.join(
+            'SECTION %d' % line if line % 7 == 0
+            else ' '.join(' '.join(rng.choice(words) for _ in range(rng.randint(3, 400))) + '.' for _ in range(3))
+            for line in range(20)
+        ))
+        for number in range(1, 6)
+    ]
+
+    chunks = list(chunker.chunk_pages(pages, budget, overlap_tokens=budget // 4))
+
+    assert chunks
+    for chunk in chunks:
+        assert chunk.token_count <= budget
+        assert chunker.count_tokens(chunk.text) == chunk.token_count
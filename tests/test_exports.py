@@ -0,0 +1,13 @@
+import io
+import zipfile
+from exports import stream_zip
+
+
+def test_zip_members_are_unique_for_documents_with_the_same_name():
+    result = {'checklist': {'Reporting': ['File the quarterly report']}}
+    documents = [('policy.pdf', result), ('policy.pdf', result), ('POLICY.pdf', result)]
+
+    with zipfile.ZipFile(io.BytesIO(b''.join(stream_zip(documents)))) as archive:
+        names = archive.namelist()
+
+    assert names == ['policy.pdf_result.csv', 'policy.pdf_result~2.csv', 'POLICY.pdf_result~3.csv']
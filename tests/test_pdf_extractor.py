@@ -0,0 +1,12 @@
+import pytest
+from pdf_extractor import BACKENDS, extract_text, iter_pages, page_count
+
+
+@pytest.mark.parametrize('backend', sorted(BACKENDS))
+def test_empty_file_has_no_pages(tmp_path, backend):
+    path = tmp_path / 'empty.pdf'
+    path.write_bytes(b'')
+
+    assert page_count(str(path), backend) == 0
+    assert list(iter_pages(str(path), backend)) == []
+    assert extract_text(str(path), backend) == ''
@@ -0,0 +1,71 @@
+import threading
+import pytest
+from scheduler import ChunkScheduler
+
+
+def hold(scheduler, document_id, started, release):
+    with scheduler.slot(document_id, 10):
+        started.set()
+        release.wait(5)
+
+
+def test_same_named_documents_are_scheduled_by_job_key():
+    scheduler = ChunkScheduler(slots=1)
+    # Two owners' policy.pdf uploads, with different content hashes
+    scheduler.begin('hash-alice', user_id=1)
+    scheduler.begin('hash-bob', user_id=2)
+
+    events = {name: (threading.Event(), threading.Event()) for name in ('a1', 'a2', 'b1')}
+    threads = {
+        name: threading.Thread(target=hold, args=(scheduler, document_id, *events[name]))
+        for name, document_id in (('a1', 'hash-alice'), ('a2', 'hash-alice'), ('b1', 'hash-bob'))
+    }
+    threads['a1'].start()
+    assert events['a1'][0].wait(5)
+    threads['a2'].start()
+    threads['b1'].start()
+    for _ in range(100):
+        if scheduler.stats()['waiting'] == 2:
+            break
+        threading.Event().wait(0.01)
+    assert scheduler.stats() | {'tokens_per_second': None} == {
+        'slots': 1, 'in_flight': 1, 'waiting': 2, 'documents': 2, 'tokens_per_second': None,
+    }
+
+    # Every waiting chunk is dispatched as slots free up
+    for name in ('a1', 'b1', 'a2'):
+        assert events[name][0].wait(5)
+        events[name][1].set()
+        threads[name].join(5)
+    assert scheduler.stats()['in_flight'] == 0
+    assert scheduler.stats()['waiting'] == 0
+
+
+def test_begin_rejects_a_document_already_scheduled():
+    scheduler = ChunkScheduler(slots=1)
+    scheduler.begin('hash-alice', user_id=1)
+    started, release = threading.Event(), threading.Event()
+    waiting_started, waiting_release = threading.Event(), threading.Event()
+    first = threading.Thread(target=hold, args=(scheduler, 'hash-alice', started, release))
+    first.start()
+    assert started.wait(5)
+    waiting = threading.Thread(target=hold, args=(scheduler, 'hash-alice', waiting_started, waiting_release))
+    waiting.start()
+    for _ in range(100):
+        if scheduler.stats()['waiting'] == 1:
+            break
+        threading.Event().wait(0.01)
+
+    with pytest.raises(ValueError):
+        scheduler.begin('hash-alice', user_id=1)
+
+    # The chunk already waiting still gets the slot
+    release.set()
+    assert waiting_started.wait(5)
+    waiting_release.set()
+    first.join(5)
+    waiting.join(5)
+    scheduler.end('hash-alice')
+    assert scheduler.stats() | {'tokens_per_second': None} == {
+        'slots': 1, 'in_flight': 0, 'waiting': 0, 'documents': 0, 'tokens_per_second': None,
+    }
@@ -0,0 +1,92 @@
+import io
+import pytest
+import app as web
+
+
+def login(username):
+    client = web.app.test_client()
+    client.post('/register', data={'username': username, 'password': username})
+    client.post('/login', data={'username': username, 'password': username})
+    return client
+
+
+def upload(client, filename, content):
+    response = client.post('/upload', data={'files': (io.BytesIO(content), filename)},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+
+
+def listed(client):
+    status = client.get('/get_checklists?status_only=1').get_json()
+    return status['total_documents'], set(status['processing'])
+
+
+@pytest.fixture
+def users():
+    return login('alice'), login('bob')
+
+
+def test_same_filename_from_two_users_keeps_both_documents(users):
+    alice, bob = users
+    upload(alice, 'policy.pdf', b'%PDF-1.4 alice policy')
+    upload(bob, 'policy.pdf', b'%PDF-1.4 bob policy')
+
+    assert listed(alice) == (1, {'policy.pdf'})
+    assert listed(bob) == (1, {'policy.pdf'})
+    with web.app.app_context():
+        documents = web.Document.query.filter_by(filename='policy.pdf').all()
+        assert len({document.owner_id for document in documents}) == 2
+        assert len({document.content_hash for document in documents}) == 2
+        for document in documents:
+            assert web.processing_queue.find(document.job_key) is not None
+
+    # Deleting one user's document leaves the other's document and job alone
+    bob.post('/delete_document/policy.pdf')
+    assert listed(bob) == (0, set())
+    assert listed(alice) == (1, {'policy.pdf'})
+    with web.app.app_context():
+        document = web.Document.query.filter_by(filename='policy.pdf').one()
+        assert web.processing_queue.find(document.job_key) is not None
+
+
+def test_same_filename_from_two_users_keeps_revisions_and_processing_apart(users, monkeypatch):
+    import worker
+    from pdf_processor import CHUNK_PROMPT_KEY
+    from revisions import StoredChunk, page_fingerprint, revision_key, revision_store
+
+    alice, bob = users
+    upload(alice, 'manual.pdf', b'%PDF-1.4 alice manual')
+    upload(bob, 'manual.pdf', b'%PDF-1.4 bob manual')
+    with web.app.app_context():
+        documents = {web.db.session.get(web.User, document.owner_id).username: document
+                     for document in web.Document.query.filter_by(filename='manual.pdf')}
+        alice_id, bob_id = documents['alice'].owner_id, documents['bob'].owner_id
+        bob_job = web.processing_queue.find(documents['bob'].job_key)
+
+    # Alice's manual was processed earlier; Bob's has the same pages
+    pages = [(1, 'Scope of the policy'), (2, 'Reporting duties')]
+    revision_store.save(revision_key(alice_id, 'manual.pdf'), alice_id, [page_fingerprint(text) for _, text in pages],
+                        [StoredChunk(0, 1, 'alice output')], {'Duties': ['Alice item']}, CHUNK_PROMPT_KEY)
+
+    processed = {}
+    def process_pdf(pages, **kwargs):
+        processed.update(kwargs, pages=list(pages))
+        return {'checklist': {}, 'chunk_count': 0, 'item_count': 0}
+    monkeypatch.setattr(worker, 'iter_pdf_pages', lambda path: iter(pages))
+    monkeypatch.setattr(worker, 'page_count', lambda path: len(pages))
+    monkeypatch.setattr(worker, 'process_pdf', process_pdf)
+    monkeypatch.setattr(worker, 'initialize_rag_system', lambda documents: None)
+    worker.process_document(bob_job)
+
+    # Bob's upload is processed under its own job, and never as a revision of Alice's document
+    assert processed['previous'] is None
+    assert processed['document_id'] == bob_job['document_id']
+    assert processed['revision_key'] == revision_key(bob_id, 'manual.pdf')
+    assert processed['owner_id'] == bob_id
+
+    # Deleting Bob's document cancels only Bob's job and keeps Alice's revision history
+    cancelled = []
+    monkeypatch.setattr(web, 'cancel_document', cancelled.append)
+    bob.post('/delete_document/manual.pdf')
+    assert cancelled == [bob_job['document_id']]
+    assert revision_store.get(revision_key(alice_id, 'manual.pdf')) is not None
@@ -0,0 +1,45 @@
+"""Content-addressed storage for uploaded PDFs.
+
+Files are stored as `<sha256>.pdf`, so identical uploads share one file (and one processing
+job) whatever they are called, and uploads with the same name never overwrite each other.
+An upload is received (and hashed) first and kept under its hash later, so the caller can
+hold a lock on the content while it is placed.
+"""
+import hashlib
+import os
+import tempfile
+from typing import BinaryIO, Tuple
+
+READ_SIZE = 1024 * 1024
+
+
+def upload_path(folder: str, content_hash: str) -> str:
+    return os.path.join(folder, f'{content_hash}.pdf')
+
+
+def receive_upload(stream: BinaryIO, folder: str) -> Tuple[str, str]:
+    """Write an upload to a temporary file in `folder`, hashing while writing; returns (content_hash, temp_path)"""
+    digest = hashlib.sha256()
+    handle, temp_path = tempfile.mkstemp(dir=folder, suffix='.upload')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            while True:
+                data = stream.read(READ_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                f.write(data)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return digest.hexdigest(), temp_path
+
+
+def keep_upload(temp_path: str, folder: str, content_hash: str) -> str:
+    """Move a received upload to its content-addressed path, or drop it if that content is already stored"""
+    path = upload_path(folder, content_hash)
+    if os.path.exists(path):
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, path)
+    return path
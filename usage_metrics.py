@@ -0,0 +1,227 @@
+"""Rolling OpenAI usage metrics.
+
+Every API call (or cache hit standing in for one) is added to per-minute and per-hour
+buckets plus all-time totals in SQLite, so windowed usage queries read a bounded number
+of rows however long the app has been running. All-time totals are kept per endpoint and
+model; per-document totals live in a separate table that is only read on request.
+
+    python usage_metrics.py import api_usage.log
+"""
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, Optional
+from config import USAGE_METRICS_DB_PATH, API_USAGE_LOG_PATH
+from logger import main_logger as logger
+
+MINUTE = 60
+HOUR = 3600
+# Buckets older than this are pruned, per resolution
+RETENTION = {MINUTE: 2 * HOUR, HOUR: 90 * 24 * HOUR}
+WINDOWS = {'hour': (MINUTE, HOUR), 'day': (HOUR, 24 * HOUR)}
+
+COUNTERS = ('calls', 'errors', 'cache_hits', 'prompt_tokens', 'completion_tokens', 'latency_ms')
+
+
+class UsageMetrics:
+    def __init__(self, path: str = USAGE_METRICS_DB_PATH):
+        self.lock = threading.Lock()
+        self.last_pruned = 0.0
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+        counters = ', '.join(f'{name} REAL NOT NULL DEFAULT 0' for name in COUNTERS)
+        legacy = self._uses_legacy_totals()
+        if legacy:
+            self.db.execute('ALTER TABLE usage_totals RENAME TO usage_totals_legacy')
+        self.db.executescript(f'''
+            CREATE TABLE IF NOT EXISTS usage_buckets (
+                resolution INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                endpoint TEXT NOT NULL,
+                model TEXT NOT NULL,
+                document_id TEXT NOT NULL,
+                {counters},
+                PRIMARY KEY (resolution, bucket, endpoint, model, document_id)
+            );
+            CREATE TABLE IF NOT EXISTS usage_totals (
+                endpoint TEXT NOT NULL,
+                model TEXT NOT NULL,
+                {counters},
+                first_call REAL,
+                last_call REAL,
+                PRIMARY KEY (endpoint, model)
+            );
+            CREATE TABLE IF NOT EXISTS document_totals (
+                document_id TEXT NOT NULL,
+                endpoint TEXT NOT NULL,
+                model TEXT NOT NULL,
+                {counters},
+                PRIMARY KEY (document_id, endpoint, model)
+            );
+            CREATE TABLE IF NOT EXISTS usage_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+        if legacy:
+            self._migrate_legacy_totals()
+        self.db.commit()
+
+    def _uses_legacy_totals(self) -> bool:
+        # All-time totals used to be kept per document, which made every scrape scan all documents
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(usage_totals)')]
+        return 'document_id' in columns
+
+    def _migrate_legacy_totals(self):
+        columns = ', '.join(COUNTERS)
+        sums = ', '.join(f'SUM({name})' for name in COUNTERS)
+        self.db.execute(
+            f'INSERT INTO usage_totals (endpoint, model, {columns}, first_call, last_call) '
+            f'SELECT endpoint, model, {sums}, MIN(first_call), MAX(last_call) '
+            f'FROM usage_totals_legacy GROUP BY endpoint, model'
+        )
+        self.db.execute(
+            f'INSERT INTO document_totals (document_id, endpoint, model, {columns}) '
+            f"SELECT document_id, endpoint, model, {columns} FROM usage_totals_legacy WHERE document_id != ''"
+        )
+        self.db.execute('DROP TABLE usage_totals_legacy')
+
+    def _add(self, timestamp: float, endpoint: str, model: str, document_id: str, values: Dict[str, float]):
+        columns = ', '.join(COUNTERS)
+        placeholders = ', '.join('?' * len(COUNTERS))
+        increments = ', '.join(f'{name} = {name} + excluded.{name}' for name in COUNTERS)
+        counts = [values.get(name, 0) for name in COUNTERS]
+        for resolution in (MINUTE, HOUR):
+            self.db.execute(
+                f'INSERT INTO usage_buckets (resolution, bucket, endpoint, model, document_id, {columns}) '
+                f'VALUES (?, ?, ?, ?, ?, {placeholders}) '
+                f'ON CONFLICT (resolution, bucket, endpoint, model, document_id) DO UPDATE SET {increments}',
+                [resolution, int(timestamp // resolution) * resolution, endpoint, model, document_id] + counts,
+            )
+        self.db.execute(
+            f'INSERT INTO usage_totals (endpoint, model, {columns}, first_call, last_call) '
+            f'VALUES (?, ?, {placeholders}, ?, ?) '
+            f'ON CONFLICT (endpoint, model) DO UPDATE SET {increments}, '
+            f'first_call = MIN(first_call, excluded.first_call), last_call = MAX(last_call, excluded.last_call)',
+            [endpoint, model] + counts + [timestamp, timestamp],
+        )
+        if document_id:
+            self.db.execute(
+                f'INSERT INTO document_totals (document_id, endpoint, model, {columns}) '
+                f'VALUES (?, ?, ?, {placeholders}) '
+                f'ON CONFLICT (document_id, endpoint, model) DO UPDATE SET {increments}',
+                [document_id, endpoint, model] + counts,
+            )
+
+    def record(self, endpoint: str, model: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+               latency: float = 0.0, status: int = 200, cache_hit: bool = False,
+               document_id: Optional[str] = None, timestamp: Optional[float] = None):
+        timestamp = timestamp or time.time()
+        values = {
+            'calls': 1,
+            'errors': 0 if 200 <= status < 300 else 1,
+            'cache_hits': 1 if cache_hit else 0,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'latency_ms': latency * 1000,
+        }
+        try:
+            with self.lock:
+                self._add(timestamp, endpoint, model, document_id or '', values)
+                self._prune(timestamp)
+                self.db.commit()
+        except sqlite3.Error as e:
+            # Metrics must never break the call being measured
+            logger.error(f"Error recording API usage: {str(e)}")
+
+    def _prune(self, now: float):
+        if now - self.last_pruned < 300:
+            return
+        for resolution, retention in RETENTION.items():
+            self.db.execute('DELETE FROM usage_buckets WHERE resolution = ? AND bucket < ?', (resolution, now - retention))
+        self.last_pruned = now
+
+    def _summarize(self, table: str, where: str, params: list, group_by: str) -> Dict[str, Dict]:
+        sums = ', '.join(f'SUM({name})' for name in COUNTERS)
+        with self.lock:
+            rows = self.db.execute(f'SELECT {group_by}, {sums} FROM {table} WHERE {where} GROUP BY {group_by}', params).fetchall()
+        summary = {}
+        for row in rows:
+            values = dict(zip(COUNTERS, row[1:]))
+            values['avg_latency_ms'] = round(values['latency_ms'] / values['calls'], 1) if values['calls'] else 0.0
+            del values['latency_ms']
+            summary[row[0]] = {name: int(value) if name != 'avg_latency_ms' else value for name, value in values.items()}
+        return summary
+
+    def window(self, window: str = 'hour', group_by: str = 'endpoint', model: Optional[str] = None,
+               document_id: Optional[str] = None) -> Dict[str, Dict]:
+        """Usage over the last hour or day, grouped by endpoint, model or document"""
+        if window not in WINDOWS:
+            raise ValueError(f"Unknown window: {window}")
+        if group_by not in ('endpoint', 'model', 'document_id'):
+            raise ValueError(f"Cannot group usage by: {group_by}")
+        resolution, span = WINDOWS[window]
+        now = time.time()
+        where, params = 'resolution = ? AND bucket > ?', [resolution, now - span - resolution]
+        if model:
+            where, params = where + ' AND model = ?', params + [model]
+        if document_id:
+            where, params = where + ' AND document_id = ?', params + [document_id]
+        return self._summarize('usage_buckets', where, params, group_by)
+
+    def totals(self, group_by: str = 'endpoint') -> Dict[str, Dict]:
+        """All-time usage by endpoint or model; one row per endpoint and model, however many documents"""
+        if group_by not in ('endpoint', 'model'):
+            raise ValueError(f"Cannot group usage totals by: {group_by}")
+        return self._summarize('usage_totals', '1 = 1', [], group_by)
+
+    def document_totals(self, document_id: str, group_by: str = 'endpoint') -> Dict[str, Dict]:
+        """All-time usage of one document, grouped by endpoint or model"""
+        if group_by not in ('endpoint', 'model'):
+            raise ValueError(f"Cannot group usage totals by: {group_by}")
+        return self._summarize('document_totals', 'document_id = ?', [document_id], group_by)
+
+    def call_range(self):
+        with self.lock:
+            return self.db.execute('SELECT MIN(first_call), MAX(last_call) FROM usage_totals').fetchone()
+
+    def import_csv_log(self, path: str = API_USAGE_LOG_PATH) -> int:
+        """One-time import of the legacy `timestamp,api_name` log; later calls are no-ops"""
+        key = f'imported:{path}'
+        with self.lock:
+            if self.db.execute('SELECT 1 FROM usage_meta WHERE key = ?', (key,)).fetchone():
+                return 0
+        imported = 0
+        try:
+            with open(path, 'r') as f, self.lock:
+                for line in f:
+                    try:
+                        timestamp, api_name = line.strip().split(',')
+                        timestamp = float(timestamp)
+                    except ValueError:
+                        continue
+                    self._add(timestamp, api_name, 'unknown', '', {'calls': 1})
+                    imported += 1
+                self.db.execute('INSERT INTO usage_meta (key, value) VALUES (?, ?)', (key, str(imported)))
+                self.db.commit()
+        except FileNotFoundError:
+            return 0
+        logger.info(f"Imported {imported} API calls from {path}")
+        return imported
+
+
+usage_metrics = UsageMetrics()
+
+
+def record_api_call(endpoint: str, model: str, **kwargs):
+    usage_metrics.record(endpoint, model, **kwargs)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'import':
+        path = sys.argv[2] if len(sys.argv) > 2 else API_USAGE_LOG_PATH
+        print(f"Imported {usage_metrics.import_csv_log(path)} calls from {path}")
+    else:
+        print(__doc__)
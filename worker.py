@@ -0,0 +1,150 @@
+"""Document processing workers draining the durable job queue.
+
+Workers run as threads inside the web app (PROCESSING_WORKER_MODE='thread') or as separate
+processes started with:
+
+    python worker.py --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from typing import Dict, Optional
+from config import PROCESSING_WORKERS, JOB_LEASE_SECONDS, DOCUMENT_TOKEN_BUDGET, ETA_UPDATE_INTERVAL
+from instrumentation import profiled, workers_busy, workers_total
+from job_queue import JobQueue
+from logger import main_logger as logger
+from pdf_extractor import page_count
+from pdf_processor import process_pdf, iter_pdf_pages
+from rag_system import initialize_rag_system
+from revisions import match_previous, revision_key
+from scheduler import chunk_scheduler, TokenBudgetExceeded
+
+
+def process_document(job: Dict, job_queue: Optional[JobQueue] = None) -> Dict:
+    payload = job['payload']
+    filename = payload['filename']
+    owner_id = payload.get('user_id')
+    # Content hash, shared by every document uploaded with this content
+    document_id = job['document_id']
+
+    def on_progress(index, output, completed, submitted):
+        # Partial checklist sections are streamed to the browser as chunks finish
+        if job_queue is not None:
+            job_queue.add_event(document_id, 'chunk', {
+                'index': index,
+                'completed': completed,
+                'submitted': submitted,
+                'section': output,
+            })
+
+    # Stream pages into the chunker, keeping the text for the RAG index
+    page_texts = []
+    def pages():
+        for page_number, page_text in iter_pdf_pages(payload['path']):
+            page_texts.append(page_text)
+            chunk_scheduler.page_read(document_id)
+            yield page_number, page_text
+
+    # Chunk requests are scheduled fairly against other documents, within the document's token budget.
+    # Filenames are only unique per owner, so processing is keyed by the job's content hash.
+    chunk_scheduler.begin(
+        document_id, owner_id, job['priority'],
+        payload.get('token_budget', DOCUMENT_TOKEN_BUDGET), page_count(payload['path']),
+    )
+    try:
+        # A revision of one of the owner's documents only sends its changed pages to the LLM
+        key = revision_key(owner_id, filename)
+        previous, document_pages = match_previous(key, pages(), owner_id)
+        result = process_pdf(document_pages, document_id=document_id, on_progress=on_progress, previous=previous,
+                             revision_key=key, owner_id=owner_id)
+    finally:
+        chunk_scheduler.end(document_id)
+    text = "".join(page_texts)
+
+    if not result:
+        raise ValueError("Generated result is empty")
+
+    # Initialize RAG system with processed documents
+    initialize_rag_system({document_id: {'content': text}})
+    return result
+
+
+def _keep_leased(job_queue: JobQueue, job: Dict, worker_id: str, done: threading.Event):
+    while not done.wait(min(JOB_LEASE_SECONDS / 3, ETA_UPDATE_INTERVAL)):
+        eta = chunk_scheduler.eta(job['document_id'])
+        job_queue.heartbeat(job['id'], worker_id, time.time() + eta if eta is not None else None)
+
+
+def run_job(job_queue: JobQueue, job: Dict, worker_id: str):
+    document_id = job['document_id']
+    filename = job['payload']['filename']
+    logger.info(f"Worker {worker_id} processing document: {filename} (attempt {job['attempts']})")
+    done = threading.Event()
+    threading.Thread(target=_keep_leased, args=(job_queue, job, worker_id, done), daemon=True).start()
+    job_queue.add_event(document_id, 'document', {'status': 'Processing', 'attempt': job['attempts']})
+    workers_busy.inc()
+    try:
+        # Uploads sent with profile=1 are run under cProfile (this thread only; chunk requests run elsewhere)
+        with profiled(os.path.basename(filename), enabled=job['payload'].get('profile', False)):
+            result = process_document(job, job_queue)
+        job_queue.complete(job['id'], worker_id, result)
+        job_queue.add_event(document_id, 'document', {'status': 'Completed'})
+        logger.info(f"Successfully processed document: {filename}")
+    except Exception as e:
+        logger.error(f"Error processing document {filename}: {str(e)}")
+        # Another attempt would spend the same tokens again
+        if job_queue.fail(job['id'], worker_id, str(e), retry=not isinstance(e, TokenBudgetExceeded)):
+            logger.info(f"Document {filename} will be retried")
+            job_queue.add_event(document_id, 'document', {'status': 'Retrying', 'error': str(e)})
+        else:
+            job_queue.add_event(document_id, 'document', {'status': 'Failed', 'error': str(e)})
+    finally:
+        workers_busy.dec()
+        done.set()
+
+
+def run_worker(job_queue: JobQueue, worker_id: str, stop: Optional[threading.Event] = None, poll_interval: float = 1):
+    workers_total.inc()
+    while stop is None or not stop.is_set():
+        try:
+            job = job_queue.claim(worker_id)
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+            run_job(job_queue, job, worker_id)
+        except Exception as e:
+            logger.error(f"Error in document processing worker {worker_id}: {str(e)}")
+            time.sleep(poll_interval)
+
+
+def start_worker_threads(job_queue: JobQueue, count: int = PROCESSING_WORKERS):
+    base = f"{socket.gethostname()}-{os.getpid()}"
+    for number in range(count):
+        threading.Thread(
+            target=run_worker, args=(job_queue, f"{base}-t{number}"), name=f'document-worker-{number}', daemon=True
+        ).start()
+
+
+def _worker_process(number: int):
+    # Each process opens its own connection to the queue
+    run_worker(JobQueue(), f"{socket.gethostname()}-{os.getpid()}-p{number}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run document processing workers')
+    parser.add_argument('--workers', type=int, default=PROCESSING_WORKERS)
+    args = parser.parse_args()
+
+    processes = [multiprocessing.Process(target=_worker_process, args=(number,)) for number in range(args.workers)]
+    for process in processes:
+        process.start()
+    logger.info(f"Started {len(processes)} document processing workers")
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()